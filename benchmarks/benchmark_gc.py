@@ -0,0 +1,115 @@
+import asyncio, multiprocessing, os, tempfile, time
+from pathlib import Path
+
+import click, httpx, numpy as np, SimpleITK as sitk
+
+from intervention.fakegc import FakeGC, PREFIX, STATS
+from intervention.gcserver import GCServer
+from intervention.upload import delete_all_data, upload_data
+from intervention.utils import GCAPI
+
+TOKEN = '0' * 64
+
+
+def _serve(conn, cases: int, slug: str, fake_kwargs: dict, server_kwargs: dict):
+    # a separate process, such that the server does not compete with the client for the GIL
+    server = GCServer(FakeGC.synthetic(cases, slug, **fake_kwargs), **server_kwargs)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+class _Counter:
+    def __init__(self, url: str):
+        self.url = url + STATS
+        self.last = httpx.get(self.url, verify=os.environ.get('SSL_CERT_FILE', True)).json()
+
+    def delta(self) -> dict:
+        stats = httpx.get(self.url, verify=os.environ.get('SSL_CERT_FILE', True)).json()
+        delta = {k: v - self.last[k] for k, v in stats.items()}
+        self.last = stats
+        return delta
+
+
+def _report(name: str, seconds: float, count: int, unit: str, counter: _Counter):
+    d = counter.delta()
+    click.echo(f"{name:<32}{seconds:>8.2f} s{count / seconds:>10.1f} {unit}/s"
+               f"{d['requests']:>8} requests{d['rate_limited']:>6} x 429{d['failures']:>6} x 503")
+
+
+def _scans(input_dir: Path, count: int, shape, rng: np.random.Generator) -> int:
+    size = 0
+    for i in range(count):
+        path = input_dir / f'{10000 + i}' / f'{10000 + i}_{i}_needle_0.mha'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        array = rng.normal(100, 20, size=shape).clip(0).astype(np.int16)
+        sitk.WriteImage(sitk.GetImageFromArray(array), str(path))
+        size += path.stat().st_size
+    return size
+
+
+@click.command()
+@click.option('-n', '--cases', type=int, default=2000, help='display sets served')
+@click.option('-l', '--latency', type=float, default=0.05, help='seconds per request')
+@click.option('--page-size', type=int, default=None, help='maximum results per page')
+@click.option('--rate-limit', type=float, default=0, help='fraction of requests answered with 429')
+@click.option('--retry-after', type=int, default=0)
+@click.option('-c', '--concurrency', type=int, multiple=True, default=[1, 8, 32])
+@click.option('-f', '--files', type=int, default=16, help='scans to upload, 0 skips uploads')
+@click.option('-s', '--shape', type=int, nargs=3, default=(20, 256, 256), help='z y x of the scans')
+@click.option('--cert', type=click.Path(exists=True, path_type=Path), default=None,
+              help='self-signed PEM certificate (with key) for localhost, serves HTTPS and times gcapi as well')
+def main(cases: int, latency: float, page_size: int, rate_limit: float, retry_after: int, concurrency, files: int,
+         shape, cert: Path):
+    if cert:
+        # trusted by httpx, thus by gcapi and AsyncGC
+        os.environ['SSL_CERT_FILE'] = str(cert)
+    slug = 'fake'
+    receive, send = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=_serve, daemon=True, args=(
+        send, cases, slug, {'page_size': page_size, 'rate_limit': rate_limit, 'retry_after': retry_after},
+        {'latency': latency, 'certfile': cert}))
+    server.start()
+    url = receive.recv()
+    counter = _Counter(url)
+    click.echo(f'{cases} cases @ {url}, {latency * 1000:.0f} ms latency, page size {page_size or "any"}, '
+               f'{rate_limit:.0%} rate limited')
+
+    for c in concurrency:
+        gc = GCAPI(slug, TOKEN, base_url=url + PREFIX)
+
+        async def fetch():
+            async with gc.async_client(concurrency=c) as client:
+                return await asyncio.gather(client.answers(), client.display_sets(), client.images())
+
+        start = time.perf_counter()
+        records = sum(map(len, asyncio.run(fetch())))
+        _report(f'AsyncGC fetch concurrency={c}', time.perf_counter() - start, records, 'records', counter)
+
+    if cert:
+        gc = GCAPI(slug, TOKEN, base_url=url + PREFIX)
+        start = time.perf_counter()
+        try:
+            records = len(gc.answers) + len(gc.display_sets) + len(gc.cases)
+            _report('GCAPI (gcapi) fetch', time.perf_counter() - start, records, 'records', counter)
+        except Exception as e:
+            click.echo(f'GCAPI (gcapi) fetch failed: {type(e).__name__}: {str(e).splitlines()[0]}')
+
+    if files:
+        with tempfile.TemporaryDirectory() as tmp:
+            size = _scans(Path(tmp) / 'mha', files, shape, np.random.default_rng(0))
+            gc = GCAPI(slug, TOKEN, base_url=url + PREFIX)
+            start = time.perf_counter()
+            errors = upload_data(Path(tmp) / 'mha', gc, cache_dir=Path(tmp) / 'cache')
+            _report(f'upload_data {files} x {size / files / 1e6:.1f} MB', time.perf_counter() - start,
+                    size / 1e6, 'MB', counter)
+            start = time.perf_counter()
+            errors += delete_all_data(gc)
+            _report('delete_all_data', time.perf_counter() - start, cases + files, 'display sets', counter)
+            if errors:
+                click.echo(f'{len(errors)} requests failed')
+
+    server.terminate()
+
+
+if __name__ == '__main__':
+    main()
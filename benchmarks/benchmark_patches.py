@@ -0,0 +1,57 @@
+import tempfile, time
+from pathlib import Path
+
+import click, numpy as np, SimpleITK as sitk
+
+from intervention.patches import write_patch_store, PatchStore
+
+
+def _task(task_dir: Path, cases: int, shape, rng: np.random.Generator):
+    (task_dir / 'imagesTr').mkdir(parents=True)
+    (task_dir / 'labelsTr').mkdir(parents=True)
+    for i in range(cases):
+        image = rng.normal(100, 20, size=shape).astype(np.float32)
+        label = np.zeros(shape, dtype=np.uint8)
+        label[shape[0] // 2, 100:140, 60:200] = 1
+        sitk.WriteImage(sitk.GetImageFromArray(image), str(task_dir / 'imagesTr' / f'case_{i}_0000.nii.gz'), True)
+        sitk.WriteImage(sitk.GetImageFromArray(label), str(task_dir / 'labelsTr' / f'case_{i}.nii.gz'), True)
+
+
+@click.command()
+@click.option('-c', '--cases', type=int, default=20)
+@click.option('-s', '--shape', type=int, nargs=3, default=(5, 256, 256), help='z y x')
+@click.option('-p', '--patch', type=int, nargs=3, default=(5, 128, 128), help='z y x')
+@click.option('-n', '--samples', type=int, default=200)
+def main(cases: int, shape, patch, samples: int):
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        task = Path(tmp) / 'Task500_benchmark'
+        _task(task, cases, shape, rng)
+
+        start = time.perf_counter()
+        write_patch_store(task, task / 'patches', 'Tr')
+        click.echo(f'write_patch_store   {time.perf_counter() - start:>8.3f}s for {cases} cases')
+
+        files = sorted((task / 'imagesTr').iterdir())
+        start = time.perf_counter()
+        for _ in range(samples):
+            f = files[rng.integers(len(files))]
+            image = sitk.GetArrayFromImage(sitk.ReadImage(str(f)))
+            label = sitk.GetArrayFromImage(sitk.ReadImage(str(task / 'labelsTr' / f.name.replace('_0000', ''))))
+            z, y, x = (int(rng.integers(0, s - p + 1)) for s, p in zip(shape, patch))
+            image[z:z + patch[0], y:y + patch[1], x:x + patch[2]].copy()
+            label[z:z + patch[0], y:y + patch[1], x:x + patch[2]].copy()
+        nii = samples / (time.perf_counter() - start)
+
+        store = PatchStore(task / 'patches', 'Tr')
+        start = time.perf_counter()
+        for _ in range(samples):
+            store.sample(patch, rng)
+        npy = samples / (time.perf_counter() - start)
+
+        click.echo(f'.nii.gz patches/s   {nii:>8.1f}')
+        click.echo(f'store patches/s     {npy:>8.1f}  ({npy / nii:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import importlib, json, platform, shutil, subprocess, tempfile, time, traceback
+from datetime import datetime
+from pathlib import Path
+
+import click
+
+from intervention.synthetic import generate, SyntheticGC, MAPPINGS
+from intervention.utils import CommandDCM, CommandDCM2MHA, CommandAnnotate, CommandMHA2nnUNet
+
+
+def _version() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], text=True,
+                                       cwd=Path(__file__).parent).strip()
+    except Exception:
+        return 'unknown'
+
+
+def _time(stage: str, module: str, cmd) -> dict:
+    # stages are imported when timed, such that a missing dependency (picai_prep) is reported per stage
+    start = time.perf_counter()
+    try:
+        getattr(importlib.import_module(module), stage)(cmd)
+        return {'stage': stage, 'seconds': time.perf_counter() - start}
+    except Exception as e:
+        return {'stage': stage, 'seconds': time.perf_counter() - start, 'error': f'{type(e).__name__}: {e}',
+                'traceback': traceback.format_exc()}
+
+
+def run(base: Path, patients: int, series: int, seed: int, cache_dir: str = '', cache_budget: float = 50) -> dict:
+    start = time.perf_counter()
+    paths = generate(base / 'synthetic', patients=patients, series=series, seed=seed)
+    results = [{'stage': 'generate', 'seconds': time.perf_counter() - start}]
+
+    kwargs = lambda name, **settings: {'name': name, 'summary': '', 'base_dir': base, 'settings': settings}
+    dcm = CommandDCM(**kwargs('dcm', archive_dir=paths['archive'].as_posix(), out_dir='dcm', mappings=MAPPINGS))
+    dcm2mha = CommandDCM2MHA(**kwargs('dcm2mha', archive_dir=paths['archive'].as_posix(), out_dir='mha',
+                                      json_dir='dcm'))
+    annotate = CommandAnnotate(**kwargs('annotate', mha_dir=paths['mha'].as_posix(), out_dir='annotations',
+                                        gc_slug='synthetic', gc_api='0' * 64, cache_dir=cache_dir,
+                                        cache_budget=cache_budget))
+    annotate.gc = SyntheticGC(paths['answers'])
+    mha2nnunet = CommandMHA2nnUNet(**kwargs('mha2nnunet', mha_dir=paths['mha'].as_posix(),
+                                            annotate_dir=annotate.out_dir.as_posix(), out_dir='nnunet',
+                                            test_percentage=0.2, task_name='benchmark', task_id=500))
+
+    results.append(_time('generate_dcm2mha_json', 'intervention.dcm', dcm))
+    results.append(_time('dcm2mha', 'intervention.dcm2mha', dcm2mha))
+    results.append(_time('write_annotations', 'intervention.annotate', annotate))
+    results.append(_time('generate_mha2nnunet_jsons', 'intervention.mha2nnunet', mha2nnunet))
+    results.append(_time('mha2nnunet', 'intervention.mha2nnunet', mha2nnunet))
+
+    return {'patients': patients, 'series': series, 'cases': patients * series, 'cache': bool(cache_dir),
+            'stages': results}
+
+
+@click.command()
+@click.option('-o', '--output', type=click.Path(path_type=Path), default='benchmark.json',
+              help='json file to append results to')
+@click.option('-p', '--patients', multiple=True, type=int, default=[2, 8], help='scales to benchmark')
+@click.option('-n', '--series', type=int, default=4, help='series per patient')
+@click.option('--seed', type=int, default=0)
+@click.option('--keep', is_flag=True, help='keep the generated data')
+@click.option('--cache', is_flag=True, help='use the decompressed volume cache')
+def main(output: Path, patients, series: int, seed: int, keep: bool, cache: bool):
+    record = {'version': _version(), 'date': datetime.now().isoformat(), 'python': platform.python_version(),
+              'machine': platform.machine(), 'runs': []}
+
+    for p in patients:
+        base = Path(tempfile.mkdtemp(prefix='fastmri_benchmark_'))
+        try:
+            run_ = run(base, p, series, seed, cache_dir='cache' if cache else '')
+            record['runs'].append(run_)
+            for r in run_['stages']:
+                status = r.get('error', '').split('\n')[0] or 'ok'
+                click.echo(f"{p:>4} patients  {r['stage']:<28}{r['seconds']:>9.3f}s  {status}")
+        finally:
+            if keep:
+                click.echo(f'kept {base}')
+            else:
+                shutil.rmtree(base, ignore_errors=True)
+
+    history = []
+    if output.exists():
+        with open(output) as f:
+            history = json.load(f)
+    history.append(record)
+    with open(output, 'w') as f:
+        json.dump(history, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
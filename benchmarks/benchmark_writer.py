@@ -0,0 +1,59 @@
+import gzip, tempfile, time
+from pathlib import Path
+
+import click, numpy as np, SimpleITK as sitk
+
+from intervention.writer import write_image
+
+
+def _label_map(shape, rng: np.random.Generator) -> sitk.Image:
+    # sparse needle-like labels on a zero background, as written by annotate
+    array = np.zeros(shape, dtype=np.uint8)
+    z, y, x = (rng.integers(0, s, size=shape[1] * 4) for s in shape)
+    array[z, y, x] = rng.integers(1, 3, size=z.size)
+    return sitk.GetImageFromArray(array)
+
+
+def _scan(shape, rng: np.random.Generator) -> sitk.Image:
+    return sitk.GetImageFromArray(rng.normal(100, 20, size=shape).astype(np.int16))
+
+
+def _measure(write, path: Path, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        write(path)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('-s', '--shape', type=int, nargs=3, default=(20, 512, 512), help='z y x')
+@click.option('-r', '--repeats', type=int, default=3)
+@click.option('-t', '--threads', type=int, multiple=True, default=[1, 4, 8])
+@click.option('-k', '--kind', type=click.Choice(['label', 'scan']), default='label')
+def main(shape, repeats: int, threads, kind: str):
+    image = (_label_map if kind == 'label' else _scan)(shape, np.random.default_rng(0))
+    mb = image.GetNumberOfPixels() * image.GetSizeOfPixelComponent() / 1e6
+    click.echo(f'{shape} {image.GetPixelIDTypeAsString()} {kind}, {mb:.1f} MB uncompressed')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'label.nii.gz'
+        runs = [('sitk useCompression', lambda p: sitk.WriteImage(image, str(p), useCompression=True))]
+        for level in [0, 1, 6]:
+            for t in threads:
+                runs.append((f'write_image level={level} threads={t}',
+                             lambda p, level=level, t=t: write_image(image, p, level=level, threads=t)))
+
+        for name, write in runs:
+            seconds = _measure(write, path, repeats)
+            size = path.stat().st_size / 1e6
+            with gzip.open(path) as f:
+                f.read()
+            assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(path))),
+                                  sitk.GetArrayViewFromImage(image))
+            click.echo(f'{name:<36}{mb / seconds:>9.1f} MB/s{size:>9.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
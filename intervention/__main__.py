@@ -4,29 +4,38 @@ from datetime import datetime
 
 import click
 
-from intervention.dcm import generate_dcm2mha_json
-from intervention.dcm2mha import dcm2mha
-from intervention.mha2nnunet import mha2nnunet
-from intervention.upload import upload_data, delete_all_data
-from intervention.annotate import write_annotations
-from intervention.utils import DirectoryManager, GCAPI, Settings
-# from intervention.inference import inference, plot
+from intervention.utils import CommandUpload, Settings, now
+from intervention.metrics import Tracer
 
+# stage modules import picai_prep, SimpleITK, shapely, gcapi etc., so they are imported when their command runs
 
-def upload(dm: DirectoryManager, gc: GCAPI):
+
+def upload(cmd: CommandUpload):
+    from intervention.upload import upload_data, delete_all_data
+
+    gc = cmd.gc
     if click.confirm('Confirm delete? (required when uploading)'):
         logging.info(f'Deleting mha files @ grand-challenge.org/reader-studies/{gc.slug}')
-        delete_all_data(gc)
-        logging.info(f'Uploading mha files @ {dm.mha} to grand-challenge.org/reader-studies/{gc.slug}')
-        upload_data(dm.mha, gc)
+        if errors := delete_all_data(gc):
+            click.echo(f'{len(errors)} display sets could not be deleted, see the log')
+        logging.info(f'Uploading mha files @ {cmd.mha_dir} to grand-challenge.org/reader-studies/{gc.slug}')
+        if errors := upload_data(cmd.mha_dir, gc, cache_dir=cmd.out_dir, level=cmd.compression_level,
+                                 workers=cmd.workers, preview=cmd.preview):
+            click.echo(f'{len(errors)} uploads failed, see the log')
     else:
         logging.info('Cancelled delete, skipping upload step')
 
 
-@click.command()
-@click.option('-s', '--settings', type=click.Path(resolve_path=True, path_type=Path),
-              prompt='Enter path/to/settings.json', default='.', help="Path to json settings file")
-def cli(settings: Path):
+@click.group(invoke_without_command=True)
+@click.option('-s', '--settings', type=click.Path(resolve_path=True, path_type=Path), help="Path to json settings file")
+@click.option('--profile', is_flag=True, help="Run each stage under cProfile")
+@click.pass_context
+def cli(ctx: click.Context, settings: Path, profile: bool):
+    if ctx.invoked_subcommand is not None:
+        return
+    if settings is None:
+        settings = click.prompt('Enter path/to/settings.json', default='.',
+                                type=click.Path(resolve_path=True, path_type=Path))
     s = Settings(settings)
     print(s.summary())
     click.confirm('\nStart program?', abort=True)
@@ -34,25 +43,64 @@ def cli(settings: Path):
     start = datetime.now()
     logging.info(f"Program started at {start}")
 
-    for cmd in s.commands:
-        if cmd.name == 'dcm':
-            generate_dcm2mha_json(cmd)
-        if cmd.name == 'dcm2mha':
-            dcm2mha(cmd)
-        if cmd.name == 'upload':
-            pass
-        if cmd.name == 'annotate':
-            write_annotations(cmd)
-        if cmd.name == 'mha2nnunet':
-            mha2nnunet(cmd)
-        # if cmd.name == 'inference':
-        #     inference(cmd.dm, cmd.trainer)
-        # if cmd.name == 'plot':
-        #     plot(cmd.dm)
+    n = now()
+    tracer = Tracer(Path(f'fastmri_intervention_{n}.trace.jsonl'),
+                    profile_dir=Path(f'fastmri_intervention_{n}_profile') if profile else None)
+    with tracer:
+        for cmd in s.commands:
+            with tracer.stage(cmd.name):
+                if cmd.name == 'dcm':
+                    from intervention.dcm import generate_dcm2mha_json
+                    generate_dcm2mha_json(cmd)
+                if cmd.name == 'dcm2mha':
+                    from intervention.dcm2mha import dcm2mha
+                    dcm2mha(cmd)
+                if cmd.name == 'upload':
+                    upload(cmd)
+                if cmd.name == 'annotate':
+                    from intervention.annotate import write_annotations
+                    write_annotations(cmd)
+                if cmd.name == 'mha2nnunet':
+                    from intervention.mha2nnunet import mha2nnunet
+                    mha2nnunet(cmd)
+                if cmd.name == 'inference':
+                    from intervention.inference import inference
+                    inference(cmd)
+                if cmd.name == 'export':
+                    from intervention.export import export
+                    export(cmd)
+                if cmd.name == 'native':
+                    from intervention.native import backproject
+                    backproject(cmd)
+                # if cmd.name == 'plot':
+                #     plot(cmd.dm)
+
+    click.echo(f'\n{tracer.summary()}')
+    logging.info(f'Trace written to {tracer.path}\n{tracer.summary()}')
 
     end = datetime.now()
     logging.info(f"Program end at {end}\n\truntime {end - start}")
 
 
+@cli.command()
+@click.option('-q', '--queue', 'queue_dir', type=click.Path(file_okay=False, resolve_path=True, path_type=Path),
+              required=True, help="Shared work queue directory, the queue_dir of the settings")
+@click.option('--idle-timeout', type=float, default=None, help="Exit after this many seconds without tasks")
+@click.option('--max-tasks', type=int, default=None, help="Exit after this many tasks")
+@click.option('-s', '--settings', type=click.Path(exists=True, dir_okay=False, resolve_path=True, path_type=Path),
+              default=None, help="Json settings file to read the API keys from, else the environment")
+def worker(queue_dir: Path, idle_timeout: float, max_tasks: int, settings: Path):
+    """Run distributed stage tasks from a shared work queue"""
+    import functools
+    from intervention.utils import read_secrets
+    from intervention.workqueue import run_task, work, worker_name
+
+    logging.basicConfig(filename=f'fastmri_intervention_worker_{now()}.log', level=logging.INFO)
+    click.echo(f'Worker {worker_name()} on {queue_dir}')
+    func = functools.partial(run_task, secrets=read_secrets(settings))
+    completed = work(queue_dir, func=func, idle_timeout=idle_timeout, max_tasks=max_tasks)
+    click.echo(f'Completed {completed} tasks')
+
+
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    cli()
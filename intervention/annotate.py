@@ -1,64 +1,27 @@
-import os, threading
-from dataclasses import dataclass
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
-from typing import List
+import shutil, threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import List, Tuple
 
 import click, numpy as np, SimpleITK as sitk
 from shapely.geometry import Polygon, Point, LineString, MultiPoint
 from quaternion import from_vector_part, rotate_vectors
 from tqdm import tqdm
 
-from intervention.utils import GCAPI, CommandAnnotate
+from intervention.utils import CommandAnnotate
+from intervention.answers import AnswerTable, Case
+from intervention.metrics import work_item
+from intervention.writer import write_image
+from intervention.workqueue import distribute, shard_dir, shard_of, SHARDS_DIR
+from intervention.scheduler import header_bytes
+from intervention.cache import image_header
+from intervention.grid import empty_image, target_grid, GRID_DIR
 
 # in mm
 diameter_base = 12
 diameter_needle = 6
-
-
-@dataclass
-class Annotation:
-    x: int
-    y: int
-    z: int
-
-    def is_zero(self):
-        return self.x == 0 and self.y == 0 and self.z == 0
-
-    def as_tuple(self):
-        return self.x, self.y, self.z
-
-    def as_ndarray(self):
-        return np.array([self.x, self.y, self.z])
-
-
-@dataclass
-class Answer:
-    name: str = 'untitled'
-    mha: Path = None
-    base: Annotation = Annotation(0, 0, 0)
-    needle: Annotation = Annotation(0, 0, 0)
-    tip: Annotation = Annotation(0, 0, 0)
-    no_needle: bool = True
-    _error: str = None
-
-    # how to deal with more creators (snorthman)?
-
-    def _get_error(self) -> str:
-        return f'{self.name}: ' + self._error if self._error else 'Annotated'
-
-    def _set_error(self, error):
-        self._error = f'{type(error).__name__}({str(error)}'
-
-    error = property(fget=_get_error, fset=_set_error)
-
-    def is_valid(self) -> bool:
-        return self.mha is not None and \
-               self.mha.exists() and \
-               not any(p.is_zero() for p in [self.base, self.needle, self.tip]) and \
-               not self.no_needle and \
-               self._error is None
+# shortest casing and needle segments, shorter segments have no direction
+min_length = 1e-3
 
 
 class Boundary:
@@ -91,56 +54,116 @@ class Boundary:
         return self._XY.contains(xy) and self._YZ.contains(yz)
 
 
-def _get_answers(mha_dir: Path, gc: GCAPI) -> List[Answer]:
-    mha = dict()
-    for root, dirs, files in os.walk(mha_dir):
-        for file in files:
-            if file.endswith('.mha'):
-                mha[file] = Path(root) / file
-
-    raw_questions = gc.questions
-    raw_answers = gc.answers
-    display_sets = gc.display_sets
-    cases = gc.cases
-
-    list_to_annotation = lambda array: Annotation(x=array[0], y=array[1], z=array[2])
-
-    answers = dict()
-    for url, ra in raw_answers.items():
-        if (display_set := ra['display_set']) in answers:
-            a = answers[display_set]
-        else:
-            answers[display_set] = (a := Answer())
-
-        try:
-            if not (question := raw_questions.get(ra['question'])):
-                click.echo(f'unknown question: {ra["question"]}')
+def preflight(cases: List[Case], headers: List[dict]) -> np.ndarray:
+    """
+    Reason per case why its annotation cannot be written, '' if it can, from the image geometry only:
+    coincident points and points outside the image. All points are transformed to indices at once.
+
+    :param headers: image header per case (see intervention.cache.read_header), None if it could not be read
+    """
+    reasons = np.full(len(cases), '', dtype=object)
+    readable = np.array([h is not None for h in headers], dtype=bool)
+    reasons[~readable] = 'unreadable mha'
+    if not readable.any():
+        return reasons
+
+    ok = np.nonzero(readable)[0]
+    points = np.array([[cases[i].base, cases[i].needle, cases[i].tip] for i in ok], dtype=np.float64)
+    origin = np.array([headers[i]['origin'] for i in ok], dtype=np.float64)
+    spacing = np.array([headers[i]['spacing'] for i in ok], dtype=np.float64)
+    direction = np.array([headers[i]['direction'] for i in ok], dtype=np.float64).reshape(-1, 3, 3)
+    size = np.array([headers[i]['size'] for i in ok], dtype=np.float64)
+
+    # continuous (x, y, z) index of each point: (direction * spacing)^-1 (point - origin)
+    index = np.linalg.solve((direction * spacing[:, None, :])[:, None], (points - origin[:, None])[..., None])[..., 0]
+    outside = ((index < -0.5) | (index > size[:, None] - 0.5)).any(axis=2)
+    lengths = np.linalg.norm(np.diff(points, axis=1), axis=2)
+
+    for row, i in enumerate(ok):
+        problems = [f'{name} point outside the image (index {np.round(index[row, p], 1).tolist()})'
+                    for p, name in enumerate(['casing', 'needle', 'tip']) if outside[row, p]]
+        problems += [f'coincident {name} points' for s, name in enumerate(['casing and needle', 'needle and tip'])
+                     if lengths[row, s] < min_length]
+        reasons[i] = ', '.join(problems)
+    return reasons
+
+
+def rasterize(annotation: sitk.Image, boundaries: List[Boundary]):
+    """
+    Flood fill each boundary with its label, from its centre, on the grid of annotation. The image and the boundary
+    are convex, their intersection is connected within the image.
+    """
+    size = annotation.GetSize()
+    for boundary in boundaries:
+        start = annotation.TransformPhysicalPointToIndex(boundary.center)
+        if not all(0 <= i < n for i, n in zip(start, size)):
+            # the centre is outside a grid smaller than the image, start at the nearest voxel inside the boundary
+            start = tuple(min(max(i, 0), n - 1) for i, n in zip(start, size))
+            if not boundary.contains(np.array(annotation.TransformIndexToPhysicalPoint(start))):
                 continue
-            question = question['question_text']
-            if question == 'No needle':
-                a.no_needle = ra['answer']
-            elif question == 'Casing':
-                a.base = list_to_annotation(ra['answer']['point'])
-            elif question == 'Needle':
-                a.needle = list_to_annotation(ra['answer']['point'])
-            elif question == 'Tip':
-                a.tip = list_to_annotation(ra['answer']['point'])
-        except Exception as e:
-            a.error = str(e)
-            continue
-
-        try:
-            a.name = gc.image(display_set)
-            a.mha = mha[a.name]
-        except Exception as e:
-            a.error = str(e)
-            continue
-
-    return [a for a in answers.values()]
+        trail = [start]
+        explored = {start}
+
+        while len(trail) > 0:
+            X, Y, Z = trail.pop()
+            annotation.SetPixel(X, Y, Z, boundary.label)
+
+            group = []
+            for x in [X - 1, X + 1]:
+                group.append((x, Y, Z))
+            for y in [Y - 1, Y + 1]:
+                group.append((X, y, Z))
+            for z in [Z - 1, Z + 1]:
+                group.append((X, Y, z))
+            group = [g for g in group if g not in explored and all(0 <= i < n for i, n in zip(g, size))]
+
+            trail += [g for g in group if boundary.contains(np.array(annotation.TransformIndexToPhysicalPoint(g)))]
+            explored = explored.union(group)
+
+
+# the answers the coordinator downloaded, read by the shards
+ANSWERS_NPZ = 'answers.npz'
+
+
+def _log_name() -> str:
+    return f'annotation_log_{datetime.now().strftime("%Y%m%d%H%M%S")}.log'
+
+
+def annotate_shard(cmd: CommandAnnotate, shard: int, shards: int) -> dict:
+    return write_annotations(cmd, shard=(shard, shards))
+
+
+def write_annotations(cmd: CommandAnnotate, base_needle: int = 1, needle_tip: int = 2,
+                      shard: Tuple[int, int] = None) -> dict:
+    """
+    :param shard: (shard, shards), write the annotations of this shard of the cases only.
+    If not set and cmd.queue_dir is set, all shards are distributed over the work queue.
+    :return: number of written, skipped and failed annotations
+    """
+    if shard is None and cmd.queue_dir:
+        # downloaded once, for all shards
+        click.echo(f'Downloading answers from\n\t{cmd.gc.slug}')
+        answers = AnswerTable.from_gc(cmd.gc, cmd.mha_dir)
+        (cmd.out_dir / SHARDS_DIR).mkdir(parents=True, exist_ok=True)
+        answers.save(cmd.out_dir / SHARDS_DIR / ANSWERS_NPZ)
+
+        results = distribute(cmd)
+        counts = {k: sum(r[k] for r in results) for k in ['successes', 'skips', 'errors']}
+        click.echo(f'Wrote {counts["successes"]} annotations, with {counts["skips"]} skipped and '
+                   f'{counts["errors"]} failed')
+
+        # the invalid answers, then the failures and agreement of the cases of each shard
+        with open(cmd.out_dir / _log_name(), 'w') as f:
+            f.writelines([f'{line}\n' for line in answers.log()])
+            for i in range(cmd.shards):
+                with open(shard_dir(cmd.out_dir, i) / 'annotation_log.log') as shard_log:
+                    f.write(shard_log.read())
+        shutil.rmtree(cmd.out_dir / SHARDS_DIR)
+        return counts
 
-
-def write_annotations(cmd: CommandAnnotate, base_needle: int = 1, needle_tip: int = 2):
     context = threading.local()
+    if cmd.grid:
+        (cmd.out_dir / GRID_DIR).mkdir(exist_ok=True)
 
     if not all(0 < x < 3 for x in [base_needle, needle_tip]):
         raise ValueError("base_needle and needle_tip must be 1 and/or 2")
@@ -148,74 +171,97 @@ def write_annotations(cmd: CommandAnnotate, base_needle: int = 1, needle_tip: in
     def initializer_worker():
         context.ifr = sitk.ImageFileReader()
 
-    def _write_annotation(answer: Answer) -> bool:
-        if not answer.is_valid():
-            return False
-
-        try:
-            context.ifr.SetFileName(str(answer.mha.absolute()))
-            context.ifr.ReadImageInformation()
-            mha: sitk.Image = context.ifr.Execute()
-
-            (sz := list(mha.GetSize())).reverse()
-            annotation = sitk.GetImageFromArray(np.zeros(sz))
-            annotation.SetDirection(mha.GetDirection())
-            annotation.SetOrigin(mha.GetOrigin())
-            annotation.SetSpacing(mha.GetSpacing())
-            [annotation.SetMetaData(k, mha.GetMetaData(k)) for k in mha.GetMetaDataKeys()]
-
-            base, needle, tip = (p.as_ndarray() for p in [answer.base, answer.needle, answer.tip])
-
-            boundary_base_needle = Boundary(base, needle, base_needle, thickness=diameter_base)
-            boundary_needle_tip = Boundary(needle, tip, needle_tip, thickness=diameter_needle)
-
-            for boundary in [boundary_base_needle, boundary_needle_tip]:
-                trail = [start := mha.TransformPhysicalPointToIndex(boundary.center)]
-                explored = {start}
-
-                while len(trail) > 0:
-                    X, Y, Z = trail.pop()
-                    try:
-                        annotation.SetPixel(X, Y, Z, boundary.label)
-                    except:
-                        pass
-
-                    group = []
-                    for x in [X - 1, X + 1]:
-                        group.append((x, Y, Z))
-                    for y in [Y - 1, Y + 1]:
-                        group.append((X, y, Z))
-                    for z in [Z - 1, Z + 1]:
-                        group.append((X, Y, z))
-                    group = [g for g in group if g not in explored]
-
-                    trail += [g for g in group
-                              if boundary.contains(np.array(mha.TransformIndexToPhysicalPoint(g)))]
-                    explored = explored.union(group)
-
-            sitk.WriteImage(annotation, fileName=str(cmd.out_dir / answer.mha.with_suffix('.nii.gz').name), useCompression=True)
-            return True
-        except Exception as e:
-            answer.error = e
-            return False
+    def _write_annotation(case: Case) -> bool:
+        with work_item(case.name):
+            try:
+                if cmd.cache:
+                    mha: sitk.Image = cmd.cache.read(case.mha)
+                else:
+                    context.ifr.SetFileName(str(case.mha.absolute()))
+                    context.ifr.ReadImageInformation()
+                    mha: sitk.Image = context.ifr.Execute()
+
+                size = mha.GetSize()
+                (sz := list(size)).reverse()
+                annotation = sitk.GetImageFromArray(np.zeros(sz, dtype=np.uint8))
+                annotation.SetDirection(mha.GetDirection())
+                annotation.SetOrigin(mha.GetOrigin())
+                annotation.SetSpacing(mha.GetSpacing())
+                [annotation.SetMetaData(k, mha.GetMetaData(k)) for k in mha.GetMetaDataKeys()]
+
+                boundaries = [Boundary(case.base, case.needle, base_needle, thickness=diameter_base),
+                              Boundary(case.needle, case.tip, needle_tip, thickness=diameter_needle)]
+                rasterize(annotation, boundaries)
+                if cmd.grid:
+                    grid = empty_image(target_grid(headers[case.mha]))
+                    rasterize(grid, boundaries)
+                    write_image(grid, cmd.out_dir / GRID_DIR / case.mha.with_suffix('.nii.gz').name,
+                                level=cmd.compression_level, threads=2)
+
+                write_image(annotation, cmd.out_dir / case.mha.with_suffix('.nii.gz').name,
+                            level=cmd.compression_level, threads=2)
+                return True
+            except Exception as e:
+                failures.append(f'{case.name}: {type(e).__name__}({e})')
+                return False
 
     click.echo(f'\nCreating annotations in\n\t{cmd.out_dir}\nusing\n\t{cmd.mha_dir}\nand answers from\n\t{cmd.gc.slug}')
 
-    answers = _get_answers(cmd.mha_dir, cmd.gc)
-
-    click.echo(f'Downloaded {len(answers)} case answers from Grand Challenge')
+    if shard:
+        answers = AnswerTable.load(cmd.out_dir / SHARDS_DIR / ANSWERS_NPZ)
+    else:
+        answers = AnswerTable.from_gc(cmd.gc, cmd.mha_dir)
+    cases = list(answers.cases())
+    failures = []
+    invalid = len(answers.display_sets) - len(cases)
+    if shard:
+        cases = [c for c in cases if shard_of(c.name, shard[1]) == shard[0]]
+        # the first shard accounts for the invalid answers
+        invalid = invalid if shard[0] == 0 else 0
+
+    def header(case: Case):
+        try:
+            return image_header(case.mha, cmd.cache)
+        except (RuntimeError, OSError):
+            return None
+
+    # reject cases from their headers, before reading any image
+    with ThreadPoolExecutor(max_workers=cmd.scheduler.workers) as pool:
+        headers = list(pool.map(header, cases))
+    reasons = preflight(cases, headers)
+    failures += [f'{case.name}: {reason}' for case, reason in zip(cases, reasons) if reason]
+    rejected = int(np.count_nonzero(reasons))
+    invalid += rejected
+    headers = {case.mha: h for case, h, reason in zip(cases, headers, reasons) if not reason}
+    cases = [case for case, reason in zip(cases, reasons) if not reason]
+
+    click.echo(f'Downloaded {len(answers.display_sets)} case answers from {len(answers.readers)} readers '
+               f'from Grand Challenge, {len(cases)} cases are valid ({rejected} rejected by their geometry)')
+
+    def estimate(case: Case) -> int:
+        # the scan, plus the uint8 annotation as array, image and uncompressed nifti
+        h = headers[case.mha]
+        return header_bytes(h) + 3 * header_bytes(h, dtype=np.uint8) + \
+            (3 * header_bytes(target_grid(h), dtype=np.uint8) if cmd.grid else 0)
 
     successes, errors = 0, 0
-    with ThreadPoolExecutor(max_workers=min(8, (os.cpu_count() or 1) + 4), initializer=initializer_worker) as pool:
-        futures = {pool.submit(_write_annotation, a): a for a in answers}
-        for future in tqdm(as_completed(futures), total=len(answers)):
-            try:
-                successes += 1 if future.result() else 0
-            except Exception as e:
-                click.echo(f'Unexpected error: {e}')
-                errors += 1
-    skips = len(answers) - successes - errors
+    results = cmd.scheduler.map(_write_annotation, cases, estimate, initializer=initializer_worker)
+    for _, future in tqdm(results, total=len(cases)):
+        try:
+            successes += 1 if future.result() else 0
+        except Exception as e:
+            click.echo(f'Unexpected error: {e}')
+            errors += 1
+    skips = invalid + len(cases) - successes - errors
     click.echo(f'Wrote {successes} annotations, with {skips} skipped and {errors} failed')
 
-    with open(cmd.out_dir / f'annotation_log_{datetime.now().strftime("%Y%m%d%H%M%S")}.log', 'w') as f:
-        f.writelines([f'{a.error}\n' for a in answers if not a.is_valid()])
\ No newline at end of file
+    log = cmd.out_dir / _log_name()
+    if shard:
+        log = shard_dir(cmd.out_dir, shard[0]) / 'annotation_log.log'
+        log.parent.mkdir(parents=True, exist_ok=True)
+    with open(log, 'w') as f:
+        # the coordinator logs the invalid answers of all shards
+        f.writelines([f'{line}\n' for line in (failures if shard else answers.log() + failures)])
+        f.writelines([f'{c.name}: {c.readers} readers, agreement {c.agreement:.1f} mm\n'
+                      for c in cases if c.readers > 1])
+    return {'successes': successes, 'skips': skips, 'errors': errors}
@@ -0,0 +1,196 @@
+import os
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional
+
+import click, numpy as np
+
+from intervention.utils import GCAPI
+
+# question text to point index, 'No needle' is stored separately
+POINTS = {'Casing': 0, 'Needle': 1, 'Tip': 2}
+
+ROW = np.dtype([
+    ('display_set', np.int32),  # index into AnswerTable.display_sets
+    ('reader', np.int32),  # index into AnswerTable.readers
+    ('points', np.float64, (3, 3)),  # base, needle, tip (physical x, y, z), nan if unanswered
+    ('no_needle', bool),
+    ('error', np.int32),  # index into AnswerTable.errors, -1 if none
+])
+
+
+class Case(NamedTuple):
+    name: str
+    mha: Path
+    base: np.ndarray
+    needle: np.ndarray
+    tip: np.ndarray
+    readers: int
+    agreement: float
+
+
+class AnswerTable:
+    def __init__(self, display_sets: np.ndarray, names: np.ndarray, mha: List[Optional[Path]], readers: np.ndarray,
+                 rows: np.ndarray, errors: List[str]):
+        """
+        Answers of all readers as one structured array, one row per (display set, reader)
+
+        :param display_sets: display set urls
+        :param names: image name per display set, '' if unknown
+        :param mha: mha path per display set, None if not found
+        :param readers: reader (answer creator) names
+        :param rows: ROW structured array
+        :param errors: error messages referenced by rows['error']
+        """
+        self.display_sets = display_sets
+        self.names = names
+        self.mha = mha
+        self.readers = readers
+        self.rows = rows
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def from_gc(gc: GCAPI, mha_dir: Path) -> 'AnswerTable':
+        mha = dict()
+        for root, dirs, files in os.walk(mha_dir):
+            for file in files:
+                if file.endswith('.mha'):
+                    mha[file] = Path(root) / file
+
+        questions = {url: q['question_text'] for url, q in gc.questions.items()}
+        raw_answers = list(gc.answers.values())
+
+        display_sets, ds_index = np.unique([ra['display_set'] for ra in raw_answers], return_inverse=True)
+        readers, reader_index = np.unique([str(ra.get('creator')) for ra in raw_answers], return_inverse=True)
+        keys, row_index = np.unique(ds_index * max(1, len(readers)) + reader_index, return_inverse=True)
+
+        rows = np.zeros(len(keys), dtype=ROW)
+        rows['display_set'] = keys // max(1, len(readers))
+        rows['reader'] = keys % max(1, len(readers))
+        rows['points'] = np.nan
+        rows['no_needle'] = True
+        rows['error'] = -1
+        errors = []
+
+        def error(row: int, e: str):
+            rows['error'][row] = len(errors)
+            errors.append(e)
+
+        point_rows, point_index, point_values = [], [], []
+        for ra, row in zip(raw_answers, row_index):
+            if not (question := questions.get(ra['question'])):
+                click.echo(f'unknown question: {ra["question"]}')
+                continue
+            try:
+                if question == 'No needle':
+                    rows['no_needle'][row] = ra['answer']
+                elif question in POINTS:
+                    point = ra['answer']['point']
+                    point_values.append([point[0], point[1], point[2]])
+                    point_rows.append(row)
+                    point_index.append(POINTS[question])
+            except Exception as e:
+                error(row, f'{type(e).__name__}({e})')
+        if point_rows:
+            rows['points'][point_rows, point_index] = np.array(point_values, dtype=np.float64)
+
+        names = np.full(len(display_sets), '', dtype=object)
+        paths: List[Optional[Path]] = [None] * len(display_sets)
+        for i, display_set in enumerate(display_sets):
+            try:
+                names[i] = gc.image(str(display_set))
+                paths[i] = mha[names[i]]
+            except Exception as e:
+                for row in np.nonzero(rows['display_set'] == i)[0]:
+                    error(row, f'{type(e).__name__}({e})')
+
+        return AnswerTable(display_sets, names, paths, readers, rows, errors)
+
+    def save(self, path: Path):
+        """write the table to a .npz file, see load"""
+        np.savez(path, display_sets=np.asarray(self.display_sets, dtype=str), names=np.asarray(self.names, dtype=str),
+                 mha=np.array([str(m) if m else '' for m in self.mha], dtype=str),
+                 readers=np.asarray(self.readers, dtype=str), rows=self.rows, errors=np.array(self.errors, dtype=str))
+
+    @staticmethod
+    def load(path: Path) -> 'AnswerTable':
+        """read a table written by save, e.g. by the coordinator of a distributed stage"""
+        with np.load(path) as data:
+            return AnswerTable(data['display_sets'], data['names'].astype(object),
+                               [Path(m) if m else None for m in data['mha']], data['readers'], data['rows'],
+                               data['errors'].tolist())
+
+    def mha_exists(self) -> np.ndarray:
+        """per display set, stats each file once"""
+        return np.array([m is not None and m.exists() for m in self.mha], dtype=bool)
+
+    def valid(self) -> np.ndarray:
+        """boolean mask of rows with an existing mha and all three (nonzero) points"""
+        points = self.rows['points']
+        return self.mha_exists()[self.rows['display_set']] & \
+            ~self.rows['no_needle'] & \
+            (self.rows['error'] < 0) & \
+            np.isfinite(points).all(axis=(1, 2)) & \
+            (points != 0).any(axis=2).all(axis=1)
+
+    def reasons(self) -> np.ndarray:
+        """reason per row why it is not valid, '' for valid rows"""
+        reasons = np.full(len(self.rows), '', dtype=object)
+        points = self.rows['points']
+        exists = self.mha_exists()[self.rows['display_set']]
+        for mask, reason in [
+            (~((points != 0).any(axis=2).all(axis=1)), 'zero point'),
+            (~np.isfinite(points).all(axis=(1, 2)), 'missing point'),
+            (self.rows['no_needle'], 'no needle'),
+            (~exists, 'missing mha'),
+        ]:
+            reasons[mask] = reason
+        for row in np.nonzero(self.rows['error'] >= 0)[0]:
+            reasons[row] = self.errors[self.rows['error'][row]]
+        return reasons
+
+    def consensus(self) -> np.ndarray:
+        """
+        Per display set consensus of all valid readers
+
+        :return: structured array with fields display_set, readers, points (median point of valid readers) and
+                 agreement (largest distance in mm of any reader point to its median), sorted by display set
+        """
+        rows = self.rows[self.valid()]
+        display_sets, counts = np.unique(rows['display_set'], return_counts=True)
+        order = np.argsort(rows['display_set'], kind='stable')
+        rows = rows[order]
+
+        # pad readers into a (display set, reader, point, xyz) array
+        padded = np.full((len(display_sets), max(counts, default=0), 3, 3), np.nan)
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        group = np.repeat(np.arange(len(display_sets)), counts)
+        padded[group, within] = rows['points']
+
+        median = np.nanmedian(padded, axis=1) if len(display_sets) else np.zeros((0, 3, 3))
+        distance = np.linalg.norm(padded - median[:, None], axis=3)
+        agreement = np.nanmax(distance, axis=(1, 2)) if len(display_sets) else np.zeros(0)
+
+        result = np.zeros(len(display_sets), dtype=[('display_set', np.int32), ('readers', np.int32),
+                                                     ('points', np.float64, (3, 3)), ('agreement', np.float64)])
+        result['display_set'] = display_sets
+        result['readers'] = counts
+        result['points'] = median
+        result['agreement'] = agreement
+        return result
+
+    def cases(self) -> Iterator[Case]:
+        """valid cases, one per display set using the consensus of its readers"""
+        for c in self.consensus():
+            base, needle, tip = c['points']
+            ds = c['display_set']
+            yield Case(self.names[ds], self.mha[ds], base, needle, tip, int(c['readers']), float(c['agreement']))
+
+    def log(self) -> List[str]:
+        """one line per invalid row"""
+        reasons = self.reasons()
+        return [f'{self.names[r["display_set"]] or self.display_sets[r["display_set"]]} '
+                f'({self.readers[r["reader"]]}): {reason}'
+                for r, reason in zip(self.rows, reasons) if reason]
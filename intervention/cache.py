@@ -0,0 +1,181 @@
+import hashlib, json, os, shutil, threading
+from pathlib import Path
+from typing import Callable, Dict, TypeVar
+
+import numpy as np, SimpleITK as sitk
+
+VOLUME_MHD = 'volume.mhd'
+VOLUME_RAW = 'volume.raw'
+HEADER_JSON = 'header.json'
+
+T = TypeVar('T')
+
+_caches: Dict[Path, 'VolumeCache'] = {}
+_caches_lock = threading.Lock()
+
+
+def read_header(reader: sitk.ImageFileReader) -> dict:
+    """geometry of an image whose information has been read, in json serializable form"""
+    size = reader.GetSize()
+    dtype = sitk.GetArrayViewFromImage(sitk.Image([1] * len(size), reader.GetPixelID(),
+                                                  reader.GetNumberOfComponents())).dtype
+    return {
+        'size': list(size),
+        'spacing': list(reader.GetSpacing()),
+        'origin': list(reader.GetOrigin()),
+        'direction': list(reader.GetDirection()),
+        'components': reader.GetNumberOfComponents(),
+        'dtype': dtype.str,
+        'pixel_id': reader.GetPixelIDValue(),
+        'metadata': {k: reader.GetMetaData(k) for k in reader.GetMetaDataKeys()}
+    }
+
+
+def image_header(path: Path, cache: 'VolumeCache' = None) -> dict:
+    """geometry of an image from its file header only, or through cache"""
+    if cache:
+        return cache.header(path)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return read_header(reader)
+
+
+class VolumeCache:
+    def __init__(self, root: Path, budget: float = 50e9):
+        """
+        Read-through cache of decompressed volumes. Each source volume is stored once as an uncompressed
+        .mhd/.raw pair plus a header.json, keyed by its path and mtime, and evicted least recently used first.
+
+        :param root: cache directory
+        :param budget: maximum size of the cache in bytes
+        """
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self._headers: Dict[str, dict] = {}
+        # entries being opened by this process, never evicted
+        self._in_use: Dict[Path, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get(root: Path, budget: float = 50e9) -> 'VolumeCache':
+        """shared cache instance per root directory"""
+        root = Path(root).absolute()
+        with _caches_lock:
+            if root not in _caches:
+                _caches[root] = VolumeCache(root, budget)
+            _caches[root].budget = budget
+            return _caches[root]
+
+    def _key(self, path: Path) -> str:
+        path = Path(path).absolute()
+        stat = path.stat()
+        return hashlib.sha1(f'{path.as_posix()}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+
+    def header(self, path: Path) -> dict:
+        """geometry of path, read from the cache or from the file header only (no pixel data is read)"""
+        key = self._key(path)
+        if key in self._headers:
+            return self._headers[key]
+        entry = self.root / key / HEADER_JSON
+        if entry.exists():
+            with open(entry) as f:
+                h = json.load(f)
+        else:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(str(path))
+            reader.ReadImageInformation()
+            h = read_header(reader)
+        with self._lock:
+            self._headers[key] = h
+        return h
+
+    def _create(self, path: Path, key: str) -> Path:
+        entry = self.root / key
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(path))
+        image = reader.Execute()
+
+        # write next to the final entry, then rename, such that concurrent readers never see partial entries
+        tmp = self.root / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+        tmp.mkdir(exist_ok=True)
+        sitk.WriteImage(image, str(tmp / VOLUME_MHD), useCompression=False)
+        h = read_header(reader)
+        h['source'] = Path(path).absolute().as_posix()
+        with open(tmp / HEADER_JSON, 'w') as f:
+            json.dump(h, f)
+        try:
+            tmp.rename(entry)
+        except OSError:
+            # another process finished first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+        return entry
+
+    def _open(self, path: Path, opener: Callable[[Path], T], attempts: int = 3) -> T:
+        """
+        opener(entry) of the cache entry of path, created if missing. Entries in use by this process are not evicted,
+        an entry that another process evicts between its lookup and opener is created again.
+        """
+        key = self._key(path)
+        entry = self.root / key
+        with self._lock:
+            self._in_use[entry] = self._in_use.get(entry, 0) + 1
+        try:
+            for attempt in range(attempts):
+                try:
+                    if not (entry / HEADER_JSON).exists():
+                        self._create(path, key)
+                    os.utime(entry / VOLUME_RAW)
+                    # open files and memory maps stay valid when their entry is evicted afterwards
+                    return opener(entry)
+                except FileNotFoundError:
+                    if attempt == attempts - 1:
+                        raise
+        finally:
+            with self._lock:
+                self._in_use[entry] -= 1
+                if not self._in_use[entry]:
+                    del self._in_use[entry]
+
+    def _memmap(self, path: Path, entry: Path) -> np.memmap:
+        h = self.header(path)
+        shape = tuple(reversed(h['size'])) + ((h['components'],) if h['components'] > 1 else ())
+        return np.memmap(entry / VOLUME_RAW, dtype=np.dtype(h['dtype']), mode='r', shape=shape)
+
+    def read(self, path: Path) -> sitk.Image:
+        """
+        path as SimpleITK image. SimpleITK images own their pixel buffer, so the pixels are copied once from the memory
+        mapped cache entry, without parsing or decompressing; use array for zero-copy access.
+        """
+        h = self.header(path)
+        image = sitk.GetImageFromArray(self._open(path, lambda entry: self._memmap(path, entry)),
+                                       isVector=h['components'] > 1)
+        image.SetSpacing(h['spacing'])
+        image.SetOrigin(h['origin'])
+        image.SetDirection(h['direction'])
+        [image.SetMetaData(k, v) for k, v in h['metadata'].items()]
+        return image
+
+    def array(self, path: Path) -> np.memmap:
+        """zero-copy, read-only (z, y, x[, c]) view of path"""
+        return self._open(path, lambda entry: self._memmap(path, entry))
+
+    def evict(self):
+        """remove least recently used entries, except those in use by this process, until the cache fits its budget"""
+        with self._lock:
+            entries = []
+            for entry in self.root.iterdir():
+                raw = entry / VOLUME_RAW
+                if entry.suffix != '.tmp' and raw.exists():
+                    stat = raw.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry))
+            total = sum(e[1] for e in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.budget:
+                    break
+                if entry in self._in_use:
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
@@ -0,0 +1,59 @@
+import hashlib
+from typing import List, Optional, Tuple
+
+import numpy as np, SimpleITK as sitk
+
+
+def needle_bounds(label: np.ndarray, spacing: Tuple[float, float, float],
+                  margin: float) -> Optional[Tuple[List[int], List[int]]]:
+    """
+    Index bounding box of all labelled voxels, grown by a physical margin
+
+    :param label: (z, y, x) label array
+    :param spacing: (x, y, z) spacing in mm
+    :param margin: margin in mm
+    :return: (x, y, z) start and size, None if nothing is labelled
+    """
+    nonzero = np.argwhere(label)
+    if len(nonzero) == 0:
+        return None
+    margin = np.ceil(margin / np.array(spacing)).astype(int)
+    lower = np.maximum(nonzero.min(axis=0)[::-1] - margin, 0)
+    upper = np.minimum(nonzero.max(axis=0)[::-1] + 1 + margin, label.shape[::-1])
+    return lower.tolist(), (upper - lower).tolist()
+
+
+def random_bounds(size_mm: np.ndarray, image_size: Tuple[int, ...], spacing: Tuple[float, float, float],
+                  seed: str) -> Tuple[List[int], List[int]]:
+    """
+    Deterministic pseudo-random crop of a physical size, seeded by a string (e.g. the case name)
+
+    :param size_mm: (x, y, z) crop size in mm
+    :return: (x, y, z) start and size
+    """
+    rng = np.random.default_rng(int(hashlib.sha1(seed.encode()).hexdigest()[:8], 16))
+    size = np.minimum(np.maximum(np.rint(size_mm / np.array(spacing)).astype(int), 1), image_size)
+    start = [int(rng.integers(0, s - c + 1)) for s, c in zip(image_size, size)]
+    return start, size.tolist()
+
+
+def crop(image: sitk.Image, start: List[int], size: List[int]) -> sitk.Image:
+    """crop in index space, keeping the physical geometry"""
+    return sitk.RegionOfInterest(image, size=[int(s) for s in size], index=[int(s) for s in start])
+
+
+def paste_back(prediction: sitk.Image, start: List[int], size: List[int], source: sitk.Image) -> sitk.Image:
+    """
+    Nearest neighbour resample a prediction of a cropped case back onto its crop region, then paste it into an
+    empty label with the geometry of the source image
+
+    :param start: (x, y, z) crop start, as recorded in crops.json
+    :param size: (x, y, z) crop size, as recorded in crops.json
+    :param source: the uncropped image (or any image with its geometry)
+    """
+    region = crop(source, start, size)
+    region = sitk.Resample(prediction, region, sitk.Transform(), sitk.sitkNearestNeighbor, 0,
+                           prediction.GetPixelID())
+    label = sitk.Image(source.GetSize(), prediction.GetPixelID())
+    label.CopyInformation(source)
+    return sitk.Paste(label, region, region.GetSize(), destinationIndex=[int(s) for s in start])
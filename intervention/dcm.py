@@ -1,10 +1,67 @@
-import json, concurrent.futures
+import json, collections, concurrent.futures, hashlib, os
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import click
 from tqdm import tqdm
 
-from intervention.utils import CommandDCM, walk_archive
+from intervention.utils import CommandDCM, walk_archive, write_jsonl_archive
+from intervention.metrics import work_item
+
+
+DUPLICATES_JSON = 'dcm_duplicates.json'
+
+
+def series_fingerprint(series_dir: Path) -> str:
+    """sha1 of the sorted SOPInstanceUIDs of all .dcm files in series_dir, or of their contents if a UID is missing"""
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.LoadPrivateTagsOff()
+    uids = []
+    for file in sorted(f for f in os.listdir(series_dir) if f.endswith('.dcm')):
+        reader.SetFileName(str(series_dir / file))
+        try:
+            reader.ReadImageInformation()
+            uids.append(reader.GetMetaData('0008|0018').strip())
+        except RuntimeError:
+            with open(series_dir / file, 'rb') as f:
+                uids.append(hashlib.sha1(f.read()).hexdigest())
+    return hashlib.sha1('\\'.join(sorted(uids)).encode()).hexdigest()
+
+
+def deduplicate(archive: Iterable[dict], merged: Dict[str, List[str]], in_flight: int = None) -> Iterator[dict]:
+    """
+    Collapse series with identical fingerprints, e.g. re-exported or copied series
+
+    :param archive: archive items, fingerprinted in a thread pool
+    :param merged: receives, per kept path, the merged duplicate paths
+    :param in_flight: most items taken from archive ahead of the yielded ones, defaults to 4 per cpu
+    :return: unique archive items, the first of each fingerprint is kept
+    """
+    def fingerprint(item: dict) -> Tuple[dict, str]:
+        with work_item(item['path']):
+            return item, series_fingerprint(Path(item['path']))
+
+    def fingerprints() -> Iterator[Tuple[dict, str]]:
+        # in order, with a bounded number of series in flight such that the archive is consumed lazily
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            pending = collections.deque()
+            for item in archive:
+                pending.append(executor.submit(fingerprint, item))
+                if len(pending) >= (in_flight or 4 * (os.cpu_count() or 1)):
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    kept = {}
+    for item, fp in fingerprints():
+        if fp in kept:
+            merged.setdefault(kept[fp], []).append(item['path'])
+        else:
+            kept[fp] = item['path']
+            yield item
 
 
 def generate_dcm2mha_json(cmd: CommandDCM):
@@ -18,20 +75,32 @@ def generate_dcm2mha_json(cmd: CommandDCM):
         }
 
     def walk_dcm_archive(in_dir: Path) -> set:
-        return walk_archive(in_dir, endswith='.dcm', add_func=walk_dcm_archive_add_func)
+        with work_item(in_dir.name):
+            return walk_archive(in_dir, endswith='.dcm', add_func=walk_dcm_archive_add_func)
 
     click.echo(f"Gathering DICOMs from {cmd.archive_dir} and its subdirectories")
     dirs = [d.absolute() for d in cmd.archive_dir.iterdir()]
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        archives = list(tqdm(executor.map(walk_dcm_archive, dirs), total=len(dirs)))
+    def walk() -> Iterator[dict]:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for a in tqdm(executor.map(walk_dcm_archive, dirs), total=len(dirs)):
+                yield from sorted((item.to_dict() for item in a), key=lambda item: item['path'])
 
-    archive = set()
-    for a in archives:
-        archive.update(a)
+    archive, merged = walk(), {}
+    if cmd.deduplicate:
+        archive = deduplicate(archive, merged)
 
     cmd.out_dir.mkdir(exist_ok=True)
-    with open(dcm2mha_settings, 'w') as f:
-        json.dump({"options": {'allow_duplicates': True},
-                   "mappings": cmd.mappings,
-                   "archive": list([a.to_dict() for a in archive])}, f, indent=4)
\ No newline at end of file
+    header = {"options": {'allow_duplicates': True},
+              "mappings": cmd.mappings}
+    if cmd.archive_format == 'jsonl':
+        n = write_jsonl_archive(dcm2mha_settings.with_suffix('.jsonl'), header, archive)
+        click.echo(f"Streamed {n} series to {dcm2mha_settings.with_suffix('.jsonl')}")
+    else:
+        with open(dcm2mha_settings, 'w') as f:
+            json.dump(dict(header, archive=list(archive)), f, indent=4)
+
+    if cmd.deduplicate:
+        click.echo(f"Merged {sum(len(m) for m in merged.values())} duplicate series")
+        with open(cmd.out_dir / DUPLICATES_JSON, 'w') as f:
+            json.dump(merged, f, indent=4)
@@ -1,11 +1,52 @@
+import json, shutil
+from pathlib import Path
+
 import picai_prep
 
-from intervention.utils import CommandDCM2MHA
+from intervention.utils import CommandDCM2MHA, jsonl2json, read_archive
+from intervention.workqueue import distribute, merge_shards, shard_dir, shard_of, SHARDS_DIR
+
+
+def _settings_json(cmd: CommandDCM2MHA) -> Path:
+    dcm2mha_settings = cmd.json_dir / 'dcm2mha_settings.json'
+    jsonl = dcm2mha_settings.with_suffix('.jsonl')
+    # picai_prep reads json settings only, regenerated whenever the jsonl settings changed
+    if jsonl.exists() and (not dcm2mha_settings.exists() or
+                           jsonl.stat().st_mtime >= dcm2mha_settings.stat().st_mtime):
+        jsonl2json(jsonl, dcm2mha_settings)
+    return dcm2mha_settings
+
+
+def dcm2mha_shard(cmd: CommandDCM2MHA, shard: int, shards: int) -> dict:
+    """convert the series of one shard of the dcm2mha settings, to the shard directory of cmd.out_dir"""
+    settings, archive = read_archive(_settings_json(cmd))
+    archive = [item for item in archive if shard_of(item['path'], shards) == shard]
+
+    out_dir = shard_dir(cmd.out_dir, shard)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with open(out_dir / 'dcm2mha_settings.json', 'w') as f:
+        json.dump(dict(settings, archive=archive), f)
+
+    if archive:
+        picai_prep.Dicom2MHAConverter(
+            input_dir=cmd.archive_dir.as_posix(),
+            output_dir=(out_dir / 'mha').as_posix(),
+            dcm2mha_settings=(out_dir / 'dcm2mha_settings.json').as_posix(),
+        ).convert()
+    return {'series': len(archive)}
 
 
 def dcm2mha(cmd: CommandDCM2MHA):
+    dcm2mha_settings = _settings_json(cmd)
+
+    if cmd.queue_dir:
+        distribute(cmd)
+        merge_shards([shard_dir(cmd.out_dir, i) / 'mha' for i in range(cmd.shards)], cmd.out_dir)
+        shutil.rmtree(cmd.out_dir / SHARDS_DIR)
+        return
+
     picai_prep.Dicom2MHAConverter(
         input_dir=cmd.archive_dir.as_posix(),
         output_dir=cmd.out_dir.as_posix(),
-        dcm2mha_settings=(cmd.json_dir / 'dcm2mha_settings.json').as_posix(),
-    ).convert()
\ No newline at end of file
+        dcm2mha_settings=dcm2mha_settings.as_posix(),
+    ).convert()
@@ -0,0 +1,444 @@
+import json, logging, multiprocessing, os, shutil, tempfile, time, traceback
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import click, numpy as np, SimpleITK as sitk
+
+from intervention.utils import CommandExport
+from intervention.inference import case_files
+from intervention.tips import localize
+
+PRECISIONS = ['torch', 'fp32', 'fp16', 'int8']
+PLANS = 'nnUNetPlansv2.1'
+CHECKPOINT = 'model_final_checkpoint'
+EXPORT_JSON = 'export.json'
+REPORT_JSON = 'export_report.json'
+# of a test case: a needle in both the prediction and the label, only in the label, only in the prediction, in neither
+TIP_OUTCOMES = ['found', 'missed', 'false_positive', 'true_negative']
+
+
+def model_folder(results_dir: Path, task_dirname: str, trainer: str, network: str = '3d_fullres') -> Path:
+    """nnUNet (v1) trained model folder in RESULTS_FOLDER, as used by nnUNet_predict"""
+    return Path(results_dir) / 'nnUNet' / network / task_dirname / f'{trainer or "nnUNetTrainerV2"}__{PLANS}'
+
+
+def _folds(folder: Path, folds: List[int] = None) -> List[int]:
+    found = sorted(int(d.name.split('_')[1]) for d in folder.glob('fold_*') if d.is_dir())
+    return [f for f in found if f in folds] if folds else found
+
+
+def _trainer(folder: Path, folds: List[int], weights: bool = True):
+    """nnUNet trainer of folder and the checkpoint of each fold, or only the trainer (for its plans) if not weights"""
+    from nnunet.training.model_restore import load_model_and_checkpoint_files, restore_model
+
+    if weights:
+        return load_model_and_checkpoint_files(str(folder), folds, mixed_precision=False, checkpoint_name=CHECKPOINT)
+    trainer = restore_model(str(folder / f'fold_{folds[0]}' / f'{CHECKPOINT}.model.pkl'), checkpoint=None,
+                            train=False)
+    # as load_model_and_checkpoint_files, the output folder of training may not exist here
+    trainer.output_folder = trainer.output_folder_base = str(folder)
+    trainer.update_fold(folds[0])
+    trainer.initialize(False)
+    return trainer, []
+
+
+def _onnx_network(session, num_classes: int):
+    """SegmentationNetwork running an onnxruntime session, such that nnUNet's sliding window inference uses it"""
+    import torch
+    from nnunet.network_architecture.neural_network import SegmentationNetwork
+    from nnunet.utilities.nd_softmax import softmax_helper
+
+    class OnnxNetwork(SegmentationNetwork):
+        def __init__(self):
+            super().__init__()
+            self.conv_op = torch.nn.Conv3d
+            self.num_classes = num_classes
+            self.inference_apply_nonlin = softmax_helper
+            self.do_ds = False
+            self._input = session.get_inputs()[0].name
+
+        def get_device(self):
+            return 'cpu'
+
+        def forward(self, x):
+            return torch.from_numpy(session.run(None, {self._input: x.cpu().numpy().astype(np.float32)})[0])
+
+    return OnnxNetwork()
+
+
+def _networks(model_dir: Path, meta: dict, results_dir: Path, folds: List[int], threads: int):
+    """nnUNet trainer (for its plans and sliding window inference) and the network of each fold"""
+    import torch
+
+    torch.set_num_threads(threads)
+    folder = model_folder(results_dir, meta['task'], meta['trainer'], meta['network'])
+    if meta['precision'] == 'torch':
+        trainer, params = _trainer(folder, folds)
+        networks = {}
+        for fold, p in zip(folds, params):
+            trainer.load_checkpoint_ram(p, False)
+            networks[fold] = CpuPredictor._copy(trainer.network)
+        return trainer, networks
+
+    import onnxruntime
+
+    trainer, _ = _trainer(folder, folds, weights=False)
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return trainer, {fold: _onnx_network(onnxruntime.InferenceSession(str(Path(model_dir) / f'fold_{fold}.onnx'),
+                                                                      options, providers=['CPUExecutionProvider']),
+                                         trainer.num_classes)
+                     for fold in folds}
+
+
+def _predict_fold(trainer, network, data: np.ndarray, mirroring: bool) -> np.ndarray:
+    trainer.network = network
+    return trainer.predict_preprocessed_data_return_seg_and_softmax(
+        data, do_mirroring=mirroring, mirror_axes=trainer.data_aug_params['mirror_axes'],
+        use_sliding_window=True, step_size=0.5, use_gaussian=True, all_in_gpu=False, mixed_precision=False)[1]
+
+
+# state of a fold worker process
+_worker = {}
+
+
+def _init_fold_worker(model_dir: Path, meta: dict, results_dir: Path, folds: List[int], threads: int, lock):
+    _worker['trainer'], _worker['networks'] = _networks(model_dir, meta, results_dir, folds, threads)
+    _worker['lock'] = lock
+
+
+def _view(memory: SharedMemory, shape: Tuple[int, ...]) -> np.ndarray:
+    return np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+
+
+def _shared(func, memories: List[SharedMemory], *args):
+    """
+    func(*memories, *args), closing the shared memories after. Errors are logged with their traceback and re-raised
+    without it, as the traceback would keep the views of func on the memories alive and make closing them fail.
+    """
+    error = None
+    try:
+        return func(*memories, *args)
+    except Exception as e:
+        logging.error(f'{func.__name__} failed in process {os.getpid()}:\n{traceback.format_exc()}')
+        error = RuntimeError(f'{type(e).__name__}({e})')
+    finally:
+        for memory in memories:
+            memory.close()
+        if error:
+            raise error
+
+
+def _add_fold(data_memory: SharedMemory, sum_memory: SharedMemory, fold: int, data_shape: Tuple[int, ...],
+              sum_shape: Tuple[int, ...], mirroring: bool):
+    softmax = _predict_fold(_worker['trainer'], _worker['networks'][fold], _view(data_memory, data_shape), mirroring)
+    with _worker['lock']:
+        total = _view(sum_memory, sum_shape)
+        total += softmax
+
+
+def _run_fold(fold: int, data_name: str, data_shape: Tuple[int, ...], sum_name: str, sum_shape: Tuple[int, ...],
+              mirroring: bool):
+    """in a fold worker: predict the shared case with one fold and add its softmax to the shared sum"""
+    _shared(_add_fold, [SharedMemory(data_name), SharedMemory(sum_name)], fold, data_shape, sum_shape, mirroring)
+
+
+class CpuPredictor:
+    def __init__(self, model_dir: Path, results_dir: Path, threads: int = None, folds: List[int] = None,
+                 fold_workers: int = 0):
+        """
+        nnUNet prediction on CPU with exported networks: nnUNet preprocesses, predicts with a sliding window and
+        resamples as nnUNet_predict does, but each fold's network is an onnxruntime session (or, for the 'torch'
+        precision, the trained network on CPU). The softmax of the folds is averaged.
+
+        Each case is preprocessed once. With more than one fold worker, the folds are spread over worker processes
+        that each load their folds once, read the preprocessed case from shared memory and add their softmax to a
+        shared sum as they finish, such that folds run concurrently and only one softmax is kept per case.
+
+        :param model_dir: a precision directory of export
+        :param results_dir: nnUNet RESULTS_FOLDER of the trained model, for its plans
+        :param threads: onnxruntime/torch threads in total, defaults to the cpu count
+        :param folds: folds to ensemble, by default all exported folds
+        :param fold_workers: processes running folds, 0 for one per fold (at most threads), 1 runs them in turn
+        in this process
+        """
+        model_dir = Path(model_dir)
+        with open(model_dir / EXPORT_JSON) as f:
+            self.meta = json.load(f)
+        self.folds = [f for f in self.meta['folds'] if not folds or f in folds]
+        if not self.folds:
+            raise ValueError(f'folds {folds} are not exported in {model_dir}')
+        threads = threads or os.cpu_count() or 1
+        workers = min(fold_workers or len(self.folds), len(self.folds), threads)
+
+        self._pools: List[Tuple[List[int], ProcessPoolExecutor]] = []
+        if workers == 1:
+            self.trainer, self.networks = _networks(model_dir, self.meta, results_dir, self.folds, threads)
+            return
+
+        # this process preprocesses and exports, with the plans of the trainer only
+        folder = model_folder(results_dir, self.meta['task'], self.meta['trainer'], self.meta['network'])
+        self.trainer, _ = _trainer(folder, self.folds, weights=False)
+        self.networks = {}
+        # spawn, torch and onnxruntime thread pools do not survive a fork
+        context = multiprocessing.get_context('spawn')
+        lock = context.Lock()
+        for group in [self.folds[i::workers] for i in range(workers)]:
+            pool = ProcessPoolExecutor(1, mp_context=context, initializer=_init_fold_worker,
+                                       initargs=(model_dir, self.meta, results_dir, group, threads // workers, lock))
+            self._pools.append((group, pool))
+
+    def close(self):
+        for _, pool in self._pools:
+            pool.shutdown()
+        self._pools = []
+
+    def __enter__(self) -> 'CpuPredictor':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _copy(network):
+        import copy
+        network = copy.deepcopy(network).cpu().float()
+        network.do_ds = False
+        return network.eval()
+
+    def ensemble(self, data: np.ndarray, mirroring: bool = True) -> np.ndarray:
+        """mean softmax of the folds of a preprocessed case"""
+        if not self._pools:
+            softmax = None
+            for network in self.networks.values():
+                s = _predict_fold(self.trainer, network, data, mirroring)
+                softmax = s.astype(np.float32) if softmax is None else np.add(softmax, s, out=softmax,
+                                                                              casting='unsafe')
+            return softmax / len(self.networks)
+
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        sum_shape = (self.trainer.num_classes,) + data.shape[1:]
+        memories = [SharedMemory(create=True, size=data.nbytes),
+                    SharedMemory(create=True, size=int(np.prod(sum_shape)) * 4)]
+        try:
+            return _shared(self._ensemble_shared, memories, data, sum_shape, mirroring)
+        finally:
+            for memory in memories:
+                memory.unlink()
+
+    def _ensemble_shared(self, data_memory: SharedMemory, sum_memory: SharedMemory, data: np.ndarray,
+                         sum_shape: Tuple[int, ...], mirroring: bool) -> np.ndarray:
+        _view(data_memory, data.shape)[:] = data
+        total = _view(sum_memory, sum_shape)
+        total[:] = 0
+        futures = [pool.submit(_run_fold, fold, data_memory.name, data.shape, sum_memory.name, sum_shape, mirroring)
+                   for group, pool in self._pools for fold in group]
+        for future in futures:
+            future.result()
+        return total / len(self.folds)
+
+    def predict(self, files: List[Path], output: Path, save_npz: bool = True, mirroring: bool = True):
+        """
+        Predict one case
+
+        :param files: modality files of the case (case_0000.nii.gz, ...)
+        :param output: segmentation .nii.gz, the softmax is saved next to it as .npz if save_npz
+        """
+        from nnunet.inference.segmentation_export import save_segmentation_nifti_from_softmax
+
+        trainer = self.trainer
+        data, _, properties = trainer.preprocess_patient([str(f) for f in files])
+        softmax = self.ensemble(data, mirroring)
+        softmax = softmax.transpose([0] + [i + 1 for i in trainer.plans['transpose_backward']])
+
+        export = trainer.plans.get('segmentation_export_params', {})
+        npz = str(output)[:-len('.nii.gz')] + '.npz' if save_npz else None
+        save_segmentation_nifti_from_softmax(softmax, str(output), properties,
+                                             export.get('interpolation_order', 1), None, None, None, npz, None,
+                                             export.get('force_separate_z'), export.get('interpolation_order_z', 0))
+
+    def predict_dir(self, in_dir: Path, out_dir: Path, save_npz: bool = True) -> Dict[str, float]:
+        """predict all cases of an nnUNet images directory, :return: seconds per case"""
+        out_dir.mkdir(parents=True, exist_ok=True)
+        seconds = {}
+        for case, files in sorted(case_files(in_dir).items()):
+            start = time.perf_counter()
+            self.predict(files, out_dir / f'{case}.nii.gz', save_npz)
+            seconds[case] = time.perf_counter() - start
+        return seconds
+
+
+def export_network(network, input_shape: Tuple[int, ...], path: Path):
+    """
+    Export a torch network to fp32 ONNX, with a dynamic batch size
+
+    :param input_shape: channels and patch size of the input
+    """
+    import torch
+
+    dummy = torch.zeros((1, *input_shape), dtype=torch.float32)
+    with torch.no_grad():
+        torch.onnx.export(network, dummy, str(path), input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=13)
+
+
+def _calibration_data(trainer, images_dir: Path, cases: int, input_name: str):
+    """patch sized crops around the centre of preprocessed training cases, to calibrate int8 activations"""
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self._cases = iter(sorted(case_files(images_dir).items())[:cases])
+
+        def get_next(self) -> Optional[dict]:
+            case = next(self._cases, None)
+            if case is None:
+                return None
+            data = trainer.preprocess_patient([str(f) for f in case[1]])[0]
+            patch = np.zeros((1, data.shape[0], *trainer.patch_size), dtype=np.float32)
+            start = [max(0, (s - p) // 2) for s, p in zip(data.shape[1:], trainer.patch_size)]
+            crop = data[(slice(None),) + tuple(slice(s, s + p) for s, p in zip(start, trainer.patch_size))]
+            patch[(0, slice(None)) + tuple(slice(0, s) for s in crop.shape[1:])] = crop
+            return {input_name: patch}
+
+    return Reader()
+
+
+def export_onnx(cmd: CommandExport) -> Dict[str, Path]:
+    """
+    Export the network of each fold to ONNX per precision: fp32, fp16 (weights and activations, fp32 inputs and
+    outputs) and int8 (static QDQ quantization, per channel weights, activations calibrated on imagesTr).
+
+    :return: precision directory per precision
+    """
+    folder = model_folder(cmd.model_dir, cmd.task_dirname, cmd.trainer, cmd.network)
+    folds = _folds(folder, cmd.folds)
+    if not folds:
+        raise FileNotFoundError(f'no trained folds in {folder}')
+    trainer, params = _trainer(folder, folds)
+    meta = {'task': cmd.task_dirname, 'trainer': cmd.trainer, 'network': cmd.network, 'folds': folds,
+            'patch_size': [int(p) for p in trainer.patch_size], 'num_classes': trainer.num_classes,
+            'num_input_channels': trainer.num_input_channels}
+
+    dirs = {}
+    for precision in cmd.precisions:
+        dirs[precision] = cmd.out_dir / precision
+        dirs[precision].mkdir(parents=True, exist_ok=True)
+        with open(dirs[precision] / EXPORT_JSON, 'w') as f:
+            json.dump(dict(meta, precision=precision), f, indent=4)
+
+    onnx = [p for p in cmd.precisions if p != 'torch']
+    if not onnx:
+        return dirs
+    for fold, p in zip(folds, params):
+        trainer.load_checkpoint_ram(p, False)
+        network = CpuPredictor._copy(trainer.network)
+        fp32 = cmd.out_dir / 'fp32' / f'fold_{fold}.onnx'
+        fp32.parent.mkdir(parents=True, exist_ok=True)
+        export_network(network, (trainer.num_input_channels, *trainer.patch_size), fp32)
+        click.echo(f'Exported fold {fold} to {fp32}')
+
+        if 'fp16' in onnx:
+            import onnx as onnx_lib
+            from onnxruntime.transformers.float16 import convert_float_to_float16
+
+            model = convert_float_to_float16(onnx_lib.load(str(fp32)), keep_io_types=True)
+            onnx_lib.save(model, str(dirs['fp16'] / fp32.name))
+        if 'int8' in onnx:
+            from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+            reader = _calibration_data(trainer, cmd.in_dir / 'imagesTr', cmd.calibration, 'input')
+            quantize_static(str(fp32), str(dirs['int8'] / fp32.name), reader, quant_format=QuantFormat.QDQ,
+                            per_channel=True, weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+
+    if 'fp32' not in cmd.precisions:
+        shutil.rmtree(cmd.out_dir / 'fp32')
+    return dirs
+
+
+def _scores(prediction: Path, label: Path, classes: int) -> dict:
+    """
+    dice per label, the tip outcome (TIP_OUTCOMES) and the distance between the tips if both have a needle, else None
+    """
+    p, l = sitk.ReadImage(str(prediction)), sitk.ReadImage(str(label))
+    pa, la = sitk.GetArrayViewFromImage(p), sitk.GetArrayViewFromImage(l)
+    dice = {}
+    for c in range(1, classes):
+        total = np.count_nonzero(pa == c) + np.count_nonzero(la == c)
+        dice[c] = 2 * np.count_nonzero((pa == c) & (la == c)) / total if total else 1.0
+    predicted, labelled = localize(p), localize(l)
+    if predicted and labelled:
+        return {'dice': dice, 'tip': 'found', 'tip_mm': float(np.linalg.norm(predicted.tip - labelled.tip))}
+    return {'dice': dice, 'tip': 'missed' if labelled else 'false_positive' if predicted else 'true_negative',
+            'tip_mm': None}
+
+
+def compare(cmd: CommandExport, dirs: Dict[str, Path]) -> List[dict]:
+    """
+    accuracy (dice per label, tip distance, tip outcomes) and latency of each precision on imagesTs/labelsTs.
+    The tip distances are of the found tips, None without any.
+    """
+    report = []
+    for precision, model_dir in dirs.items():
+        with CpuPredictor(model_dir, cmd.model_dir, cmd.workers) as predictor, \
+                tempfile.TemporaryDirectory() as tmp:
+            seconds = predictor.predict_dir(cmd.in_dir / 'imagesTs', Path(tmp), save_npz=False)
+            scores = [_scores(Path(tmp) / f'{case}.nii.gz', cmd.in_dir / 'labelsTs' / f'{case}.nii.gz',
+                              predictor.meta['num_classes']) for case in seconds]
+        tips = np.array([s['tip_mm'] for s in scores if s['tip'] == 'found'])
+        report.append({
+            'precision': precision,
+            'cases': len(seconds),
+            'mb': sum(f.stat().st_size for f in model_dir.glob('*.onnx')) / 1e6,
+            'seconds_per_case': float(np.mean(list(seconds.values()))) if seconds else 0.0,
+            'dice': {c: float(np.mean([s['dice'][c] for s in scores])) for c in (scores[0]['dice'] if scores else {})},
+            'tip_mm_median': float(np.median(tips)) if len(tips) else None,
+            'tip_mm_p90': float(np.percentile(tips, 90)) if len(tips) else None,
+            **{f'tip_{outcome}': sum(s['tip'] == outcome for s in scores) for outcome in TIP_OUTCOMES[1:]}
+        })
+    return report
+
+
+def recommend(report: List[dict], tip_tolerance: float) -> Tuple[dict, dict]:
+    """
+    The baseline of a compare report, torch or else the most precise export, and the fastest precision that misses
+    no more tips and has no more false positive tips than the baseline, with a median tip error within tip_tolerance
+    mm of the baseline's
+
+    :return: the report entries of the baseline and of the recommended precision
+    """
+    baseline = min(report, key=lambda r: PRECISIONS.index(r['precision']))
+
+    def accurate(r: dict) -> bool:
+        if r['tip_missed'] > baseline['tip_missed'] or r['tip_false_positive'] > baseline['tip_false_positive']:
+            return False
+        if baseline['tip_mm_median'] is None:
+            return True
+        return r['tip_mm_median'] is not None and r['tip_mm_median'] <= baseline['tip_mm_median'] + tip_tolerance
+
+    return baseline, min([r for r in report if accurate(r)] or [baseline], key=lambda r: r['seconds_per_case'])
+
+
+def export(cmd: CommandExport):
+    click.echo(f'\nExporting {cmd.task_dirname} ({cmd.trainer}) from\n\t{cmd.model_dir}\nto\n\t{cmd.out_dir}\n'
+               f'as {", ".join(cmd.precisions)}')
+    dirs = export_onnx(cmd)
+    report = compare(cmd, dirs)
+    with open(cmd.out_dir / REPORT_JSON, 'w') as f:
+        json.dump(report, f, indent=4, allow_nan=False)
+
+    lines = [f'{"precision":<10}{"MB":>8}{"s/case":>9}{"dice":>14}{"tip mm":>9}{"p90":>8}{"missed":>8}{"false":>7}']
+    for r in report:
+        dice = '/'.join(f'{d:.2f}' for d in r['dice'].values())
+        median, p90 = ['-' if r[k] is None else f'{r[k]:.2f}' for k in ['tip_mm_median', 'tip_mm_p90']]
+        lines.append(f'{r["precision"]:<10}{r["mb"]:>8.1f}{r["seconds_per_case"]:>9.2f}{dice:>14}'
+                     f'{median:>9}{p90:>8}{r["tip_missed"]:>8}{r["tip_false_positive"]:>7}')
+
+    baseline, choice = recommend(report, cmd.tip_tolerance)
+    lines.append(f'fastest within {cmd.tip_tolerance} mm tip accuracy of {baseline["precision"]}: '
+                 f'{choice["precision"]} (cpu_model: {dirs[choice["precision"]]})')
+    click.echo('\n'.join(lines))
+    logging.info('\n'.join(lines))
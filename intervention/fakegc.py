@@ -0,0 +1,183 @@
+import hashlib, json, random, re, threading, uuid
+from pathlib import Path
+from typing import Dict, List
+
+import httpx, numpy as np
+
+HOST = 'http://fakegc'
+PREFIX = '/api/v1/'
+# counters of the fake, not a GC endpoint
+STATS = '/fake/stats/'
+
+
+class FakeGC:
+    def __init__(self, slug: str = 'fake', host: str = HOST, fail_rate: float = 0, seed: int = 0,
+                 page_size: int = None, rate_limit: float = 0, retry_after: int = 0):
+        """
+        In-memory stand-in of the Grand Challenge REST API endpoints used by intervention.gcclient, for tests and
+        benchmarks. Use transport() as the httpx transport of AsyncGC(base_url=fake.base_url), or serve it over HTTP
+        with intervention.gcserver.
+
+        :param fail_rate: fraction of requests answered with 503, to exercise retries
+        :param page_size: maximum results per page, regardless of the requested limit
+        :param rate_limit: fraction of requests answered with 429
+        :param retry_after: Retry-After seconds of the 429 responses
+        """
+        self.host = host
+        self.fail_rate = fail_rate
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        # the user of the api key, answers/mine/ serves the answers it created
+        self.user = 'synthetic'
+        self.reader_study = {'pk': str(uuid.uuid4()), 'slug': slug, 'questions': [],
+                             'api_url': f'{self.base_url}reader-studies/{slug}/'}
+        self.answers: Dict[str, dict] = {}
+        self.display_sets: Dict[str, dict] = {}
+        self.images: Dict[str, dict] = {}
+        self.uploads: Dict[str, dict] = {}
+        # uploaded bytes per image pk
+        self.contents: Dict[str, bytes] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return self.host + PREFIX
+
+    @staticmethod
+    def from_answers(answers_json: Path, slug: str = 'fake', **kwargs) -> 'FakeGC':
+        """serve the questions, answers, display sets and images of intervention.synthetic.generate"""
+        with open(answers_json) as f:
+            return FakeGC.from_dict(json.load(f), slug, **kwargs)
+
+    @staticmethod
+    def synthetic(cases: int, slug: str = 'fake', no_needle: float = 0.2, seed: int = 0, readers: int = 2,
+                  **kwargs) -> 'FakeGC':
+        """a reader study of cases display sets with random answers of readers, without image files"""
+        from intervention.synthetic import gc_answers
+
+        rng = np.random.default_rng(seed)
+        names = [f'{10000 + i}_{i}_needle_0.mha' for i in range(cases)]
+        points = [list(rng.uniform(-150, 150, size=(3, 3))) for _ in range(cases)]
+        no_needles = [bool(r < no_needle) for r in rng.random(cases)]
+        return FakeGC.from_dict(gc_answers(names, points, no_needles, readers, seed=seed), slug, seed=seed,
+                                **kwargs)
+
+    @staticmethod
+    def from_dict(gc: dict, slug: str = 'fake', **kwargs) -> 'FakeGC':
+        fake = FakeGC(slug, **kwargs)
+        fake.reader_study['questions'] = list(gc['questions'].values())
+        for name, objects in [('answers', gc['answers']), ('display_sets', gc['display_sets']),
+                              ('images', gc['cases'])]:
+            getattr(fake, name).update({str(v['pk']): dict(v, pk=str(v['pk'])) for v in objects.values()})
+        return fake
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def _page(self, request: httpx.Request, results: List[dict]) -> httpx.Response:
+        limit = int(request.url.params.get('limit', 100))
+        limit = min(limit, self.page_size) if self.page_size else limit
+        offset = int(request.url.params.get('offset', 0))
+        page = results[offset:offset + limit]
+        following = None
+        if offset + limit < len(results):
+            following = str(request.url.copy_merge_params({'offset': offset + limit, 'limit': limit}))
+        return httpx.Response(200, json={'count': len(results), 'next': following, 'previous': None, 'results': page})
+
+    def _display_set(self, fields: dict) -> dict:
+        pk = str(uuid.uuid4())
+        ds = {'pk': pk, 'api_url': f'{self.base_url}reader-studies/display-sets/{pk}/', 'values': [],
+              'order': len(self.display_sets) + 1, **fields}
+        self.display_sets[pk] = ds
+        return ds
+
+    def _upload_session(self, fields: dict) -> dict:
+        ds = self.display_sets[fields['display_set']]
+        for url in fields['uploads']:
+            upload = next(u for u in self.uploads.values() if u['api_url'] == url)
+            pk = str(uuid.uuid4())
+            image = {'pk': pk, 'api_url': f'{self.base_url}cases/images/{pk}/', 'name': upload['filename']}
+            self.images[pk] = image
+            self.contents[pk] = upload['content']
+            ds['values'].append({'interface': {'slug': fields['interface']}, 'image': image['api_url']})
+        return {'pk': str(uuid.uuid4()), 'status': 'Queued'}
+
+    def stats(self) -> dict:
+        return {'requests': self.requests, 'failures': self.failures, 'rate_limited': self.rate_limited}
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            if request.url.path == STATS:
+                return httpx.Response(200, json=self.stats())
+            self.requests += 1
+            draw = self._rng.random()
+            if draw < self.fail_rate:
+                self.failures += 1
+                return httpx.Response(503, text='fake unavailable')
+            if draw < self.fail_rate + self.rate_limit:
+                self.rate_limited += 1
+                return httpx.Response(429, text='fake rate limit', headers={'Retry-After': str(self.retry_after)})
+            return self._route(request)
+
+    def _route(self, request: httpx.Request) -> httpx.Response:
+        method, path = request.method, request.url.path
+        body = json.loads(request.content) if request.content and method != 'PUT' else {}
+
+        if path.startswith('/s3/'):
+            _, _, pk, part = path.split('/')
+            self.uploads[pk]['parts'][int(part)] = request.content
+            return httpx.Response(200, headers={'ETag': hashlib.md5(request.content).hexdigest()})
+
+        path = path[len(PREFIX):]
+        if method == 'GET' and path == 'gcapi/':
+            # version check of gcapi clients
+            return httpx.Response(200, json={'latest_version': '0', 'lowest_supported_version': '0'})
+        if method == 'GET' and path == 'reader-studies/':
+            match = [self.reader_study] if request.url.params.get('slug') == self.reader_study['slug'] else []
+            return self._page(request, match)
+        for name, route in [('answers', 'reader-studies/answers/'),
+                            ('display_sets', 'reader-studies/display-sets/'), ('images', 'cases/images/')]:
+            if method == 'GET' and path == route:
+                return self._page(request, list(getattr(self, name).values()))
+        if method == 'GET' and path == 'reader-studies/answers/mine/':
+            return self._page(request, [a for a in self.answers.values() if a.get('creator') == self.user])
+
+        if method == 'POST' and path == 'reader-studies/display-sets/':
+            return httpx.Response(201, json=self._display_set(body))
+        if m := re.fullmatch(r'reader-studies/display-sets/([^/]+)/', path):
+            if m[1] not in self.display_sets:
+                return httpx.Response(404, text='not found')
+            if method == 'PATCH':
+                self.display_sets[m[1]].update(body)
+                return httpx.Response(200, json=self.display_sets[m[1]])
+            if method == 'DELETE':
+                del self.display_sets[m[1]]
+                return httpx.Response(204)
+
+        if method == 'POST' and path == 'uploads/':
+            pk = str(uuid.uuid4())
+            self.uploads[pk] = {'pk': pk, 's3_upload_id': uuid.uuid4().hex, 'filename': body['filename'],
+                                'api_url': f'{self.base_url}uploads/{pk}/', 'parts': {}, 'content': None}
+            upload = {k: v for k, v in self.uploads[pk].items() if k not in ('parts', 'content')}
+            return httpx.Response(201, json=upload)
+        if m := re.fullmatch(r'uploads/([^/]+)/([^/]+)/([a-z-]+)/', path):
+            upload = self.uploads[m[1]]
+            if m[3] == 'generate-presigned-urls':
+                return httpx.Response(200, json={'presigned_urls': {
+                    str(n): f'{self.host}/s3/{m[1]}/{n}' for n in body['part_numbers']}})
+            if m[3] == 'complete-multipart-upload':
+                upload['content'] = b''.join(upload['parts'][p['PartNumber']] for p in body['parts'])
+                return httpx.Response(200, json={'pk': m[1], 'status': 'Completed', 'api_url': upload['api_url']})
+            if m[3] == 'abort-multipart-upload':
+                del self.uploads[m[1]]
+                return httpx.Response(200, json={'pk': m[1], 'status': 'Aborted'})
+
+        if method == 'POST' and path == 'cases/upload-sessions/':
+            return httpx.Response(201, json=self._upload_session(body))
+
+        return httpx.Response(404, text=f'fake has no {method} {path}')
@@ -0,0 +1,199 @@
+import json
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np, SimpleITK as sitk
+from tqdm import tqdm
+
+from intervention.metrics import work_item
+from intervention.scheduler import Scheduler, image_bytes
+
+FINGERPRINT_JSON = 'fingerprint.json'
+# per case fingerprints, one file each such that shards and threads never write the same file
+FINGERPRINTS_DIR = 'fingerprints'
+# of nnU-Net's intensity normalization
+PERCENTILES = [0.5, 50, 99.5]
+# most bins of a histogram of non-integer values
+BINS = 1 << 12
+
+
+def histogram(values: np.ndarray) -> dict:
+    """
+    counts of the values in bins of width, from bin offset on, mergeable across cases with merge_histograms.
+    Integer values are counted exactly, in bins of 1. Other values in bins of a power of two width, at most BINS of
+    them over their range, represented by the centre of their bin.
+    """
+    integer = np.issubdtype(values.dtype, np.integer) or values.dtype == bool
+    values = values.ravel()
+    if values.size == 0:
+        return {'offset': 0, 'width': 1.0, 'centre': 0.0, 'counts': []}
+    width, centre = 1.0, 0.0
+    if not integer:
+        values = values.astype(np.float64)
+        span = float(values.max() - values.min())
+        width, centre = 2.0 ** np.ceil(np.log2(span / BINS)) if span > 0 else 1.0, 0.5
+    bins = np.floor(values / width).astype(np.int64) if not integer else values.astype(np.int64)
+    offset = int(bins.min())
+    return {'offset': offset, 'width': width, 'centre': centre, 'counts': np.bincount(bins - offset).tolist()}
+
+
+def _rebin(h: dict, width: float) -> Tuple[int, np.ndarray]:
+    """offset and counts of a histogram in bins of width, a power of two multiple of its own"""
+    counts, offset = np.array(h['counts'], dtype=np.int64), h['offset']
+    factor = int(round(width / h.get('width', 1.0)))
+    if factor == 1:
+        return offset, counts
+    bins = (np.arange(len(counts)) + offset) // factor
+    return int(bins[0]), np.bincount(bins - bins[0], weights=counts).astype(np.int64)
+
+
+def merge_histograms(histograms: Iterable[dict]) -> dict:
+    """
+    sum of histograms, in the bins of the widest. Integer and non-integer histograms are summed apart, as the parts
+    of the merged histogram, such that integer values stay exact.
+    """
+    histograms = [h for h in histograms if h['counts']]
+    if not histograms:
+        return {'offset': 0, 'width': 1.0, 'centre': 0.0, 'counts': []}
+    parts = []
+    for centre in sorted({h.get('centre', 0.0) for h in histograms}):
+        group = [h for h in histograms if h.get('centre', 0.0) == centre]
+        width = max(h.get('width', 1.0) for h in group)
+        rebinned = [_rebin(h, width) for h in group]
+        offset = min(o for o, _ in rebinned)
+        counts = np.zeros(max(o + len(c) for o, c in rebinned) - offset, dtype=np.int64)
+        for o, c in rebinned:
+            counts[o - offset:o - offset + len(c)] += c
+        parts.append({'offset': offset, 'width': width, 'centre': centre, 'counts': counts.tolist()})
+    return parts[0] if len(parts) == 1 else {'parts': parts}
+
+
+def _bins(h: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """values and counts of the bins of a histogram, or of all its parts"""
+    if 'parts' in h:
+        bins = [_bins(p) for p in h['parts']]
+        values, counts = np.concatenate([v for v, _ in bins]), np.concatenate([c for _, c in bins])
+        order = np.argsort(values, kind='stable')
+        return values[order], counts[order]
+    width, centre = h.get('width', 1.0), h.get('centre', 0.0)
+    return (np.arange(len(h['counts'])) + h['offset'] + centre) * width, np.array(h['counts'], dtype=np.int64)
+
+
+def histogram_statistics(h: dict) -> dict:
+    """voxels, mean, sd, min, max and PERCENTILES of the values of a histogram, exact for integer values"""
+    values, counts = _bins(h)
+    if not counts.sum():
+        return {'voxels': 0}
+    # integer histograms report integers
+    value = int if 'parts' not in h and h.get('centre', 0.0) == 0 and h.get('width', 1.0) == 1 else float
+    n = int(counts.sum())
+    mean = float(counts @ values / n)
+    cumulative = np.cumsum(counts)
+    return {
+        'voxels': n,
+        'mean': mean,
+        'sd': float(np.sqrt(counts @ (values - mean) ** 2 / n)),
+        'min': value(values[np.nonzero(counts)[0][0]]),
+        'max': value(values[np.nonzero(counts)[0][-1]]),
+        'percentiles': {str(p): value(values[np.searchsorted(cumulative, p / 100 * n)]) for p in PERCENTILES}
+    }
+
+
+def case_fingerprint(images: List[Path], label: Path, labels: int) -> dict:
+    """
+    Geometry, intensity histograms (all and foreground voxels, per modality) and voxels per label of one case
+
+    :param images: modality images of the case, in order
+    :param label: label map, need not exist (e.g. a test case without annotation)
+    :param labels: number of labels, including background
+    """
+    arrays, fingerprint = [], {}
+    for i, path in enumerate(images):
+        image = sitk.ReadImage(str(path))
+        if i == 0:
+            fingerprint = {'shape': list(image.GetSize()[::-1]), 'spacing': list(image.GetSpacing()[::-1])}
+        arrays.append(sitk.GetArrayViewFromImage(image).copy())
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(str(label))) if label.exists() else \
+        np.zeros(fingerprint['shape'], dtype=np.uint8)
+    foreground = mask > 0
+    fingerprint['modalities'] = [{'histogram': histogram(a), 'foreground_histogram': histogram(a[foreground])}
+                                 for a in arrays]
+    fingerprint['label_voxels'] = np.bincount(mask.ravel(), minlength=labels)[:labels].tolist()
+    return fingerprint
+
+
+def _cases(task_dir: Path, split: str) -> Dict[str, dict]:
+    cases = {}
+    for first in sorted((task_dir / f'images{split}').glob('*_0000.nii.gz')):
+        case = first.name[:-len('_0000.nii.gz')]
+        cases[case] = {'images': sorted((task_dir / f'images{split}').glob(f'{case}_[0-9][0-9][0-9][0-9].nii.gz')),
+                       'label': task_dir / f'labels{split}' / f'{case}.nii.gz'}
+    return cases
+
+
+def write_case_fingerprints(task_dirs: List[Path], out_dir: Path, labels: int, scheduler: Scheduler = None) -> int:
+    """
+    Fingerprint each case of the Tr and Ts splits of nnUNet tasks, to out_dir/<case>.json
+
+    :param task_dirs: task directories with images{split} and labels{split}, missing splits are skipped
+    :return: number of cases
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    items = [(split, case, paths) for task_dir in task_dirs for split in ['Tr', 'Ts']
+             for case, paths in _cases(task_dir, split).items()]
+
+    def _fingerprint(item) -> int:
+        split, case, paths = item
+        with work_item(case):
+            fingerprint = {'case': case, 'split': split, **case_fingerprint(paths['images'], paths['label'], labels)}
+            with open(out_dir / f'{case}.json', 'w') as f:
+                json.dump(fingerprint, f)
+        return 1
+
+    def estimate(item) -> int:
+        # arrays of all modalities and the label, read once
+        return 2 * sum(image_bytes(p) for p in item[2]['images'])
+
+    scheduler = scheduler or Scheduler()
+    return sum(future.result() for _, future in tqdm(scheduler.map(_fingerprint, items, estimate), total=len(items)))
+
+
+def merge_fingerprints(fingerprint_dirs: List[Path], out_json: Path) -> dict:
+    """
+    Merge the case fingerprints of fingerprint_dirs in one dataset fingerprint: the cases, and of the training split
+    the median spacing and shape, intensity statistics per modality (of foreground voxels, as nnU-Net plans with) and
+    the voxels and cases per label
+    """
+    cases = []
+    for fingerprint_dir in fingerprint_dirs:
+        for path in sorted(fingerprint_dir.glob('*.json')):
+            with open(path) as f:
+                cases.append(json.load(f))
+    cases.sort(key=lambda c: c['case'])
+
+    training = [c for c in cases if c['split'] == 'Tr']
+    dataset = {'cases': len(training)}
+    if training:
+        modalities = len(training[0]['modalities'])
+        label_voxels = np.array([c['label_voxels'] for c in training], dtype=np.int64)
+        dataset.update({
+            'median_spacing': np.median([c['spacing'] for c in training], axis=0).tolist(),
+            'median_shape': np.median([c['shape'] for c in training], axis=0).tolist(),
+            'intensities': [{
+                'all': histogram_statistics(merge_histograms(c['modalities'][m]['histogram'] for c in training)),
+                'foreground': histogram_statistics(merge_histograms(c['modalities'][m]['foreground_histogram']
+                                                                    for c in training))
+            } for m in range(modalities)],
+            'label_voxels': label_voxels.sum(axis=0).tolist(),
+            'label_cases': np.count_nonzero(label_voxels, axis=0).tolist()
+        })
+
+    # statistics replace the histograms of the cases, which would dominate the file
+    for c in cases:
+        c['intensities'] = [{'all': histogram_statistics(m['histogram']),
+                             'foreground': histogram_statistics(m['foreground_histogram'])}
+                            for m in c.pop('modalities')]
+    fingerprint = {'dataset': dataset, 'cases': cases}
+    with open(out_json, 'w') as f:
+        json.dump(fingerprint, f)
+    return fingerprint
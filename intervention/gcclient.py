@@ -0,0 +1,218 @@
+import asyncio, logging, random
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import httpx
+
+API = 'https://grand-challenge.org/api/v1/'
+INTERFACE = 'generic-medical-image'
+PART_SIZE = 32 * 1024 * 1024
+
+# conflicts and locks occur while GC processes an upload, 429 when rate limited
+RETRY_STATUS = {409, 423, 429}
+# a POST creates an object, so it is retried only when the server did not process it, nor received it
+POST_RETRY_STATUS = {429, 503}
+POST_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class GCError(NamedTuple):
+    method: str
+    url: str
+    status: Optional[int]
+    error: str
+    attempts: int
+
+
+class GCRequestError(Exception):
+    def __init__(self, error: GCError):
+        super().__init__(f'{error.method} {error.url}: {error.status} {error.error} ({error.attempts} attempts)')
+        self.error = error
+
+
+class AsyncGC:
+    def __init__(self, token: str, slug: str, base_url: str = API, concurrency: int = 8, retries: int = 5,
+                 backoff: float = 0.5, timeout: float = 60, transport: httpx.AsyncBaseTransport = None):
+        """
+        Asynchronous Grand Challenge reader study client, use as `async with AsyncGC(...) as gc`
+
+        :param token: API key
+        :param slug: reader study slug
+        :param concurrency: maximum requests in flight
+        :param retries: retries of a request on connection errors, 409, 423, 429 and 5xx,
+        with jittered exponential backoff. POSTs are retried on 429, 503 and errors before the request was sent only,
+        such that no display set, upload or upload session is created twice.
+        :param backoff: base delay of the backoff in seconds
+        :param transport: httpx transport, e.g. a fake server in tests
+        """
+        self.slug = slug
+        self.base_url = base_url
+        self.retries = retries
+        self.backoff = backoff
+        self.errors: List[GCError] = []
+        self._token = token
+        self._timeout = timeout
+        self._transport = transport
+        self._concurrency = concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._reader_study: Optional[dict] = None
+
+    async def __aenter__(self) -> 'AsyncGC':
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self._timeout, transport=self._transport,
+                                         headers={'Authorization': f'Bearer {self._token}'})
+        return self
+
+    async def __aexit__(self, *args):
+        await self._client.aclose()
+
+    def _delay(self, attempt: int, response: httpx.Response = None) -> float:
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def request(self, method: str, url: str, collect: bool = False, auth: bool = True,
+                      **kwargs) -> Optional[httpx.Response]:
+        """
+        :param url: relative to base_url, or absolute (e.g. a next page or a presigned upload url)
+        :param collect: on failure, append the error to self.errors and return None instead of raising
+        :param auth: send the API key, False for presigned upload urls
+        :raises GCRequestError: after the last retry, unless collect
+        """
+        status, error = None, ''
+        for attempt in range(self.retries + 1):
+            response = None
+            async with self._semaphore:
+                try:
+                    request = self._client.build_request(method, url, **kwargs)
+                    if not auth:
+                        del request.headers['Authorization']
+                    response = await self._client.send(request)
+                    status = response.status_code
+                    if response.is_success:
+                        return response
+                    error = response.text[:200]
+                    if method == 'POST' and status not in POST_RETRY_STATUS:
+                        break
+                    if status not in RETRY_STATUS and status < 500:
+                        break
+                except httpx.TransportError as e:
+                    status, error = None, f'{type(e).__name__}({e})'
+                    if method == 'POST' and not isinstance(e, POST_RETRY_ERRORS):
+                        break
+            if attempt < self.retries:
+                await asyncio.sleep(self._delay(attempt, response))
+
+        e = GCError(method, str(url), status, error, attempt + 1)
+        if collect:
+            logging.warning(f'GC request failed: {e}')
+            self.errors.append(e)
+            return None
+        raise GCRequestError(e)
+
+    async def json(self, method: str, url: str, **kwargs) -> dict:
+        return (await self.request(method, url, **kwargs)).json()
+
+    async def list(self, url: str, params: dict = None, limit: int = 100) -> List[dict]:
+        """all results of a paginated listing, the pages after the first are fetched concurrently"""
+        params = dict(params or {}, limit=limit)
+        first = await self.json('GET', url, params=dict(params, offset=0))
+        # the server may serve fewer results per page than asked for
+        step = min(limit, len(first['results'])) or limit
+        pages = await asyncio.gather(*[self.json('GET', url, params=dict(params, offset=offset, limit=step))
+                                       for offset in range(step, first['count'], step)])
+        return [r for page in [first] + pages for r in page['results']]
+
+    async def reader_study(self) -> dict:
+        if self._reader_study is None:
+            studies = await self.json('GET', 'reader-studies/', params={'slug': self.slug})
+            if not studies['results']:
+                raise KeyError(f'unknown reader study: {self.slug}')
+            self._reader_study = studies['results'][0]
+        return self._reader_study
+
+    async def _by_api_url(self, url: str) -> Dict[str, dict]:
+        pk = (await self.reader_study())['pk']
+        return {v['api_url']: v for v in await self.list(url, params={'question__reader_study': pk})}
+
+    async def questions(self) -> Dict[str, dict]:
+        return {v['api_url']: v for v in (await self.reader_study())['questions']}
+
+    async def answers(self) -> Dict[str, dict]:
+        """the answers of all readers of the reader study"""
+        return await self._by_api_url('reader-studies/answers/')
+
+    async def display_sets(self) -> Dict[str, dict]:
+        return await self._by_api_url('reader-studies/display-sets/')
+
+    async def images(self) -> Dict[str, dict]:
+        return await self._by_api_url('cases/images/')
+
+    async def create_display_set(self, **fields) -> dict:
+        return await self.json('POST', 'reader-studies/display-sets/', json={'reader_study': self.slug, **fields})
+
+    async def update_display_set(self, pk: str, collect: bool = False, **fields) -> Optional[dict]:
+        """partial update, e.g. update_display_set(pk, order=3)"""
+        response = await self.request('PATCH', f'reader-studies/display-sets/{pk}/', collect=collect, json=fields)
+        return response.json() if response is not None else None
+
+    async def delete_display_set(self, pk: str, collect: bool = False) -> bool:
+        return await self.request('DELETE', f'reader-studies/display-sets/{pk}/', collect=collect) is not None
+
+    async def delete_display_sets(self, pks: Iterable[str]) -> int:
+        """delete concurrently, failures are collected in self.errors; returns the number deleted"""
+        return sum(await asyncio.gather(*[self.delete_display_set(pk, collect=True) for pk in pks]))
+
+    async def upload_file(self, path: Path, filename: str = None, part_size: int = PART_SIZE) -> dict:
+        """
+        Upload a file as a multipart upload, whose parts are sent concurrently
+
+        :param part_size: bytes per part, S3 requires at least 5 MB for all but the last part
+        :return: the completed user upload
+        """
+        size = Path(path).stat().st_size
+        part_numbers = list(range(1, max(1, -(-size // part_size)) + 1))
+
+        def read(part_number: int) -> bytes:
+            with open(path, 'rb') as f:
+                f.seek((part_number - 1) * part_size)
+                return f.read(part_size)
+
+        async def put(part_number: int, url: str) -> dict:
+            content = await asyncio.to_thread(read, part_number)
+            response = await self.request('PUT', url, auth=False, content=content)
+            return {'ETag': response.headers['ETag'], 'PartNumber': part_number}
+
+        upload = await self.json('POST', 'uploads/', json={'filename': filename or Path(path).name})
+        pk, upload_id = upload['pk'], upload['s3_upload_id']
+        try:
+            urls = await self.json('PATCH', f'uploads/{pk}/{upload_id}/generate-presigned-urls/',
+                                   json={'part_numbers': part_numbers})
+            parts = await asyncio.gather(*[put(n, urls['presigned_urls'][str(n)]) for n in part_numbers])
+        except Exception:
+            await self.request('PATCH', f'uploads/{pk}/{upload_id}/abort-multipart-upload/', collect=True)
+            raise
+        return await self.json('PATCH', f'uploads/{pk}/{upload_id}/complete-multipart-upload/',
+                               json={'parts': list(parts)})
+
+    async def create_display_set_from_image(self, path: Path, interface: str = INTERFACE, filename: str = None,
+                                            **fields) -> str:
+        """
+        Upload the image, then create a display set and start the import of the upload into it. The display set is
+        deleted again if the import cannot be started, such that failures leave no empty display sets.
+
+        :param filename: name of the upload, defaults to the name of path
+        :param fields: display set fields, e.g. order
+        :return: display set pk
+        """
+        upload = await self.upload_file(path, filename)
+        display_set = await self.create_display_set(**fields)
+        try:
+            await self.json('POST', 'cases/upload-sessions/', json={'uploads': [upload['api_url']],
+                                                                    'display_set': display_set['pk'],
+                                                                    'interface': interface})
+        except Exception:
+            await self.delete_display_set(display_set['pk'], collect=True)
+            raise
+        return display_set['pk']
@@ -0,0 +1,108 @@
+import logging, ssl, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import click, httpx
+
+from intervention.fakegc import FakeGC
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, as clients reuse their connections to GC
+    protocol_version = 'HTTP/1.1'
+    server: 'GCServer'
+
+    def _handle(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        request = httpx.Request(self.command, self.server.url + self.path, headers=dict(self.headers.items()),
+                                content=content)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        response = self.server.fake.handle(request)
+        body = response.read()
+
+        self.send_response(response.status_code)
+        for key, value in response.headers.items():
+            if key.lower() not in ('content-length', 'transfer-encoding', 'connection'):
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+    def log_message(self, format: str, *args):
+        logging.debug(f'{self.address_string()} {format % args}')
+
+
+class GCServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fake: FakeGC, host: str = 'localhost', port: int = 0, latency: float = 0,
+                 certfile: Path = None, keyfile: Path = None):
+        """
+        Local Grand Challenge stand-in: serves a FakeGC over HTTP(S), use as `with GCServer(fake) as server` and
+        connect to server.fake.base_url. gcapi only accepts https urls, serve it a certfile that it trusts, e.g.
+        through the SSL_CERT_FILE environment variable.
+
+        :param port: 0 picks a free port
+        :param latency: seconds added to each request, requests are handled concurrently
+        :param certfile: PEM certificate chain to serve HTTPS
+        :param keyfile: PEM private key, if not in certfile
+        """
+        super().__init__((host, port), _Handler)
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(str(certfile), str(keyfile) if keyfile else None)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.url = f"{'https' if certfile else 'http'}://{host}:{self.server_address[1]}"
+        self.fake = fake
+        self.latency = latency
+        # presigned upload urls and new objects point to this server
+        fake.host = self.url
+        fake.reader_study['api_url'] = f"{fake.base_url}reader-studies/{fake.reader_study['slug']}/"
+        self._thread = None
+
+    def start(self) -> 'GCServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> 'GCServer':
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+@click.command()
+@click.option('-p', '--port', type=int, default=8000)
+@click.option('--host', default='localhost')
+@click.option('-n', '--cases', type=int, default=1000, help='display sets, each with an image and answers')
+@click.option('-s', '--slug', default='fake')
+@click.option('-l', '--latency', type=float, default=0.05, help='seconds per request')
+@click.option('--page-size', type=int, default=None, help='maximum results per page')
+@click.option('--rate-limit', type=float, default=0, help='fraction of requests answered with 429')
+@click.option('--retry-after', type=int, default=0, help='Retry-After seconds of the 429 responses')
+@click.option('--fail-rate', type=float, default=0, help='fraction of requests answered with 503')
+@click.option('--cert', type=click.Path(exists=True, path_type=Path), default=None, help='serve HTTPS')
+@click.option('--key', type=click.Path(exists=True, path_type=Path), default=None)
+def main(port: int, host: str, cases: int, slug: str, latency: float, page_size: int, rate_limit: float,
+         retry_after: int, fail_rate: float, cert: Path, key: Path):
+    fake = FakeGC.synthetic(cases, slug, page_size=page_size, rate_limit=rate_limit, retry_after=retry_after,
+                            fail_rate=fail_rate)
+    server = GCServer(fake, host, port, latency, cert, key)
+    click.echo(f'Serving reader study {slug} with {cases} cases @ {fake.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import shutil
+from pathlib import Path
+from typing import Iterable, Sequence
+
+import numpy as np, SimpleITK as sitk
+
+from intervention.cache import image_header
+
+# nnU-Net preprocessing of mha2nnunet, (z, y, x)
+SPACING = (3.0, 1.094, 1.094)
+MATRIX_SIZE = (5, 256, 256)
+# annotations rasterized on the target grid, in the annotations directory
+GRID_DIR = 'grid'
+
+
+def target_grid(header: dict, spacing: Sequence[float] = SPACING, matrix_size: Sequence[int] = MATRIX_SIZE) -> dict:
+    """
+    Geometry the preprocessing resamples an image to: the image resampled to spacing from its first voxel, then
+    centre cropped or padded to matrix_size, as picai_prep does.
+
+    :param header: image geometry (see intervention.cache.read_header)
+    :return: size, spacing, origin and direction of the target grid, (x, y, z) like header
+    """
+    size, native = np.array(header['size']), np.array(header['spacing'])
+    spacing, matrix_size = np.array(spacing[::-1], dtype=float), np.array(matrix_size[::-1])
+    resampled = np.round(size * native / spacing).astype(int)
+    start = np.where(resampled > matrix_size, (resampled - matrix_size) // 2, -((matrix_size - resampled) // 2))
+    direction = np.array(header['direction']).reshape(3, 3)
+    return {
+        'size': matrix_size.tolist(),
+        'spacing': spacing.tolist(),
+        'origin': (np.array(header['origin']) + direction @ (start * spacing)).tolist(),
+        'direction': list(header['direction'])
+    }
+
+
+def empty_image(header: dict, pixel_id: int = sitk.sitkUInt8) -> sitk.Image:
+    """zero image with the geometry of header"""
+    image = sitk.Image([int(s) for s in header['size']], pixel_id)
+    image.SetSpacing(header['spacing'])
+    image.SetOrigin(header['origin'])
+    image.SetDirection(header['direction'])
+    return image
+
+
+def _same_grid(a: dict, b: dict) -> bool:
+    return a['size'] == b['size'] and \
+        all(np.allclose(a[k], b[k], atol=1e-3) for k in ['spacing', 'origin', 'direction'])
+
+
+def copy_grid_labels(task_dir: Path, split: str, archive: Iterable[dict], annotations_dir: Path) -> int:
+    """
+    Replace the labels the converter resampled by the annotations rasterized on the target grid, such that they are
+    not resampled at all. A label is kept if the converted scan is not on the grid of its annotation.
+
+    :param task_dir: nnUNet task directory with images{split} and labels{split}
+    :param archive: items of the converter settings, their annotation_path relative to annotations_dir
+    :return: number of replaced labels
+    """
+    replaced = 0
+    for item in archive:
+        if Path(item['annotation_path']).parts[0] != GRID_DIR:
+            continue
+        case = f'{item["patient_id"]}_{item["study_id"]}'
+        grid = annotations_dir / item['annotation_path']
+        label = task_dir / f'labels{split}' / f'{case}.nii.gz'
+        scan = task_dir / f'images{split}' / f'{case}_0000.nii.gz'
+        if label.exists() and scan.exists() and _same_grid(image_header(grid), image_header(scan)):
+            shutil.copyfile(grid, label)
+            replaced += 1
+    return replaced
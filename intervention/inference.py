@@ -1,160 +1,127 @@
-# import os, logging, json, shutil
-# import subprocess
-# from typing import List
-# from pathlib import Path
-#
-# from picai_prep import MHA2nnUNetConverter
-# import SimpleITK as sitk
-# import matplotlib.pyplot as plt
-# import numpy as np
-#
-# from intervention.utils import dataset_json, CommandInference, CommandDCM, CommandDCM2MHA, CommandMHA2nnUNet
-# from intervention.dcm import generate_dcm2mha_json
-# from intervention.dcm2mha import dcm2mha
-#
-#
-# def nnUNet_predict(results_dir: Path, input_dir: Path, output_dir: Path, task: str, trainer: str, folds: List = None,
-#                     network: str = "3d_fullres", checkpoint: str = "model_final_checkpoint",
-#                     store_probability_maps: bool = True, disable_augmentation: bool = False,
-#                     disable_patch_overlap: bool = False):
-#     """
-#     Use trained nnUNet network to generate segmentation masks
-#     """
-#
-#     # Set environment variables
-#     os.environ['RESULTS_FOLDER'] = str(results_dir)
-#
-#     # Run prediction script
-#     cmd = [
-#         'nnUNet_predict',
-#         '-t', task,
-#         '-i', str(input_dir),
-#         '-o', str(output_dir),
-#         '-m', network,
-#         '-tr', trainer if trainer else "nnUNetTrainerV2",
-#         '--num_threads_preprocessing', '2',
-#         '--num_threads_nifti_save', '1'
-#     ]
-#
-#     # if folds:
-#     #     cmd.append('-f')
-#     #     cmd.extend(folds.split(','))
-#
-#     if checkpoint:
-#         cmd.append('-chk')
-#         cmd.append(checkpoint)
-#
-#     if store_probability_maps:
-#         cmd.append('--save_npz')
-#
-#     if disable_augmentation:
-#         cmd.append('--disable_tta')
-#
-#     if disable_patch_overlap:
-#         cmd.extend(['--step_size', '1'])
-#
-#     try:
-#         subprocess.check_call(cmd)
-#     except Exception as e:
-#         print(' '.join(cmd))
-#         logging.info(' '.join(cmd))
-#         logging.info(str(e))
-#
-#
-# def get_pid_sid(file: Path):
-#     img = sitk.ReadImage(file.as_posix())
-#     pid = img.GetMetaData('0010|0020').strip()
-#     sid = img.GetMetaData('0020|000d').strip().split('.')[-1]
-#     return pid, sid
-#
-#
-# def inference(cmd: CommandInference):
-#     # convert files found in /predict to nii.gz
-#
-#     # dcm2mha
-#     dcm_out_dir = str(cmd.in_dir / 'dcm')
-#     dcm_archive_dir = str(cmd.in_dir)
-#     dcm_mappings = {'mappings': {'auto': {'Modality': ['MR']}}}
-#     dcm_cmd = CommandDCM(out_dir=dcm_out_dir, archive_dir=dcm_archive_dir, mappings=dcm_mappings, **cmd.kwargs)
-#     generate_dcm2mha_json(dcm_cmd)
-#
-#     dcm2mha_out_dir = str(cmd.in_dir / 'mha')
-#     dcm2mha_cmd = CommandDCM2MHA(out_dir=dcm2mha_out_dir, archive_dir=dcm_archive_dir, json_dir=dcm_out_dir, **cmd.kwargs)
-#     dcm2mha(dcm2mha_cmd)
-#
-#     # mha2nnunet
-#     mha2nnunet_out_dir = str(cmd.in_dir / 'dcm')
-#     mha2nnunet_mha_dir
-#     annotate_dir
-#     # self.out_dir = self.setup_dir('out_dir')
-#     # self.mha_dir = self.setup_dir('mha_dir')
-#     # self.annotate_dir = self.setup_dir('annotate_dir')
-#     # self.task_name: str = self._settings['task_name']
-#     # self.task_id: int = self._settings['task_id']
-#     # self.task_dirname = f'Task{self.task_id}_{self.task_name}'
-#     # self.test_percentage: float = self._settings['test_percentage']
-#     inference_dm.mha.mkdir(exist_ok=True)
-#     mha2nnunet_archive = []
-#     for directory in [dm.predict] + list(inference_dm.mha.iterdir()):
-#         for path in directory.iterdir():
-#             if path.suffix == '.mha':
-#                 pid, sid = get_pid_sid(path)
-#                 pid_dir = inference_dm.mha / pid
-#                 pid_dir.mkdir(exist_ok=True)
-#                 mha = pid_dir / path.name
-#                 if not mha.exists():
-#                     shutil.copyfile(path, pid_dir / path.name)
-#
-#                 item = {
-#                     'patient_id': pid,
-#                     'study_id': sid,
-#                     'scan_paths': [path.absolute().as_posix()]
-#                 }
-#                 annotation = dm.annotations / path.with_suffix('.nii.gz').name
-#                 if annotation.exists():
-#                     item['annotation_path'] = annotation.absolute().as_posix()
-#                 mha2nnunet_archive.append(item)
-#     mha2nnunet_settings = {
-#         "archive": mha2nnunet_archive,
-#         "dataset_json": dataset_json(dm.task_dirname),
-#         "preprocessing": {
-#             "spacing": [
-#                 3.0,
-#                 1.094,
-#                 1.094
-#             ]
-#         }
-#     }
-#
-#     inference_dm.nnunet.mkdir(exist_ok=True)
-#     mha2nnunet_settings_json = inference_dm.nnunet / 'mha2nnunet_settings.json'
-#     with open(mha2nnunet_settings_json, 'w') as f:
-#         json.dump(mha2nnunet_settings, f, indent=4)
-#
-#     MHA2nnUNetConverter(
-#         input_path=inference_dm.mha.as_posix(),
-#         output_path=inference_dm.nnunet.as_posix(),
-#         settings_path=mha2nnunet_settings_json.as_posix(),
-#         out_dir_scans='images',
-#         out_dir_annot='labels'
-#     ).convert()
-#
-#     # clean up
-#     nnunet_dir = inference_dm.nnunet / inference_dm.task_dirname
-#     (nnunet_dir / 'labels').mkdir(exist_ok=True)
-#     for tr in [nnunet_dir / 'images', nnunet_dir / 'labels']:
-#         shutil.move(tr, inference_dm.output)
-#
-#     shutil.rmtree(inference_dm.dcm)
-#     shutil.rmtree(inference_dm.mha)
-#     shutil.rmtree(inference_dm.nnunet)
-#
-#     nnUNet_predict(dm.output / 'results', inference_dm.output / 'images', inference_dm.output, dm.task_dirname,
-#                    checkpoint='model_best', trainer=trainer)
-#
-#     return inference_dm.output
-#
-#
+import os, logging, re, shutil, subprocess
+from typing import Dict, List
+from pathlib import Path
+
+import click
+
+from intervention.utils import CommandInference
+from intervention.probability import compact_probabilities
+from intervention.tips import localize_dir, TIPS_CSV
+from intervention.workqueue import distribute, merge_shards, shard_dir, shard_of, SHARDS_DIR
+
+
+def nnUNet_predict(results_dir: Path, input_dir: Path, output_dir: Path, task: str, trainer: str, folds: List = None,
+                   network: str = "3d_fullres", checkpoint: str = "model_final_checkpoint",
+                   store_probability_maps: bool = True, disable_augmentation: bool = False,
+                   disable_patch_overlap: bool = False):
+    """
+    Use trained nnUNet network to generate segmentation masks, raises if nnUNet_predict fails
+    """
+
+    # Set environment variables
+    os.environ['RESULTS_FOLDER'] = str(results_dir)
+
+    # Run prediction script
+    cmd = [
+        'nnUNet_predict',
+        '-t', task,
+        '-i', str(input_dir),
+        '-o', str(output_dir),
+        '-m', network,
+        '-tr', trainer if trainer else "nnUNetTrainerV2",
+        '--num_threads_preprocessing', '2',
+        '--num_threads_nifti_save', '1'
+    ]
+
+    if folds:
+        cmd.append('-f')
+        cmd.extend(str(f) for f in folds)
+
+    if checkpoint:
+        cmd.append('-chk')
+        cmd.append(checkpoint)
+
+    if store_probability_maps:
+        cmd.append('--save_npz')
+
+    if disable_augmentation:
+        cmd.append('--disable_tta')
+
+    if disable_patch_overlap:
+        cmd.extend(['--step_size', '1'])
+
+    try:
+        subprocess.check_call(cmd)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error(f"{' '.join(cmd)} failed: {e}")
+        raise
+
+
+def case_files(in_dir: Path) -> Dict[str, List[Path]]:
+    """modality files (case_0000.nii.gz, case_0001.nii.gz, ...) per case of an nnUNet images directory"""
+    cases = {}
+    for image in sorted(Path(in_dir).iterdir()):
+        case = re.sub(r'_\d{4}\.nii\.gz$', '', image.name)
+        if case != image.name:
+            cases.setdefault(case, []).append(image)
+    return cases
+
+
+def _predict(cmd: CommandInference, in_dir: Path, out_dir: Path) -> int:
+    """:return: bytes saved by compacting probabilities"""
+    store = cmd.probabilities != 'none'
+    if cmd.cpu_model:
+        from intervention.export import CpuPredictor
+        with CpuPredictor(cmd.cpu_model, cmd.model_dir, cmd.scheduler.workers, cmd.folds,
+                          cmd.fold_workers) as predictor:
+            predictor.predict_dir(in_dir, out_dir, store)
+    else:
+        nnUNet_predict(cmd.model_dir, in_dir, out_dir, cmd.task_dirname, cmd.trainer, folds=cmd.folds,
+                       store_probability_maps=store)
+
+    if not store:
+        return 0
+    click.echo(f'Compacting probabilities to {cmd.probabilities}')
+    return compact_probabilities(out_dir, dtype=cmd.probabilities, crop=cmd.probabilities_crop,
+                                 scheduler=cmd.scheduler)
+
+
+def inference_shard(cmd: CommandInference, shard: int, shards: int) -> dict:
+    """predict the cases of one shard of cmd.in_dir, linked to and predicted in the shard directory of cmd.out_dir"""
+    in_dir, out_dir = shard_dir(cmd.out_dir, shard) / 'input', shard_dir(cmd.out_dir, shard) / 'output'
+    in_dir.mkdir(parents=True, exist_ok=True)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    n = 0
+    for case, images in case_files(cmd.in_dir).items():
+        # all modalities of a case go to the same shard
+        if shard_of(case, shards) == shard:
+            for image in images:
+                (in_dir / image.name).unlink(missing_ok=True)
+                (in_dir / image.name).symlink_to(image.absolute())
+                n += 1
+
+    return {'images': n, 'saved': _predict(cmd, in_dir, out_dir) if n else 0}
+
+
+def inference(cmd: CommandInference):
+    click.echo(f'\nPredicting\n\t{cmd.in_dir}\nto\n\t{cmd.out_dir}\nusing {cmd.task_dirname} ({cmd.trainer})'
+               + (f' exported to {cmd.cpu_model}' if cmd.cpu_model else ''))
+    if cmd.queue_dir:
+        saved = sum(r['saved'] for r in distribute(cmd))
+        merge_shards([shard_dir(cmd.out_dir, i) / 'output' for i in range(cmd.shards)], cmd.out_dir)
+        shutil.rmtree(cmd.out_dir / SHARDS_DIR)
+    else:
+        saved = _predict(cmd, cmd.in_dir, cmd.out_dir)
+
+    if cmd.probabilities != 'none':
+        click.echo(f'Saved {saved / 1e6:.1f} MB')
+
+    rows = localize_dir(cmd.out_dir, workers=cmd.scheduler.workers)
+    click.echo(f'Localized {sum(r["found"] for r in rows)} needle tips in {len(rows)} predictions to '
+               f'{cmd.out_dir / TIPS_CSV}')
+
+
 # class Prediction:
 #     def __init__(self, path: Path, image_dir: Path, label_dir: Path):
 #         self.prediction = path
@@ -0,0 +1,163 @@
+import cProfile, io, json, logging, os, pstats, resource, sys, threading, time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+_tracer: Optional['Tracer'] = None
+
+
+def _io() -> Dict[str, int]:
+    """bytes read/written by this process, including page cache hits (Linux only)"""
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read': int(values['rchar']), 'written': int(values['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return {'read': 0, 'written': 0}
+
+
+def _reset_peak_rss():
+    """reset the peak resident set size of this process to the current one (Linux only)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss() -> int:
+    """peak resident set size in bytes since the last _reset_peak_rss, otherwise of the process lifetime"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+class Stage:
+    def __init__(self, tracer: 'Tracer', name: str):
+        self.tracer = tracer
+        self.name = name
+        self.items = 0
+        self.record = {}
+
+    @contextmanager
+    def item(self, key: str):
+        # peak RSS and bytes read/written are process wide, so only stages record them
+        wall, cpu = time.perf_counter(), time.thread_time()
+        record = {'type': 'item', 'stage': self.name, 'item': str(key)}
+        try:
+            yield record
+        finally:
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.thread_time() - cpu
+            with self.tracer.lock:
+                self.items += 1
+            self.tracer.emit(record)
+
+
+class Tracer:
+    def __init__(self, path: Path = None, profile_dir: Path = None):
+        """
+        Records wall time, CPU time, peak RSS (of the stage, where the peak can be reset), bytes read/written and
+        items/s per stage, and wall and CPU time per work item
+
+        :param path: JSONL trace output, None to keep records in memory only
+        :param profile_dir: if set, each stage is run under cProfile, the main thread and the threads started during
+        the stage (e.g. Scheduler and thread pools), and their merged stats are dumped here
+        """
+        self.path = path
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.stages: List[dict] = []
+        self._current: Optional[Stage] = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            open(path, 'w').close()
+
+    def __enter__(self):
+        global _tracer
+        self._previous, _tracer = _tracer, self
+        return self
+
+    def __exit__(self, *args):
+        global _tracer
+        _tracer = self._previous
+
+    def emit(self, record: dict):
+        if self.path:
+            with self.lock, open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def stage(self, name: str):
+        stage = Stage(self, name)
+        profilers = [cProfile.Profile()] if self.profile_dir else []
+        self._current = stage
+
+        def profile_thread(*args):
+            # the first event of a thread started during the stage, which then runs under a profiler of its own
+            profiler = cProfile.Profile()
+            with self.lock:
+                profilers.append(profiler)
+            profiler.enable()
+
+        # from Python 3.12 on a profiler sees all threads
+        per_thread = profilers and sys.version_info < (3, 12)
+        _reset_peak_rss()
+        io_start, wall, cpu = _io(), time.perf_counter(), time.process_time()
+        try:
+            if profilers:
+                if per_thread:
+                    threading.setprofile(profile_thread)
+                profilers[0].enable()
+            yield stage
+        finally:
+            if profilers:
+                profilers[0].disable()
+                if per_thread:
+                    threading.setprofile(None)
+            wall = time.perf_counter() - wall
+            io_end = _io()
+            stage.record = {'type': 'stage', 'stage': name, 'wall': wall, 'cpu': time.process_time() - cpu,
+                            'peak_rss': _peak_rss(), 'read': io_end['read'] - io_start['read'],
+                            'written': io_end['written'] - io_start['written'], 'items': stage.items,
+                            'items_per_s': stage.items / wall if wall > 0 else 0}
+            self._current = None
+            self.stages.append(stage.record)
+            self.emit(stage.record)
+            if profilers:
+                self._dump_profile(list(profilers), name)
+
+    def _dump_profile(self, profilers: List[cProfile.Profile], name: str):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        profile = self.profile_dir / f'{len(self.stages)}_{name}.prof'
+        s = io.StringIO()
+        stats = pstats.Stats(*profilers, stream=s)
+        stats.dump_stats(profile)
+        stats.sort_stats('cumulative').print_stats(25)
+        logging.info(f'cProfile {name} ({profile}, {len(profilers)} threads)\n{s.getvalue()}')
+
+    def summary(self) -> str:
+        header = f'{"stage":<14}{"wall (s)":>10}{"cpu (s)":>10}{"peak RSS (MB)":>15}' \
+                 f'{"read (MB)":>11}{"written (MB)":>14}{"items":>7}{"items/s":>9}'
+        rows = [header, '-' * len(header)]
+        for r in self.stages:
+            rows.append(f'{r["stage"]:<14}{r["wall"]:>10.2f}{r["cpu"]:>10.2f}{r["peak_rss"] / 1e6:>15.1f}'
+                        f'{r["read"] / 1e6:>11.1f}{r["written"] / 1e6:>14.1f}{r["items"]:>7}{r["items_per_s"]:>9.2f}')
+        return '\n'.join(rows)
+
+
+@contextmanager
+def work_item(key: str):
+    """Record a work item in the active stage, a no-op outside of a traced stage"""
+    stage = _tracer._current if _tracer else None
+    if stage is None:
+        yield {}
+    else:
+        with stage.item(key) as record:
+            yield record
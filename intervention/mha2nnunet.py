@@ -1,15 +1,27 @@
 import json, concurrent.futures, copy, shutil
 from pathlib import Path
+from typing import List, Tuple
 
 import click, picai_prep
 from tqdm import tqdm
-import numpy as np
+import numpy as np, SimpleITK as sitk
 
-from intervention.utils import CommandMHA2nnUNet, dataset_json, walk_archive
+from intervention.utils import CommandMHA2nnUNet, dataset_json, walk_archive, write_jsonl_archive, read_archive, \
+    jsonl2json
+from intervention.patches import write_patch_store
+from intervention.crop import needle_bounds, random_bounds, crop
+from intervention.grid import copy_grid_labels, GRID_DIR, MATRIX_SIZE, SPACING
+from intervention.fingerprint import merge_fingerprints, write_case_fingerprints, FINGERPRINT_JSON, \
+    FINGERPRINTS_DIR
+from intervention.metrics import work_item
+from intervention.writer import write_image
+from intervention.scheduler import image_bytes
+from intervention.workqueue import distribute, merge_shards, shard_dir, shard_of, SHARDS_DIR
 
 SPLIT_JSON = 'nnunet_split.json'
 TRAIN_JSON = 'mha2nnunet_train_settings.json'
 TEST_JSON = 'mha2nnunet_test_settings.json'
+CROPS_JSON = 'crops.json'
 
 
 def generate_mha2nnunet_jsons(cmd: CommandMHA2nnUNet):
@@ -19,6 +31,9 @@ def generate_mha2nnunet_jsons(cmd: CommandMHA2nnUNet):
         patient_id = dirpath.parts[-1]
         mha = (cmd.mha_dir / patient_id / filename)
         annotation = (cmd.annotate_dir / filename).with_suffix('.nii.gz')
+        if cmd.crop_margin == 0 and (gridded := cmd.annotate_dir / GRID_DIR / annotation.name).exists():
+            # already on the target grid, copied over the converted label after conversion (see _convert)
+            annotation = gridded
         fn = filename.split(sep='_')
         if mha.exists() and annotation.exists():
             return {
@@ -66,18 +81,10 @@ def generate_mha2nnunet_jsons(cmd: CommandMHA2nnUNet):
                 for s in S[:len(items)]:
                     splits[s].append(train_set[items.pop()])
 
-    preprocessing = {
-        "matrix_size": [
-            5,
-            256,
-            256
-        ],
-        "spacing": [
-            3.0,
-            1.094,
-            1.094
-        ]
-    }
+    preprocessing = {"matrix_size": list(MATRIX_SIZE), "spacing": list(SPACING)}
+    if cmd.crop_margin > 0:
+        # cropped cases keep their cropped extent
+        del preprocessing["matrix_size"]
 
     nnunet_split = []
     for S in range(len(splits)):
@@ -91,65 +98,219 @@ def generate_mha2nnunet_jsons(cmd: CommandMHA2nnUNet):
     with open(cmd.out_dir / SPLIT_JSON, 'w') as f:
         json.dump(nnunet_split, f, indent=4)
 
-    dump_settings = lambda A: {"dataset_json": dataset_json(cmd.task_dirname),
-                               "preprocessing": preprocessing,
-                               "archive": list([a.to_dict() for a in A])}
+    header = {"dataset_json": dataset_json(cmd.task_dirname), "preprocessing": preprocessing}
+    for settings_json, A in [(TRAIN_JSON, [t for s in splits for t in s]), (TEST_JSON, test_set)]:
+        if cmd.archive_format == 'jsonl':
+            write_jsonl_archive(_settings_path(cmd, settings_json), header, (a.to_dict() for a in A))
+        else:
+            with open(cmd.out_dir / settings_json, 'w') as f:
+                json.dump({**header, "archive": [a.to_dict() for a in A]}, f, indent=4)
 
-    with open(cmd.out_dir / TRAIN_JSON, 'w') as f:
-        json.dump(dump_settings([t for s in splits for t in s]), f, indent=4)
-    with open(cmd.out_dir / TEST_JSON, 'w') as f:
-        json.dump(dump_settings(test_set), f, indent=4)
 
+def _settings_path(cmd: CommandMHA2nnUNet, settings_json: str) -> Path:
+    path = cmd.out_dir / settings_json
+    return path.with_suffix('.jsonl') if cmd.archive_format == 'jsonl' else path
+
+
+def crop_cases(cmd: CommandMHA2nnUNet) -> dict:
+    """
+    Crop the scans and annotations of the train and test settings to cmd.crop_margin around the needle.
+    Cases without needle get a crop of the median needle crop size, at a position seeded by cmd.crop_seed.
+    Crops are scratch files and are written uncompressed.
+
+    :return: the crops per case, the cropped scans and annotations are written to the directories of _sources
+    """
+    scans_dir, annotations_dir = _sources(cmd)
+
+    items = []
+    for settings_json in [TRAIN_JSON, TEST_JSON]:
+        _, archive = read_archive(_settings_path(cmd, settings_json))
+        items += list(archive)
+
+    def read(path: Path) -> sitk.Image:
+        return cmd.cache.read(path) if cmd.cache else sitk.ReadImage(str(path))
+
+    def _crop(item: dict, size_mm: np.ndarray = None) -> dict:
+        case = f'{item["patient_id"]}_{item["study_id"]}'
+        with work_item(case):
+            label = read(cmd.annotate_dir / item['annotation_path'])
+            if size_mm is None:
+                bounds = needle_bounds(sitk.GetArrayViewFromImage(label), label.GetSpacing(), cmd.crop_margin)
+                if bounds is None:
+                    return {'case': case, 'positive': False}
+            else:
+                bounds = random_bounds(size_mm, label.GetSize(), label.GetSpacing(), f'{cmd.crop_seed}_{case}')
+            start, size = bounds
+
+            for path in item['scan_paths']:
+                (scans_dir / path).parent.mkdir(parents=True, exist_ok=True)
+                write_image(crop(read(cmd.mha_dir / path), start, size), scans_dir / path, level=0)
+            (annotations_dir / item['annotation_path']).parent.mkdir(parents=True, exist_ok=True)
+            write_image(crop(label, start, size), annotations_dir / item['annotation_path'], level=0)
+
+            return {'case': case, 'positive': size_mm is None, 'start': start, 'size': size,
+                    'size_mm': (np.array(size) * label.GetSpacing()).tolist(), 'source_size': list(label.GetSize()),
+                    'scan_paths': item['scan_paths']}
+
+    def estimate(item: dict) -> int:
+        # each image is read and cropped
+        paths = [cmd.annotate_dir / item['annotation_path']] + [cmd.mha_dir / p for p in item['scan_paths']]
+        return 2 * sum(image_bytes(p, cmd.cache) for p in paths)
+
+    click.echo(f'Cropping {len(items)} cases to {cmd.crop_margin} mm around the needle')
+    results = [(item, future.result()) for item, future in
+               tqdm(cmd.scheduler.map(_crop, items, estimate), total=len(items))]
+
+    negatives = [item for item, c in results if not c['positive']]
+    crops = [c for _, c in results if c['positive']]
+    if negatives:
+        if not crops:
+            raise ValueError('cannot crop cases without needle, no case has a needle')
+        size_mm = np.median([c['size_mm'] for c in crops], axis=0)
+        crops += [future.result() for _, future in
+                  tqdm(cmd.scheduler.map(lambda i: _crop(i, size_mm), negatives, estimate), total=len(negatives))]
+
+    return {c.pop('case'): c for c in sorted(crops, key=lambda c: c['case'])}
+
+
+def _sources(cmd: CommandMHA2nnUNet) -> Tuple[Path, Path]:
+    """scans and annotations directories the converter reads, the crops if cmd.crop_margin is set"""
+    if cmd.crop_margin > 0:
+        return cmd.out_dir / 'crop' / 'mha', cmd.out_dir / 'crop' / 'annotations'
+    return cmd.mha_dir, cmd.annotate_dir
 
-def mha2nnunet(cmd: CommandMHA2nnUNet):
-    train_json = cmd.out_dir / TRAIN_JSON
-    test_json = cmd.out_dir / TEST_JSON
-    if not train_json.exists() or not test_json.exists():
-        generate_mha2nnunet_jsons(cmd)
 
-    train = cmd.out_dir / 'train'
-    test = cmd.out_dir / 'test'
+def _convert(cmd: CommandMHA2nnUNet, output_dir: Path, train_json: Path, test_json: Path):
+    scans_dir, annotations_dir = _sources(cmd)
 
     picai_prep.MHA2nnUNetConverter(
-        output_dir=cmd.out_dir.as_posix(),
-        mha2nnunet_settings=(cmd.out_dir / TRAIN_JSON).as_posix(),
-        scans_dir=cmd.mha_dir.as_posix(),
-        annotations_dir=cmd.annotate_dir.as_posix()
+        output_dir=output_dir.as_posix(),
+        mha2nnunet_settings=train_json.as_posix(),
+        scans_dir=scans_dir.as_posix(),
+        annotations_dir=annotations_dir.as_posix()
     ).convert()
 
     picai_prep.MHA2nnUNetConverter(
-        output_dir=cmd.out_dir.as_posix(),
-        mha2nnunet_settings=(cmd.out_dir / TEST_JSON).as_posix(),
-        scans_dir=cmd.mha_dir.as_posix(),
-        annotations_dir=cmd.annotate_dir.as_posix(),
+        output_dir=output_dir.as_posix(),
+        mha2nnunet_settings=test_json.as_posix(),
+        scans_dir=scans_dir.as_posix(),
+        annotations_dir=annotations_dir.as_posix(),
         scans_out_dirname='imagesTs',
         annotations_out_dirname='labelsTs'
     ).convert()
 
-    train_task = train / cmd.task_dirname
-    test_task = test / cmd.task_dirname
+    # the converter resamples labels even if they are on its grid already
+    replaced = 0
+    for split, name, settings_json in [('Tr', 'train', train_json), ('Ts', 'test', test_json)]:
+        _, archive = read_archive(settings_json)
+        replaced += copy_grid_labels(output_dir / name / cmd.task_dirname, split, archive, annotations_dir)
+    if replaced:
+        click.echo(f'Copied {replaced} labels rasterized on the target grid to {output_dir}')
 
-    with open(train_task / 'dataset.json') as f:
-        train_dataset = json.load(f)
-    with open(test_task / 'dataset.json') as f:
-        test_dataset = json.load(f)
 
-    dataset = copy.copy(train_dataset)
-    dataset['numTest'] = len(test_dataset['training'])
-    dataset['test'] = [{'image': i['image'].replace('sTr/', 'sTs/'),
-                        'label': i['label'].replace('sTr/', 'sTs/')} for i in test_dataset['training']]
+def _fingerprint(cmd: CommandMHA2nnUNet, output_dir: Path) -> int:
+    """fingerprint the cases the converter wrote to output_dir, in the shard that converted them"""
+    click.echo(f'Fingerprinting cases of {output_dir}')
+    return write_case_fingerprints([output_dir / 'train' / cmd.task_dirname, output_dir / 'test' / cmd.task_dirname],
+                                   output_dir / FINGERPRINTS_DIR, len(dataset_json(cmd.task_dirname)['labels']),
+                                   cmd.scheduler)
+
+
+def mha2nnunet_shard(cmd: CommandMHA2nnUNet, shard: int, shards: int) -> dict:
+    """convert the cases of one shard of the train and test settings, to the shard directory of cmd.out_dir"""
+    out_dir = shard_dir(cmd.out_dir, shard)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    settings_jsons, n = [], 0
+    for settings_json in [TRAIN_JSON, TEST_JSON]:
+        settings, archive = read_archive(cmd.out_dir / settings_json)
+        archive = [a for a in archive if shard_of(f'{a["patient_id"]}_{a["study_id"]}', shards) == shard]
+        with open(out_dir / settings_json, 'w') as f:
+            json.dump(dict(settings, archive=archive), f)
+        settings_jsons.append(out_dir / settings_json)
+        n += len(archive)
+
+    if n:
+        _convert(cmd, out_dir, *settings_jsons)
+        if cmd.fingerprint:
+            _fingerprint(cmd, out_dir)
+    return {'cases': n}
 
+
+def _merge_tasks(cmd: CommandMHA2nnUNet, output_dirs: List[Path]) -> Path:
+    """merge the train and test tasks the converter wrote to each of output_dirs in one task"""
     output = cmd.out_dir / cmd.task_dirname
     if output.exists():
         shutil.rmtree(output)
     output.mkdir(parents=True)
 
-    shutil.move(train_task / 'imagesTr', output / 'imagesTr')
-    shutil.move(train_task / 'labelsTr', output / 'labelsTr')
-    shutil.move(test_task / 'imagesTs', output / 'imagesTs')
-    shutil.move(test_task / 'labelsTs', output / 'labelsTs')
+    dataset, training, test = None, [], []
+    for output_dir in output_dirs:
+        for split, task, entries in [('Tr', output_dir / 'train' / cmd.task_dirname, training),
+                                     ('Ts', output_dir / 'test' / cmd.task_dirname, test)]:
+            if not (task / 'dataset.json').exists():
+                continue  # a shard without cases of this split
+            with open(task / 'dataset.json') as f:
+                task_dataset = json.load(f)
+            if split == 'Tr' and dataset is None:
+                dataset = task_dataset
+            entries += task_dataset['training']
+            for kind in ['images', 'labels']:
+                merge_shards([task / f'{kind}{split}'], output / f'{kind}{split}')
+        shutil.rmtree(output_dir / 'train', ignore_errors=True)
+        shutil.rmtree(output_dir / 'test', ignore_errors=True)
+
+    dataset = copy.copy(dataset)
+    dataset['training'] = training
+    dataset['numTraining'] = len(training)
+    dataset['numTest'] = len(test)
+    dataset['test'] = [{'image': i['image'].replace('sTr/', 'sTs/'),
+                        'label': i['label'].replace('sTr/', 'sTs/')} for i in test]
     with open(output / 'dataset.json', 'w') as f:
         json.dump(dataset, f)
+    return output
+
+
+def mha2nnunet(cmd: CommandMHA2nnUNet):
+    train_json = _settings_path(cmd, TRAIN_JSON)
+    test_json = _settings_path(cmd, TEST_JSON)
+    if not train_json.exists() or not test_json.exists():
+        generate_mha2nnunet_jsons(cmd)
+    for settings in [train_json, test_json]:
+        # picai_prep reads json settings only
+        if settings.suffix == '.jsonl':
+            jsonl2json(settings, settings.with_suffix('.json'))
+
+    crops = None
+    if cmd.crop_margin > 0:
+        crops = crop_cases(cmd)
+
+    if cmd.queue_dir:
+        output_dirs = [shard_dir(cmd.out_dir, i) for i in range(cmd.shards)]
+        distribute(cmd)
+    else:
+        output_dirs = [cmd.out_dir]
+        _convert(cmd, cmd.out_dir, cmd.out_dir / TRAIN_JSON, cmd.out_dir / TEST_JSON)
+        if cmd.fingerprint:
+            _fingerprint(cmd, cmd.out_dir)
+
+    output = _merge_tasks(cmd, output_dirs)
+    if cmd.fingerprint:
+        fingerprint_dirs = [output_dir / FINGERPRINTS_DIR for output_dir in output_dirs]
+        dataset = merge_fingerprints(fingerprint_dirs, output / FINGERPRINT_JSON)['dataset']
+        click.echo(f'Fingerprinted {dataset["cases"]} training cases to {output / FINGERPRINT_JSON}')
+        for fingerprint_dir in fingerprint_dirs:
+            shutil.rmtree(fingerprint_dir, ignore_errors=True)
+    if cmd.queue_dir:
+        shutil.rmtree(cmd.out_dir / SHARDS_DIR)
+
+    if crops is not None:
+        # crop offsets, to paste predictions back with intervention.crop.paste_back
+        with open(output / CROPS_JSON, 'w') as f:
+            json.dump(crops, f, indent=4)
+        shutil.rmtree(cmd.out_dir / 'crop')
 
-    shutil.rmtree(train)
-    shutil.rmtree(test)
\ No newline at end of file
+    if cmd.patch_store:
+        click.echo(f'Writing patch store to {output / "patches"}')
+        for split in ['Tr', 'Ts']:
+            write_patch_store(output, output / 'patches', split)
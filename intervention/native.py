@@ -0,0 +1,137 @@
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+import click, numpy as np, SimpleITK as sitk
+from tqdm import tqdm
+
+from intervention.utils import CommandNative, dataset_json, read_archive
+from intervention.cache import image_header
+from intervention.writer import write_image
+
+# settings of the mha2nnunet converter, naming the source scans of each case
+SETTINGS_JSONS = ['mha2nnunet_train_settings.json', 'mha2nnunet_test_settings.json']
+SEGMENTATION_JSON = '.seg.json'
+SEGMENTATION_NPZ = '.seg.npz'
+# display colour per label of dataset_json
+COLORS = {1: [255, 255, 0], 2: [255, 0, 0]}
+
+# per process, reused for every case
+_resampler: Optional[sitk.ResampleImageFilter] = None
+
+
+def sources(nnunet_dir: Path, mha_dir: Path) -> Dict[str, Path]:
+    """first scan of each case of the mha2nnunet settings in nnunet_dir"""
+    cases = {}
+    for settings_json in SETTINGS_JSONS:
+        if (nnunet_dir / settings_json).exists():
+            _, archive = read_archive(nnunet_dir / settings_json)
+            cases.update({f'{a["patient_id"]}_{a["study_id"]}': mha_dir / a['scan_paths'][0] for a in archive})
+    return cases
+
+
+def _init_worker():
+    global _resampler
+    _resampler = sitk.ResampleImageFilter()
+    _resampler.SetInterpolator(sitk.sitkNearestNeighbor)
+    _resampler.SetDefaultPixelValue(0)
+
+
+def resample(prediction: sitk.Image, header: dict) -> sitk.Image:
+    """nearest neighbour resample prediction onto the geometry of header (see intervention.cache.read_header)"""
+    if _resampler is None:
+        _init_worker()
+    resampler = _resampler
+    resampler.SetSize([int(s) for s in header['size']])
+    resampler.SetOutputSpacing(header['spacing'])
+    resampler.SetOutputOrigin(header['origin'])
+    resampler.SetOutputDirection(header['direction'])
+    resampler.SetOutputPixelType(prediction.GetPixelID())
+    label = resampler.Execute(prediction)
+    [label.SetMetaData(k, v) for k, v in header.get('metadata', {}).items()]
+    return label
+
+
+def write_segmentation(label: sitk.Image, path: Path, header: dict) -> int:
+    """
+    DICOM-SEG-like overlay of a label: a bit packed binary frame per segment and slice it occurs in, as path.seg.npz,
+    with the segments, their colours and the referenced series in path.seg.json
+
+    :return: number of frames
+    """
+    array = sitk.GetArrayViewFromImage(label)
+    labels = dataset_json('')['labels']
+    segments, frames, numbers, slices = [], [], [], []
+    for number in range(1, len(labels)):
+        mask = array == number
+        occupied = np.nonzero(mask.any(axis=(1, 2)))[0]
+        if len(occupied):
+            segments.append({'number': number, 'label': labels[str(number)], 'color': COLORS.get(number)})
+            frames.append(np.packbits(mask[occupied], axis=-1))
+            numbers += [number] * len(occupied)
+            slices += occupied.tolist()
+
+    metadata = header.get('metadata', {})
+    with open(path.with_name(path.name + SEGMENTATION_JSON), 'w') as f:
+        json.dump({
+            'rows': label.GetSize()[1],
+            'columns': label.GetSize()[0],
+            'slices': label.GetSize()[2],
+            'spacing': header['spacing'],
+            'origin': header['origin'],
+            'direction': header['direction'],
+            'series_instance_uid': metadata.get('0020|000e', ''),
+            'segments': segments,
+            'frames': len(slices)
+        }, f)
+    empty = np.zeros((0, array.shape[1], (array.shape[2] + 7) // 8), dtype=np.uint8)
+    np.savez(path.with_name(path.name + SEGMENTATION_NPZ), frames=np.concatenate(frames) if frames else empty,
+             segment=np.array(numbers, dtype=np.uint8), slice=np.array(slices, dtype=np.int32))
+    return len(slices)
+
+
+def read_segmentation(path: Path) -> np.ndarray:
+    """label array (z, y, x) of an overlay written by write_segmentation"""
+    with open(path.with_name(path.name + SEGMENTATION_JSON)) as f:
+        meta = json.load(f)
+    data = np.load(path.with_name(path.name + SEGMENTATION_NPZ))
+    array = np.zeros((meta['slices'], meta['rows'], meta['columns']), dtype=np.uint8)
+    frames = np.unpackbits(data['frames'], axis=-1, count=meta['columns']).astype(bool)
+    for frame, number, z in zip(frames, data['segment'], data['slice']):
+        array[z][frame] = number
+    return array
+
+
+def _backproject(prediction: Path, header: dict, out_dir: Path, level: int, overlay: bool) -> int:
+    label = resample(sitk.ReadImage(str(prediction)), header)
+    name = prediction.name[:-len('.nii.gz')]
+    write_image(label, out_dir / prediction.name, level=level, threads=1)
+    if overlay:
+        write_segmentation(label, out_dir / name, header)
+    return int(np.prod(header['size']))
+
+
+def backproject(cmd: CommandNative) -> int:
+    """
+    Resample the predictions of cmd.in_dir onto the geometry of their source scans, from the scan headers only,
+    in a process pool whose workers each reuse one resampler.
+
+    :return: number of predictions written
+    """
+    cases = sources(cmd.nnunet_dir, cmd.mha_dir)
+    predictions = {p: cases.get(p.name[:-len('.nii.gz')]) for p in sorted(cmd.in_dir.glob('*.nii.gz'))}
+    if missing := [p.name for p, source in predictions.items() if source is None]:
+        click.echo(f'{len(missing)} predictions without a source scan in {cmd.nnunet_dir}, e.g. {missing[0]}')
+    predictions = {p: source for p, source in predictions.items() if source is not None}
+
+    with ThreadPoolExecutor(max_workers=cmd.workers) as pool:
+        headers = list(pool.map(lambda source: image_header(source, cmd.cache), predictions.values()))
+
+    click.echo(f'Resampling {len(predictions)} predictions of\n\t{cmd.in_dir}\nto their scans in\n\t{cmd.mha_dir}')
+    with ProcessPoolExecutor(max_workers=cmd.workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(_backproject, p, h, cmd.out_dir, cmd.compression_level, cmd.overlays)
+                   for p, h in zip(predictions, headers)]
+        voxels = sum(f.result() for f in tqdm(futures))
+    click.echo(f'Wrote {len(futures)} native labels ({voxels / 1e6:.1f} M voxels) to {cmd.out_dir}')
+    return len(futures)
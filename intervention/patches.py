@@ -0,0 +1,127 @@
+import json
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np, SimpleITK as sitk
+from tqdm import tqdm
+
+from intervention.metrics import work_item
+
+INDEX_JSON = 'index{split}.json'
+IMAGES_NPY = 'images{split}.npy'
+LABELS_NPY = 'labels{split}.npy'
+
+
+def _cases(task_dir: Path, split: str) -> List[Tuple[str, Path, Path]]:
+    cases = []
+    for image in sorted((task_dir / f'images{split}').glob('*_0000.nii.gz')):
+        case = image.name[:-len('_0000.nii.gz')]
+        cases.append((case, image, task_dir / f'labels{split}' / f'{case}.nii.gz'))
+    return cases
+
+
+def write_patch_store(task_dir: Path, out_dir: Path, split: str = 'Tr') -> Path:
+    """
+    Store all cases of an nnUNet task split in one contiguous, memory-mappable array of their first modality
+    (case_0000.nii.gz) and one of their labels. All cases must share the pixel type of the first.
+
+    :param task_dir: nnUNet task directory with images{split} and labels{split}
+    :param out_dir: receives images{split}.npy, labels{split}.npy and index{split}.json
+    :param split: Tr or Ts
+    :return: path to the index json
+    """
+    cases = _cases(task_dir, split)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # headers only, to allocate the store
+    reader = sitk.ImageFileReader()
+    shapes, pixel_id = [], None
+    for case, image, _ in cases:
+        reader.SetFileName(str(image))
+        reader.ReadImageInformation()
+        shapes.append(tuple(reversed(reader.GetSize())))
+        pixel_id = pixel_id if pixel_id is not None else reader.GetPixelID()
+        if reader.GetPixelID() != pixel_id:
+            raise ValueError(f'{case} is {sitk.GetPixelIDValueAsString(reader.GetPixelID())}, the store has the '
+                             f'pixel type of {cases[0][0]}')
+    dtype = None if pixel_id is None else \
+        sitk.GetArrayFromImage(sitk.Image([1] * reader.GetDimension(), pixel_id)).dtype
+    sizes = [int(np.prod(s)) for s in shapes]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+
+    images = np.lib.format.open_memmap(out_dir / IMAGES_NPY.format(split=split), mode='w+',
+                                       dtype=dtype or np.float32, shape=(int(offsets[-1]),))
+    labels = np.lib.format.open_memmap(out_dir / LABELS_NPY.format(split=split), mode='w+',
+                                       dtype=np.uint8, shape=(int(offsets[-1]),))
+
+    index = []
+    for (case, image, label), shape, offset, size in tqdm(zip(cases, shapes, offsets, sizes), total=len(cases)):
+        with work_item(case):
+            images[offset:offset + size] = sitk.GetArrayFromImage(sitk.ReadImage(str(image))).ravel()
+            if label.exists():
+                labels[offset:offset + size] = sitk.GetArrayFromImage(sitk.ReadImage(str(label))).ravel()
+            counts = np.bincount(labels[offset:offset + size], minlength=3)
+            index.append({'case': case, 'offset': int(offset), 'shape': list(shape),
+                          'label_voxels': {str(i): int(c) for i, c in enumerate(counts) if i > 0}})
+    images.flush()
+    labels.flush()
+
+    index_json = out_dir / INDEX_JSON.format(split=split)
+    with open(index_json, 'w') as f:
+        json.dump({'split': split, 'dtype': np.dtype(dtype or np.float32).str, 'cases': index}, f, indent=4)
+    return index_json
+
+
+class PatchStore:
+    def __init__(self, store_dir: Path, split: str = 'Tr'):
+        """
+        Random access to a patch store written by write_patch_store
+
+        :param store_dir: directory with images{split}.npy, labels{split}.npy and index{split}.json
+        """
+        with open(store_dir / INDEX_JSON.format(split=split)) as f:
+            self.index = json.load(f)['cases']
+        self._images = np.load(store_dir / IMAGES_NPY.format(split=split), mmap_mode='r')
+        self._labels = np.load(store_dir / LABELS_NPY.format(split=split), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def cases(self) -> List[str]:
+        return [c['case'] for c in self.index]
+
+    def case(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """zero-copy (z, y, x) image and label of case i"""
+        c = self.index[i]
+        size = int(np.prod(c['shape']))
+        offset = c['offset']
+        return self._images[offset:offset + size].reshape(c['shape']), \
+            self._labels[offset:offset + size].reshape(c['shape'])
+
+    def sample(self, patch_size: Tuple[int, int, int], rng: np.random.Generator,
+               foreground: float = 0.33) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Random (z, y, x) patch, zero padded where it exceeds the case
+
+        :param foreground: probability that the patch is centred on a labelled voxel, if the case has any
+        """
+        i = int(rng.integers(len(self)))
+        image, label = self.case(i)
+        patch_size = np.array(patch_size)
+
+        if rng.random() < foreground and sum(self.index[i]['label_voxels'].values()) > 0:
+            voxels = np.flatnonzero(label)
+            centre = np.array(np.unravel_index(rng.choice(voxels), label.shape))
+        else:
+            centre = np.array([rng.integers(s) for s in label.shape])
+
+        start = centre - patch_size // 2
+        src = tuple(slice(max(0, a), min(s, a + p)) for a, p, s in zip(start, patch_size, label.shape))
+        dst = tuple(slice(r.start - a, r.stop - a) for r, a in zip(src, start))
+
+        patch_image = np.zeros(patch_size, dtype=image.dtype)
+        patch_label = np.zeros(patch_size, dtype=label.dtype)
+        patch_image[dst] = image[src]
+        patch_label[dst] = label[src]
+        return patch_image, patch_label
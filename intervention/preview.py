@@ -0,0 +1,40 @@
+import os, threading
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np, SimpleITK as sitk
+
+# intensity window, in percentiles of the volume
+WINDOW = (0.5, 99.5)
+
+
+def preview(image: sitk.Image, factor: int = 2, window: Tuple[float, float] = WINDOW) -> sitk.Image:
+    """
+    Reduced volume to annotate in place of image: averaged over factor x factor voxels in-plane, windowed to uint8.
+    The preview has the physical geometry of image (up to a partial bin at the far edges), such that a physical
+    point placed on the preview is the same point on image.
+
+    :param factor: in-plane (x, y) downsampling factor, 1 only windows
+    :param window: lower and upper intensity percentiles mapped to 0 and 255
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    lower, upper = np.percentile(array, window) if array.size else (0, 0)
+    upper = upper if upper > lower else lower + 1
+
+    # BinShrink averages bins and moves the origin to the centre of the first bin, keeping the physical extent
+    shrunk = sitk.BinShrink(sitk.Cast(image, sitk.sitkFloat32), [factor, factor] + [1] * (image.GetDimension() - 2))
+    windowed = sitk.IntensityWindowing(shrunk, float(lower), float(upper), 0, 255)
+    result = sitk.Cast(windowed, sitk.sitkUInt8)
+    for key in image.GetMetaDataKeys():
+        result.SetMetaData(key, image.GetMetaData(key))
+    return result
+
+
+def write_preview(path: Path, out: Path, factor: int = 2, window: Tuple[float, float] = WINDOW) -> Path:
+    """write the compressed preview of the image at path to out, unless out exists"""
+    out = Path(out)
+    if not out.exists():
+        tmp = out.with_name(f'.{out.name}.{os.getpid()}.{threading.get_ident()}.tmp{out.suffix}')
+        sitk.WriteImage(preview(sitk.ReadImage(str(path)), factor, window), str(tmp), useCompression=True)
+        tmp.replace(out)
+    return out
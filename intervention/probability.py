@@ -0,0 +1,173 @@
+import json, zipfile
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from intervention.metrics import work_item
+
+PROBABILITY_NPY = '.prob.npy'
+PROBABILITY_JSON = '.prob.json'
+
+_scales = {'uint8': 255, 'float16': 1}
+
+
+def _paths(path: Path) -> Tuple[Path, Path]:
+    name = Path(path).name.split('.')[0]
+    return Path(path).with_name(name + PROBABILITY_NPY), Path(path).with_name(name + PROBABILITY_JSON)
+
+
+def save_probabilities(softmax: np.ndarray, path: Path, dtype: str = 'uint8', crop: bool = True) -> Path:
+    """
+    Store a (C, Z, Y, X) softmax array as quantized foreground channels in a memory-mappable .npy file.
+    The background channel is dropped, it is recovered as 1 - sum(foreground).
+
+    :param softmax: softmax probabilities, channel 0 is background
+    :param path: output path, the suffix is replaced by .prob.npy (and .prob.json for the header)
+    :param dtype: uint8 or float16
+    :param crop: crop to the bounding box of all voxels with a nonzero quantized foreground probability
+    """
+    if dtype not in _scales:
+        raise ValueError(f'unknown dtype: {dtype}')
+    scale = _scales[dtype]
+
+    foreground = np.asarray(softmax[1:], dtype=np.float32)
+    if dtype == 'uint8':
+        stored = np.rint(np.clip(foreground, 0, 1) * scale).astype(np.uint8)
+    else:
+        stored = foreground.astype(np.float16)
+
+    bbox = [[0, s] for s in stored.shape[1:]]
+    if crop:
+        nonzero = stored.any(axis=0)
+        if nonzero.any():
+            for axis in range(3):
+                other = tuple(a for a in range(3) if a != axis)
+                indices, = np.nonzero(nonzero.any(axis=other))
+                bbox[axis] = [int(indices[0]), int(indices[-1]) + 1]
+        else:
+            bbox = [[0, 0] for _ in range(3)]
+        stored = stored[(slice(None),) + tuple(slice(a, b) for a, b in bbox)]
+
+    npy, header = _paths(path)
+    np.save(npy, np.ascontiguousarray(stored))
+    with open(header, 'w') as f:
+        json.dump({'shape': list(softmax.shape), 'bbox': bbox, 'dtype': dtype, 'scale': scale}, f)
+    return npy
+
+
+class ProbabilityMap:
+    def __init__(self, path: Path):
+        """
+        Lazily opened probability map, written by save_probabilities.
+
+        :param path: path to the .prob.npy (or .prob.json) file
+        """
+        npy, header = _paths(path)
+        with open(header) as f:
+            header = json.load(f)
+        self.shape: Tuple[int, ...] = tuple(header['shape'])
+        self.bbox: List[List[int]] = header['bbox']
+        self.dtype: str = header['dtype']
+        self.scale: int = header['scale']
+        self._data = np.load(npy, mmap_mode='r')
+
+    @property
+    def labels(self) -> int:
+        return self.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    def _check_label(self, label: int):
+        if not 0 < label < self.labels:
+            raise IndexError(f'label must be between 1 and {self.labels - 1}')
+
+    def _full(self, label: int, z: slice) -> np.ndarray:
+        z = range(*z.indices(self.shape[1]))
+        out = np.zeros((len(z),) + self.shape[2:], dtype=np.float32)
+        (z0, z1), (y0, y1), (x0, x1) = self.bbox
+        inside = [(i, k) for i, k in enumerate(z) if z0 <= k < z1]
+        if inside:
+            i, k = zip(*inside)
+            data = self._data[label - 1, [j - z0 for j in k]]
+            out[list(i), y0:y1, x0:x1] = data.astype(np.float32) / self.scale
+        return out
+
+    def slice(self, label: int, z: int) -> np.ndarray:
+        """Probability of label in slice z, only reading that slice from disk."""
+        self._check_label(label)
+        return self._full(label, slice(z, z + 1))[0]
+
+    def channel(self, label: int) -> np.ndarray:
+        """Full (Z, Y, X) probabilities of label."""
+        self._check_label(label)
+        return self._full(label, slice(None))
+
+    def threshold(self, label: int, t: float) -> np.ndarray:
+        """Boolean (Z, Y, X) mask of label with probability >= t, computed in the stored dtype."""
+        self._check_label(label)
+        mask = np.zeros(self.shape[1:], dtype=bool)
+        if t <= 0:
+            mask[:] = True
+            return mask
+        (z0, z1), (y0, y1), (x0, x1) = self.bbox
+        mask[z0:z1, y0:y1, x0:x1] = self._data[label - 1] >= self._quantize(t)
+        return mask
+
+    def voxel_counts(self, label: int, thresholds: Iterable[float]) -> List[int]:
+        """Number of voxels with probability >= t for each t, in a single pass over the stored data."""
+        self._check_label(label)
+        thresholds = list(thresholds)
+        total = int(np.prod(self.shape[1:]))
+        data = self._data[label - 1]
+        if self.dtype == 'uint8':
+            above = np.cumsum(np.bincount(data.ravel(), minlength=256)[::-1])[::-1]
+            get = lambda q: int(above[q]) if q < 256 else 0
+        else:
+            values = np.sort(data.ravel())
+            get = lambda q: int(values.size - np.searchsorted(values, q, side='left'))
+        return [total if t <= 0 else get(self._quantize(t)) for t in thresholds]
+
+    def _quantize(self, t: float):
+        if self.dtype == 'uint8':
+            return int(np.ceil(t * self.scale - 1e-6))
+        return np.float16(t)
+
+
+def npz_bytes(npz: Path, key: str = 'softmax') -> int:
+    """decompressed size of an array in an .npz file, from its header only"""
+    with zipfile.ZipFile(npz) as z, z.open(f'{key}.npy') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, dtype = read_header(f)
+    return int(np.prod(shape)) * dtype.itemsize
+
+
+def compact_probabilities(in_dir: Path, dtype: str = 'uint8', crop: bool = True, remove: bool = True,
+                          scheduler: 'Scheduler' = None) -> int:
+    """
+    Replace nnUNet softmax .npz files (--save_npz) in in_dir by compact .prob.npy files
+
+    :param scheduler: compact files in parallel, within its memory budget
+    :return: bytes saved
+    """
+    def _compact(npz: Path) -> int:
+        with work_item(npz.name):
+            with np.load(npz) as f:
+                softmax = f['softmax']
+            npy = save_probabilities(softmax, npz, dtype=dtype, crop=crop)
+            saved = npz.stat().st_size - npy.stat().st_size
+            if remove:
+                npz.unlink()
+            return saved
+
+    npzs = sorted(Path(in_dir).glob('*.npz'))
+    if scheduler is None:
+        return sum(_compact(npz) for npz in tqdm(npzs, total=len(npzs)))
+
+    # the softmax and its foreground, scaled and converted
+    results = scheduler.map(_compact, npzs, lambda npz: 3 * npz_bytes(npz))
+    return sum(future.result() for _, future in tqdm(results, total=len(npzs)))
@@ -0,0 +1,89 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Tuple, TypeVar
+
+import numpy as np
+
+from intervention.cache import image_header
+
+T = TypeVar('T')
+
+
+def available_memory() -> int:
+    """available physical memory in bytes"""
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f)
+        return int(meminfo['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def image_bytes(path: Path, cache: 'VolumeCache' = None, dtype: np.dtype = None) -> int:
+    """
+    Decompressed size of an image, from its header only
+
+    :param cache: read the header through this volume cache
+    :param dtype: size of an image of the same geometry with this pixel type instead, e.g. np.uint8 for a label
+    """
+    return header_bytes(image_header(path, cache), dtype)
+
+
+def header_bytes(header: dict, dtype: np.dtype = None) -> int:
+    """decompressed size of an image with header (see intervention.cache.read_header), optionally of another dtype"""
+    itemsize = np.dtype(dtype).itemsize if dtype else np.dtype(header['dtype']).itemsize * header['components']
+    return int(np.prod(header['size'])) * itemsize
+
+
+class Scheduler:
+    def __init__(self, memory_budget: float = None, workers: int = None):
+        """
+        Thread pool that admits work items by their estimated memory, largest first, such that the estimates of the
+        items in flight stay within a memory budget. An item larger than the budget runs alone.
+
+        :param memory_budget: bytes, defaults to 80% of the available memory
+        :param workers: threads, defaults to the cpu count
+        """
+        self.memory_budget = memory_budget or 0.8 * available_memory()
+        self.workers = workers or os.cpu_count() or 1
+        self.peak = 0
+
+    def map(self, func: Callable[[T], object], items: Iterable[T], estimate: Callable[[T], int],
+            initializer: Callable = None) -> Iterator[Tuple[T, Future]]:
+        """
+        Run func on all items
+
+        :param estimate: peak memory in bytes of func(item), e.g. from image headers
+        :param initializer: called by each worker thread when it starts
+        :return: (item, future) in order of completion
+        """
+        def _estimate(item: T) -> int:
+            try:
+                return estimate(item)
+            except Exception:
+                return 0  # func reports the error, e.g. an unreadable image
+
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=self.workers, initializer=initializer) as pool:
+            estimates = list(pool.map(_estimate, items))
+            queue = deque(sorted(zip(estimates, range(len(items))), key=lambda e: -e[0]))
+
+            running, used = {}, 0
+
+            def admit() -> bool:
+                return len(running) < self.workers and (not running or used + queue[0][0] <= self.memory_budget)
+
+            while queue or running:
+                while queue and admit():
+                    size, i = queue.popleft()
+                    running[pool.submit(func, items[i])] = (i, size)
+                    used += size
+                    self.peak = max(self.peak, used)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, size = running.pop(future)
+                    used -= size
+                    yield items[i], future
@@ -0,0 +1,209 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np, SimpleITK as sitk
+
+# tfi2d-like needle scans: few thick slices, fine in-plane resolution
+SHAPE = (5, 256, 256)
+SPACING = (0.9, 0.9, 3.0)
+QUESTIONS = ['No needle', 'Casing', 'Needle', 'Tip']
+MAPPINGS = {"needle": {"SeriesDescription": ["needle"]}}
+
+
+def _uid(rng: np.random.Generator) -> str:
+    return '1.3.6.1.4.1.9590.' + '.'.join(str(rng.integers(1, 10 ** 9)) for _ in range(3))
+
+
+def _oblique_direction(rng: np.random.Generator, max_angle: float = 30) -> Tuple[float, ...]:
+    angles = np.deg2rad(rng.uniform(-max_angle, max_angle, size=3))
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    Rx = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    Ry = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    Rz = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    return tuple((Rz @ Ry @ Rx).flatten())
+
+
+def synthetic_image(rng: np.random.Generator, shape: Tuple[int, int, int] = SHAPE,
+                    spacing: Tuple[float, float, float] = SPACING) -> Tuple[sitk.Image, List[np.ndarray]]:
+    """
+    Noisy oblique volume with a bright needle
+
+    :param shape: (z, y, x)
+    :return: image and the physical base, needle and tip points of the drawn needle
+    """
+    array = rng.normal(100, 20, size=shape).clip(0).astype(np.int16)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing(spacing)
+    image.SetDirection(_oblique_direction(rng))
+    image.SetOrigin(tuple(rng.uniform(-150, 150, size=3)))
+
+    # needle lies in the centre slice, entering from an image border
+    z = shape[0] // 2
+    size = np.array(shape[:0:-1])
+    start = np.array([rng.uniform(0.05, 0.15), rng.uniform(0.2, 0.8)]) * size
+    direction = np.array([1.0, rng.uniform(-0.5, 0.5)])
+    direction /= np.linalg.norm(direction)
+    length = rng.uniform(0.4, 0.7) * size[0]
+    indices = [start, start + direction * length * 0.3, start + direction * length]
+
+    for t in np.linspace(0, 1, int(length) * 2):
+        x, y = np.rint(start + direction * length * t).astype(int)
+        if 0 <= x < shape[2] and 0 <= y < shape[1]:
+            array[z, y, x] = 600
+    image = _with_array(image, array)
+
+    points = [np.array(image.TransformContinuousIndexToPhysicalPoint((float(x), float(y), float(z))))
+              for x, y in indices]
+    return image, points
+
+
+def _with_array(reference: sitk.Image, array: np.ndarray) -> sitk.Image:
+    image = sitk.GetImageFromArray(array)
+    image.CopyInformation(reference)
+    return image
+
+
+def write_dicom_series(image: sitk.Image, series_dir: Path, tags: Dict[str, str], rng: np.random.Generator):
+    """Write image as a DICOM series, one file per slice"""
+    series_dir.mkdir(parents=True, exist_ok=True)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    direction = image.GetDirection()
+    orientation = '\\'.join(str(v) for v in (direction[0], direction[3], direction[6],
+                                              direction[1], direction[4], direction[7]))
+    for z in range(image.GetDepth()):
+        s = image[:, :, z]
+        for k, v in tags.items():
+            s.SetMetaData(k, v)
+        s.SetMetaData('0008|0060', 'MR')
+        s.SetMetaData('0008|0018', _uid(rng))
+        s.SetMetaData('0018|0050', str(image.GetSpacing()[2]))
+        s.SetMetaData('0020|0037', orientation)
+        s.SetMetaData('0020|0032', '\\'.join(str(p) for p in image.TransformIndexToPhysicalPoint((0, 0, z))))
+        s.SetMetaData('0020|0013', str(z + 1))
+        writer.SetFileName(str(series_dir / f'{z + 1:04d}.dcm'))
+        writer.Execute(s)
+
+
+class SyntheticGC:
+    def __init__(self, answers_json: Path, slug: str = 'synthetic'):
+        """
+        Stand-in for GCAPI, serving answers written by generate
+
+        :param answers_json: fake GC answers
+        """
+        with open(answers_json) as f:
+            gc = json.load(f)
+        self.slug = slug
+        self._questions = gc['questions']
+        self._answers = gc['answers']
+        self._display_sets = gc['display_sets']
+        self._cases = gc['cases']
+
+    def image(self, display_set):
+        ds = self.display_sets[display_set]
+        img = None
+        for d in ds['values']:
+            if d['interface']['slug'] == 'generic-medical-image':
+                img = d['image']
+        return self.cases[img]['name']
+
+    @property
+    def questions(self):
+        return self._questions
+
+    @property
+    def answers(self):
+        return self._answers
+
+    @property
+    def display_sets(self):
+        return self._display_sets
+
+    @property
+    def cases(self):
+        return self._cases
+
+
+def gc_answers(names: List[str], points: List[List[np.ndarray]], no_needle: List[bool], readers: int = 1,
+               jitter: float = 1, seed: int = 0) -> dict:
+    """
+    GC questions, answers, display sets and images (cases) of named images with base, needle and tip points
+
+    :param readers: readers answering each image, the first ('synthetic') places the points exactly, the others
+    ('reader1', ...) up to jitter mm off in each axis
+    """
+    rng = np.random.default_rng(seed)
+    api = 'https://grand-challenge.org/api/v1'
+    questions = {f'{api}/reader-studies/questions/{i}/': {'api_url': f'{api}/reader-studies/questions/{i}/',
+                                                          'question_text': q}
+                 for i, q in enumerate(QUESTIONS)}
+    q_urls = list(questions.keys())
+
+    answers, display_sets, cases = {}, {}, {}
+    for i, (name, P, nn) in enumerate(zip(names, points, no_needle)):
+        image = f'{api}/cases/images/{i}/'
+        display_set = f'{api}/reader-studies/display-sets/{i}/'
+        cases[image] = {'api_url': image, 'pk': i, 'name': name}
+        display_sets[display_set] = {'api_url': display_set, 'pk': i, 'values': [
+            {'interface': {'slug': 'generic-medical-image'}, 'image': image}]}
+
+        for reader in range(readers):
+            offset = rng.uniform(-jitter, jitter, size=(len(P), 3)) if reader else np.zeros((len(P), 3))
+            values = [nn] + ([] if nn else [{'type': 'Point', 'point': list(map(float, p + o))}
+                                            for p, o in zip(P, offset)])
+            for q, value in zip(q_urls, values):
+                url = f'{api}/reader-studies/answers/{len(answers)}/'
+                answers[url] = {'api_url': url, 'pk': len(answers), 'creator': f'reader{reader}' if reader else
+                                'synthetic', 'display_set': display_set, 'question': q, 'answer': value}
+    return {'questions': questions, 'answers': answers, 'display_sets': display_sets, 'cases': cases}
+
+
+def generate(out_dir: Path, patients: int = 2, studies: int = 1, series: int = 2, no_needle: float = 0.2,
+             shape: Tuple[int, int, int] = SHAPE, seed: int = 0, readers: int = 1) -> Dict[str, Path]:
+    """
+    Generate a synthetic archive: DICOM series, their MHA conversions and matching GC answers.
+
+    :param out_dir: output directory, receives archive/, mha/ and gc_answers.json
+    :param patients: number of patients
+    :param studies: studies per patient
+    :param series: needle series per study
+    :param no_needle: fraction of series answered with 'No needle'
+    :param shape: (z, y, x) of each series
+    :param readers: readers answering each series, see gc_answers
+    :return: paths to the archive and mha directories and answers json
+    """
+    rng = np.random.default_rng(seed)
+    archive_dir, mha_dir = out_dir / 'archive', out_dir / 'mha'
+    names, points, no_needles = [], [], []
+
+    for p in range(patients):
+        patient_id = f'{10000 + p}'
+        for _ in range(studies):
+            study_uid = _uid(rng)
+            study_id = study_uid.split('.')[-1]
+            for s in range(series):
+                image, P = synthetic_image(rng, shape=shape)
+                series_uid = _uid(rng)
+                tags = {'0010|0010': f'Synthetic^{patient_id}', '0010|0020': patient_id,
+                        '0020|000d': study_uid, '0020|000e': series_uid, '0020|0011': str(s + 1),
+                        '0008|103e': f'needle tfi2d {s}'}
+                write_dicom_series(image, archive_dir / patient_id / study_uid / series_uid, tags, rng)
+
+                for k, v in tags.items():
+                    image.SetMetaData(k, v)
+                name = f'{patient_id}_{study_id}_needle_{s}.mha'
+                (mha_dir / patient_id).mkdir(parents=True, exist_ok=True)
+                sitk.WriteImage(image, str(mha_dir / patient_id / name), useCompression=True)
+
+                names.append(name)
+                points.append(P)
+                no_needles.append(bool(rng.random() < no_needle))
+
+    answers_json = out_dir / 'gc_answers.json'
+    with open(answers_json, 'w') as f:
+        json.dump(gc_answers(names, points, no_needles, readers, seed=seed), f)
+
+    return {'archive': archive_dir, 'mha': mha_dir, 'answers': answers_json}
@@ -0,0 +1,124 @@
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+import numpy as np, SimpleITK as sitk
+
+from intervention.probability import ProbabilityMap, PROBABILITY_JSON
+
+# labels of dataset_json
+NEEDLE, TIP = 1, 2
+TIPS_CSV = 'tips.csv'
+
+
+class Needle(NamedTuple):
+    tip: np.ndarray  # physical x, y, z in mm
+    entry: np.ndarray  # the other end of the needle
+    direction: np.ndarray  # unit vector from entry to tip
+    length: float  # mm between entry and tip
+    voxels: int  # of the largest needle component
+    components: int  # needle components found, the largest is used
+
+    @property
+    def azimuth(self) -> float:
+        """degrees of the direction in the physical x-y plane, from the x axis"""
+        return float(np.degrees(np.arctan2(self.direction[1], self.direction[0])))
+
+    @property
+    def elevation(self) -> float:
+        """degrees of the direction out of the physical x-y plane"""
+        return float(np.degrees(np.arcsin(np.clip(self.direction[2], -1, 1))))
+
+
+def _physical(image: sitk.Image, indices: np.ndarray) -> np.ndarray:
+    """physical points of (N, 3) (z, y, x) array indices, all at once"""
+    direction = np.array(image.GetDirection()).reshape(3, 3)
+    return (indices[:, ::-1] * np.array(image.GetSpacing())) @ direction.T + np.array(image.GetOrigin())
+
+
+def localize(label: sitk.Image, mask: np.ndarray = None) -> Optional[Needle]:
+    """
+    Needle tip and trajectory of a label map (NEEDLE and TIP labels): the largest connected component of all needle
+    voxels is fit with its principal axis in physical space, the tip is the extreme projection on that axis at the
+    TIP end. Without both NEEDLE and TIP voxels the tip is the end nearest the image centre, as needles enter from
+    the image border.
+
+    :param mask: (z, y, x) foreground instead of label > 0, e.g. a thresholded probability; label still tells TIP
+    :return: None if there are no needle voxels
+    """
+    array = sitk.GetArrayViewFromImage(label)
+    foreground = (array > 0) if mask is None else mask
+    if not foreground.any():
+        return None
+
+    components = sitk.RelabelComponent(sitk.ConnectedComponent(sitk.GetImageFromArray(foreground.astype(np.uint8))),
+                                       sortByObjectSize=True)
+    components = sitk.GetArrayFromImage(components)
+    indices = np.argwhere(components == 1)
+    points = _physical(label, indices)
+
+    centre = points.mean(axis=0)
+    if len(points) > 1:
+        axis = np.linalg.svd(points - centre, full_matrices=False)[2][0]
+    else:
+        axis = np.array([1.0, 0, 0])
+    t = (points - centre) @ axis
+
+    labels = array[tuple(indices.T)]
+    tip, needle = labels == TIP, labels == NEEDLE
+    if tip.any() and needle.any():
+        forward = t[tip].mean() > t[needle].mean()
+    else:
+        image_centre = np.array(label.TransformContinuousIndexToPhysicalPoint([(s - 1) / 2 for s in label.GetSize()]))
+        forward = (image_centre - centre) @ axis > 0
+    axis = axis if forward else -axis
+    t = t if forward else -t
+
+    tip_point, entry_point = centre + axis * t.max(), centre + axis * t.min()
+    return Needle(tip_point, entry_point, axis, float(t.max() - t.min()), len(indices), int(components.max()))
+
+
+def localize_file(path: Path, threshold: float = None) -> Optional[Needle]:
+    """
+    :param path: label map, e.g. a .nii.gz prediction
+    :param threshold: use the compacted probabilities next to path (see intervention.probability), foreground is any
+    label with at least this probability
+    """
+    label = sitk.ReadImage(str(path))
+    mask = None
+    name = Path(path).name.split('.')[0]
+    if threshold is not None and (Path(path).parent / (name + PROBABILITY_JSON)).exists():
+        probabilities = ProbabilityMap(Path(path).parent / (name + PROBABILITY_JSON))
+        mask = np.logical_or.reduce([probabilities.threshold(c, threshold) for c in range(1, probabilities.labels)])
+    return localize(label, mask)
+
+
+def localize_dir(in_dir: Path, out_csv: Path = None, threshold: float = None, workers: int = None) -> List[dict]:
+    """
+    Localize the needle of each .nii.gz label map in in_dir and write them as one row per case to out_csv
+
+    :return: the rows
+    """
+    paths = sorted(Path(in_dir).glob('*.nii.gz'))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        needles = list(pool.map(lambda p: localize_file(p, threshold), paths))
+
+    rows = []
+    for path, n in zip(paths, needles):
+        row = {'case': path.name[:-len('.nii.gz')], 'found': n is not None}
+        if n is not None:
+            row.update({f'{k}_{a}': round(float(v), 2) for k, p in [('tip', n.tip), ('entry', n.entry)]
+                        for a, v in zip('xyz', p)})
+            row.update({f'direction_{a}': round(float(v), 4) for a, v in zip('xyz', n.direction)})
+            row.update({'length': round(n.length, 2), 'azimuth': round(n.azimuth, 2),
+                        'elevation': round(n.elevation, 2), 'voxels': n.voxels, 'components': n.components})
+        rows.append(row)
+
+    out_csv = Path(out_csv or Path(in_dir) / TIPS_CSV)
+    fields = max((list(r) for r in rows), key=len, default=['case', 'found'])
+    with open(out_csv, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
@@ -1,12 +1,76 @@
-import os, time, logging, httpx
+import asyncio, hashlib, os, logging, shutil, tempfile, threading, time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import List
 
+import click
 from tqdm import tqdm
 
 from intervention.utils import GCAPI
+from intervention.gcclient import GCError, GCRequestError
 
 
-def upload_data(input: Path, gc: GCAPI, test: bool = False):
+def is_compressed(path: Path) -> bool:
+    """whether an image file is compressed, from the header of .mha/.mhd files"""
+    path = Path(path)
+    if path.suffix.lower() not in ('.mha', '.mhd'):
+        return path.suffix.lower() in ('.gz', '.zip')
+    with open(path, 'rb') as f:
+        for line in f:
+            key, _, value = line.decode(errors='replace').partition('=')
+            if key.strip() == 'CompressedData':
+                return value.strip().lower() == 'true'
+            if key.strip() == 'ElementDataFile':
+                return False
+    return False
+
+
+def _sha1(path: Path) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 24):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def upload_copy(path: Path, cache_dir: Path, level: int = 6) -> Path:
+    """
+    Compressed copy of an uncompressed .mha/.mhd image to upload, cached in cache_dir by the sha1 of its content.
+    Compressed and other images are uploaded as they are.
+    """
+    import SimpleITK as sitk
+
+    if is_compressed(path) or Path(path).suffix.lower() not in ('.mha', '.mhd'):
+        return path
+
+    copy = cache_dir / f'{_sha1(path)}.mha'
+    if not copy.exists():
+        tmp = cache_dir / f'.{copy.name}.{os.getpid()}.{threading.get_ident()}.tmp.mha'
+        sitk.WriteImage(sitk.ReadImage(str(path)), str(tmp), useCompression=True, compressionLevel=level)
+        tmp.replace(copy)
+    return copy
+
+
+def preview_copy(path: Path, cache_dir: Path, factor: int) -> Path:
+    """preview of an image to upload (see intervention.preview), cached in cache_dir by the sha1 of its content"""
+    from intervention.preview import write_preview
+
+    return write_preview(path, cache_dir / f'{_sha1(path)}_preview{factor}.mha', factor)
+
+
+def upload_data(input: Path, gc: GCAPI, test: bool = False, cache_dir: Path = None, level: int = 6,
+                workers: int = None, preview: int = 0) -> List[GCError]:
+    """
+    Upload each mha file to its own display set, concurrently, ordered as found.
+    Uncompressed files are compressed in a background pool first, overlapping with the transfer of other files.
+
+    :param cache_dir: keeps the compressed upload copies for later uploads, by default they are temporary
+    :param level: zlib level of the upload copies
+    :param workers: compression threads (preview processes), defaults to the cpu count
+    :param preview: if > 0, upload uint8 previews downsampled in-plane by this factor in place of the images,
+    generated in a process pool. Answers on previews are in the physical space of the images, so annotate the images.
+    :return: the failed requests
+    """
     files = []
     # Loop through files in the specified directory and add their names to the list
     for root, directories, filenames in os.walk(input):
@@ -20,40 +84,79 @@ def upload_data(input: Path, gc: GCAPI, test: bool = False):
     logging.info(f"Found {total} images (cases) for upload")
     # click.confirm('Confirm to start uploading {total} items', abort=True)
 
-    pks = {}
-    for order, file in tqdm(enumerate(files, 1), total=total):
-        display_set_pk = gc.client.create_display_sets_from_images(
-            reader_study=gc.slug,
-            display_sets=[{"generic-medical-image": [file.absolute().as_posix()]}]
-        )
-        display_set_pk = display_set_pk[0]
+    sizes = {'original': 0, 'sent': 0}
+
+    async def upload(pool: Executor, copies: Path) -> List[GCError]:
+        loop = asyncio.get_running_loop()
+        async with gc.async_client() as client:
+            async def create(order: int, file: Path):
+                try:
+                    if preview:
+                        copy = await loop.run_in_executor(pool, preview_copy, file, copies, preview)
+                    else:
+                        copy = await loop.run_in_executor(pool, upload_copy, file, copies, level)
+                    display_set_pk = await client.create_display_set_from_image(copy, filename=file.name, order=order)
+                    sizes['original'] += file.stat().st_size
+                    sizes['sent'] += copy.stat().st_size
+                    logging.info(f'{display_set_pk}: {file.name} ({order})')
+                except GCRequestError as e:
+                    client.errors.append(e.error)
+                    logging.error(f'{file.name} ({order}): {e}')
+                except Exception as e:
+                    # e.g. an unreadable image, such that the other files are still uploaded
+                    client.errors.append(GCError('UPLOAD', file.as_posix(), None, f'{type(e).__name__}({e})', 1))
+                    logging.error(f'{file.name} ({order}): {type(e).__name__}({e})')
+
+            tasks = [create(order, file) for order, file in enumerate(files, 1)]
+            for task in tqdm(asyncio.as_completed(tasks), total=total):
+                await task
+            return client.errors
 
-        pks[display_set_pk] = {
-            "order": order
-        }
-        logging.info(f'{display_set_pk}: {file.name} ({order})')
-        if order % 100 == 0:
-            time.sleep(60)
+    start = time.perf_counter()
+    copies = Path(cache_dir) if cache_dir else Path(tempfile.mkdtemp(prefix='fastmri_upload_'))
+    copies.mkdir(parents=True, exist_ok=True)
+    try:
+        executor = ProcessPoolExecutor if preview else ThreadPoolExecutor
+        with executor(max_workers=workers or os.cpu_count() or 1) as pool:
+            errors = asyncio.run(upload(pool, copies))
+    finally:
+        if not cache_dir:
+            shutil.rmtree(copies)
+    seconds = time.perf_counter() - start
 
-    logging.info("Upload complete ...")
-    time.sleep(60)
+    summary = (f"Uploaded {total - len(errors)} of {total} images in {seconds:.0f} s: "
+               f"{sizes['original'] / 1e6 / seconds:.1f} MB/s effective, "
+               f"{sizes['sent'] / 1e6 / seconds:.1f} MB/s sent, "
+               f"{(sizes['original'] - sizes['sent']) / 1e6:.1f} MB saved by {'preview' if preview else 'compression'}")
+    logging.info(summary)
+    click.echo(summary)
 
-    logging.info(f"Ordering {total} display sets")
-    for pk in tqdm(pks.keys(), total=total):
-        gc.client.reader_studies.display_sets.partial_update(pk, **pks[pk])
+    gc.invalidate('display_sets', 'cases')
+    return errors
 
 
-def delete_all_data(gc: GCAPI):
-    display_sets = gc.display_sets
-    for display_set in display_sets.values():
-        try:
-            gc.client.reader_studies.display_sets.delete(display_set['pk'])
-        except httpx.HTTPStatusError as e:
-            continue
+def delete_all_data(gc: GCAPI) -> List[GCError]:
+    """
+    Delete all display sets of the reader study, concurrently
+
+    :return: the failed deletes
+    """
+    async def delete() -> List[GCError]:
+        async with gc.async_client() as client:
+            display_sets = await client.display_sets()
+            deleted = await client.delete_display_sets(ds['pk'] for ds in display_sets.values())
+            logging.info(f'Deleted {deleted} of {len(display_sets)} display sets')
+            return client.errors
+
+    errors = asyncio.run(delete())
+    for e in errors:
+        logging.error(f'Delete failed: {e}')
+
+    gc.invalidate('display_sets', 'cases', 'answers')
+    return errors
 
 
 if __name__ == '__main__':
     with open('tests/input/api.txt') as f:
         api_key = f.readline()
     delete_all_data(GCAPI('needle-segmentation-for-interventional-radiology', api_key))
-
@@ -1,16 +1,28 @@
-import httpx, logging, json, copy, os
+import logging, json, copy, os, threading
 from pathlib import Path
 from datetime import datetime
-from typing import Callable, Dict, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Optional
 
-from box import Box
-import gcapi, jsonschema
+import jsonschema
+
+# settings left out of work queue tasks, with the environment variable workers read them from otherwise
+SECRETS = {'gc_api': 'GC_API_KEY'}
 
 
 def now() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
 
 
+def read_secrets(settings_json: Path = None) -> dict:
+    """SECRETS of the commands of a settings file, else of the environment"""
+    secrets = {k: os.environ[env] for k, env in SECRETS.items() if os.environ.get(env)}
+    if settings_json:
+        with open(settings_json) as f:
+            for cmd in json.load(f)['commands']:
+                secrets.update({k: cmd[k] for k in SECRETS if cmd.get(k)})
+    return secrets
+
+
 def dataset_json(task_dirname: str):
     return {
         "description": "Segmentation model for NeedleNet",
@@ -31,6 +43,8 @@ def dataset_json(task_dirname: str):
 
 
 def walk_archive(in_dir: Path, endswith: str, add_func: Callable[[Path, str], Dict]) -> set:
+    from box import Box
+
     archive = set()
     for dirpath, dirnames, filenames in os.walk(in_dir):
         for fn in [f for f in filenames if f.endswith(endswith)]:
@@ -40,6 +54,61 @@ def walk_archive(in_dir: Path, endswith: str, add_func: Callable[[Path, str], Di
     return archive
 
 
+def write_jsonl_archive(path: Path, header: dict, archive: Iterable[dict]) -> int:
+    """
+    Stream archive items to JSON Lines, the first line is {"header": header}
+
+    :param header: all settings except the archive, e.g. options and mappings
+    :return: number of archive items written
+    """
+    n = 0
+    with open(path, 'w') as f:
+        f.write(json.dumps({'header': header}) + '\n')
+        for item in archive:
+            f.write(json.dumps(item) + '\n')
+            n += 1
+    return n
+
+
+def read_archive(path: Path) -> Tuple[dict, Iterator[dict]]:
+    """
+    Settings and archive of a picai_prep json or JSON Lines settings file, JSON Lines archives are read lazily
+
+    :return: settings without the archive, and an iterator over the archive items
+    """
+    path = Path(path)
+    if path.suffix != '.jsonl':
+        with open(path) as f:
+            settings = json.load(f)
+        archive = settings.pop('archive')
+        return settings, iter(archive)
+
+    with open(path) as f:
+        header = json.loads(f.readline())['header']
+
+    def items():
+        with open(path) as g:
+            g.readline()
+            for line in g:
+                if line.strip():
+                    yield json.loads(line)
+
+    return header, items()
+
+
+def jsonl2json(jsonl: Path, json_path: Path):
+    """Convert a JSON Lines archive to picai_prep json settings, without loading the archive in memory"""
+    header, archive = read_archive(jsonl)
+    with open(json_path, 'w') as f:
+        f.write('{\n')
+        for key, val in header.items():
+            f.write(f'    {json.dumps(key)}: {json.dumps(val)},\n')
+        f.write('    "archive": [')
+        for i, item in enumerate(archive):
+            f.write((',' if i else '') + '\n        ' + json.dumps(item))
+        f.write('\n    ]\n}')
+
+
 class DirectoryManager:
     def __init__(self, base: Path, output_dir: Path, task_name: str, task_id: int):
         """
@@ -74,26 +143,69 @@ class DirectoryManager:
 
 
 class GCAPI:
-    def __init__(self, slug: str, api: str):
-        self.client = gcapi.Client(token=api)
-        self.slug = slug
-
-        try:
-            rs = next(self.client.reader_studies.iterate_all(params={"slug": self.slug}))
-        except httpx.HTTPStatusError as e:
-            raise ConnectionRefusedError(f'Invalid api key!\n\n{e}')
+    def __init__(self, slug: str, api: str, client: Callable[[], 'gcapi.Client'] = None, base_url: str = None):
+        """
+        Grand Challenge reader study, connects on first use
 
-        self._questions = {v['api_url']: v for v in rs['questions']}
-        self._gen_answers = self.client.reader_studies.answers.mine.iterate_all(
-            params={"question__reader_study": rs["pk"]})
+        :param slug: reader study slug
+        :param api: API key
+        :param client: returns the gcapi.Client to use, by default a new client is created on first use
+        :param base_url: API url, by default grand-challenge.org, e.g. an intervention.gcserver stand-in
+        """
+        self.slug = slug
+        self.base_url = base_url
+        self._api = api
+        self._get_client = client
+        self._client = None
+        self._lock = threading.RLock()
+        self._reader_study = None
+        self._questions = None
         self._answers = None
-        self._gen_display_sets = self.client.reader_studies.display_sets.iterate_all(
-            params={"question__reader_study": rs["pk"]})
         self._display_sets = None
-        self._gen_cases = self.client.images.iterate_all(params={"question__reader_study": rs["pk"]})
         self._cases = None
 
-        logging.info('Connected to GC.')
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                if self._get_client:
+                    self._client = self._get_client()
+                else:
+                    import gcapi
+                    self._client = gcapi.Client(token=self._api, **self._base_url())
+            return self._client
+
+    @property
+    def reader_study(self) -> dict:
+        with self._lock:
+            if self._reader_study is None:
+                import httpx
+                try:
+                    self._reader_study = next(self.client.reader_studies.iterate_all(params={"slug": self.slug}))
+                except httpx.HTTPStatusError as e:
+                    raise ConnectionRefusedError(f'Invalid api key!\n\n{e}')
+                logging.info('Connected to GC.')
+            return self._reader_study
+
+    def invalidate(self, *names: str):
+        """
+        Drop cached downloads after a mutation, e.g. invalidate('display_sets', 'cases') after an upload
+
+        :param names: any of 'answers', 'display_sets', 'cases'
+        """
+        with self._lock:
+            for name in names:
+                if name not in ('answers', 'display_sets', 'cases'):
+                    raise KeyError(f'unknown name: {name}')
+                setattr(self, f'_{name}', None)
+
+    def async_client(self, **kwargs) -> 'AsyncGC':
+        """asyncio client of this reader study, see intervention.gcclient.AsyncGC for kwargs"""
+        from intervention.gcclient import AsyncGC
+        return AsyncGC(self._api, self.slug, **{**self._base_url(), **kwargs})
+
+    def _base_url(self) -> dict:
+        return {'base_url': self.base_url} if self.base_url else {}
 
     def image(self, display_set):
         ds = self.display_sets[display_set]
@@ -105,34 +217,61 @@ class GCAPI:
 
     @property
     def questions(self):
-        return self._questions
+        with self._lock:
+            if self._questions is None:
+                self._questions = {v['api_url']: v for v in self.reader_study['questions']}
+            return self._questions
 
     @property
     def answers(self):
-        if self._answers is None:
-            def gen():
-                yield 'raw_answers', list(self._gen_answers)
-            get = {name: {v['api_url']: v for v in y} for name, y in gen()}
-            self._answers = get['raw_answers']
-        return self._answers
+        """the answers of all readers of the reader study, not only those of the api key's user"""
+        with self._lock:
+            if self._answers is None:
+                gen = self.client.reader_studies.answers.iterate_all(
+                    params={"question__reader_study": self.reader_study["pk"]})
+                self._answers = {v['api_url']: v for v in gen}
+            return self._answers
 
     @property
     def display_sets(self):
-        if self._display_sets is None:
-            def gen():
-                yield 'display_sets', list(self._gen_display_sets)
-            get = {name: {v['api_url']: v for v in y} for name, y in gen()}
-            self._display_sets = get['display_sets']
-        return self._display_sets
+        with self._lock:
+            if self._display_sets is None:
+                gen = self.client.reader_studies.display_sets.iterate_all(
+                    params={"question__reader_study": self.reader_study["pk"]})
+                self._display_sets = {v['api_url']: v for v in gen}
+            return self._display_sets
 
     @property
     def cases(self):
-        if self._cases is None:
-            def gen():
-                yield 'cases', list(self._gen_cases)
-            get = {name: {v['api_url']: v for v in y} for name, y in gen()}
-            self._cases = get['cases']
-        return self._cases
+        with self._lock:
+            if self._cases is None:
+                gen = self.client.images.iterate_all(params={"question__reader_study": self.reader_study["pk"]})
+                self._cases = {v['api_url']: v for v in gen}
+            return self._cases
+
+
+class GCSessions:
+    def __init__(self):
+        """
+        Per run registry of GCAPI reader studies keyed by (slug, api key), with one gcapi.Client per api key,
+        such that commands share connections and downloaded answers, display sets and images
+        """
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._studies: Dict[Tuple[str, str], GCAPI] = {}
+
+    def _client(self, api: str):
+        with self._lock:
+            if api not in self._clients:
+                import gcapi
+                self._clients[api] = gcapi.Client(token=api)
+            return self._clients[api]
+
+    def get(self, slug: str, api: str) -> GCAPI:
+        with self._lock:
+            if (slug, api) not in self._studies:
+                self._studies[(slug, api)] = GCAPI(slug, api, client=lambda: self._client(api))
+            return self._studies[(slug, api)]
 
 
 class Command:
@@ -143,6 +282,11 @@ class Command:
         self._base = kwargs['base_dir']
         self.kwargs = kwargs
 
+        _, schemas = Settings._schema()
+        for key, val in schemas.get(self.name, {}).get('properties', {}).items():
+            if 'default' in val:
+                self._settings.setdefault(key, val['default'])
+
     def __str__(self):
         return self.name
 
@@ -161,12 +305,44 @@ class Command:
             return relative_dir
 
 
+    def setup_cache(self) -> Optional['VolumeCache']:
+        """shared decompressed volume cache, None if cache_dir is empty"""
+        if not self._settings.get('cache_dir'):
+            return None
+        from intervention.cache import VolumeCache
+        return VolumeCache.get(self.setup_dir('cache_dir'), self._settings['cache_budget'] * 1e9)
+
+    def setup_scheduler(self) -> 'Scheduler':
+        """memory-aware thread pool of volume processing stages"""
+        from intervention.scheduler import Scheduler
+        return Scheduler(self._settings['memory_budget'] * 1e9, self._settings['workers'])
+
+    def setup_queue(self) -> Optional[Path]:
+        """shared work queue directory, None if queue_dir is empty"""
+        if not self._settings.get('queue_dir'):
+            return None
+        return self.setup_dir('queue_dir').absolute()
+
+    def secrets(self) -> dict:
+        return {k: self._settings[k] for k in SECRETS if self._settings.get(k)}
+
+    def task(self, **kwargs) -> dict:
+        """
+        json serializable task to rebuild this command on a worker, see intervention.workqueue.
+        SECRETS are left out, as the queue directory is shared.
+        """
+        settings = {k: v for k, v in self._settings.items() if k not in SECRETS}
+        return {'name': self.name, 'base_dir': str(Path(self._base).absolute()), 'settings': settings, **kwargs}
+
+
 class CommandDCM(Command):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.out_dir = self.setup_dir('out_dir')
         self.archive_dir = self.setup_dir('archive_dir')
         self.mappings = self._settings['mappings']
+        self.deduplicate: bool = self._settings['deduplicate']
+        self.archive_format: str = self._settings['archive_format']
 
 
 class CommandDCM2MHA(Command):
@@ -175,25 +351,44 @@ class CommandDCM2MHA(Command):
         self.out_dir = self.setup_dir('out_dir')
         self.archive_dir = self.setup_dir('archive_dir')
         self.json_dir = self.setup_dir('json_dir')
+        self.queue_dir = self.setup_queue()
+        self.shards: int = self._settings['shards']
 
 
-class CommandUpload(Command):
+class CommandGC(Command):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         gc_slug: str = self._settings['gc_slug']
         gc_api: str = self._settings['gc_api']
         self.gc = None
         if gc_slug and gc_api:
-            self.gc = GCAPI(gc_slug, gc_api)
+            sessions: Optional[GCSessions] = self.kwargs.get('sessions')
+            self.gc = sessions.get(gc_slug, gc_api) if sessions else GCAPI(gc_slug, gc_api)
         else:
             raise AttributeError(f'missing attribute!\ngc_api: {gc_api}\ngc_slug: {gc_slug}')
 
 
-class CommandAnnotate(CommandUpload):
+class CommandUpload(CommandGC):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.mha_dir = self.setup_dir('mha_dir')
+        self.out_dir = self.setup_dir('out_dir')
+        self.preview: int = self._settings['preview']
+        self.compression_level: int = self._settings['compression_level']
+        self.workers: Optional[int] = self._settings['workers'] or None
+
+
+class CommandAnnotate(CommandGC):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.out_dir = self.setup_dir('out_dir')
         self.mha_dir = self.setup_dir('mha_dir')
+        self.cache = self.setup_cache()
+        self.compression_level: int = self._settings['compression_level']
+        self.grid: bool = self._settings['grid']
+        self.queue_dir = self.setup_queue()
+        self.shards: int = self._settings['shards']
+        self.scheduler = self.setup_scheduler()
 
 
 class CommandMHA2nnUNet(Command):
@@ -206,6 +401,15 @@ class CommandMHA2nnUNet(Command):
         self.task_id: int = self._settings['task_id']
         self.task_dirname = f'Task{self.task_id}_{self.task_name}'
         self.test_percentage: float = self._settings['test_percentage']
+        self.patch_store: bool = self._settings['patch_store']
+        self.fingerprint: bool = self._settings['fingerprint']
+        self.crop_margin: float = self._settings['crop_margin']
+        self.crop_seed: int = self._settings['crop_seed']
+        self.archive_format: str = self._settings['archive_format']
+        self.cache = self.setup_cache()
+        self.queue_dir = self.setup_queue()
+        self.shards: int = self._settings['shards']
+        self.scheduler = self.setup_scheduler()
 
 
 class CommandInference(Command):
@@ -215,14 +419,56 @@ class CommandInference(Command):
         self.in_dir = self.setup_dir('in_dir')
         self.model_dir = self.setup_dir('model_dir')
         self.trainer: str = self._settings['trainer']
+        self.task_name: str = self._settings['task_name']
+        self.task_id: int = self._settings['task_id']
+        self.task_dirname = f'Task{self.task_id}_{self.task_name}'
+        self.probabilities: str = self._settings['probabilities']
+        self.probabilities_crop: bool = self._settings['probabilities_crop']
+        self.queue_dir = self.setup_queue()
+        self.shards: int = self._settings['shards']
+        self.scheduler = self.setup_scheduler()
+        self.cpu_model: Optional[Path] = self.setup_dir('cpu_model') if self._settings['cpu_model'] else None
+        self.folds: List[int] = self._settings['folds']
+        self.fold_workers: int = self._settings['fold_workers']
+
+
+class CommandExport(Command):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.out_dir = self.setup_dir('out_dir')
+        self.in_dir = self.setup_dir('in_dir')
+        self.model_dir = self.setup_dir('model_dir')
+        self.trainer: str = self._settings['trainer']
+        self.task_name: str = self._settings['task_name']
+        self.task_id: int = self._settings['task_id']
+        self.task_dirname = f'Task{self.task_id}_{self.task_name}'
+        self.network: str = self._settings['network']
+        self.folds: List[int] = self._settings['folds']
+        self.precisions: List[str] = self._settings['precisions']
+        self.calibration: int = self._settings['calibration']
+        self.tip_tolerance: float = self._settings['tip_tolerance']
+        self.workers: int = self._settings['workers']
+
+
+class CommandNative(Command):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.out_dir = self.setup_dir('out_dir')
+        self.in_dir = self.setup_dir('in_dir')
+        self.mha_dir = self.setup_dir('mha_dir')
+        self.nnunet_dir = self.setup_dir('nnunet_dir')
+        self.overlays: bool = self._settings['overlays']
+        self.compression_level: int = self._settings['compression_level']
+        self.cache = self.setup_cache()
+        self.workers: Optional[int] = self._settings['workers'] or None
 
 
 class CommandPlot(Command):
     pass
 
 
-def _commandFactory(name: str, summary: str, base_dir: Path, settings: dict) -> Command:
-    kwargs = {'name': name, 'summary': summary, 'base_dir': base_dir, 'settings': settings}
+def _commandFactory(name: str, summary: str, base_dir: Path, settings: dict, sessions: GCSessions = None) -> Command:
+    kwargs = {'name': name, 'summary': summary, 'base_dir': base_dir, 'settings': settings, 'sessions': sessions}
     if name == 'dcm':
         return CommandDCM(**kwargs)
     if name == 'dcm2mha':
@@ -235,6 +481,10 @@ def _commandFactory(name: str, summary: str, base_dir: Path, settings: dict) ->
         return CommandAnnotate(**kwargs)
     if name == 'inference':
         return CommandInference(**kwargs)
+    if name == 'export':
+        return CommandExport(**kwargs)
+    if name == 'native':
+        return CommandNative(**kwargs)
     if name == 'plot':
         return CommandPlot(**kwargs)
     raise KeyError(f'unknown name: {name}')
@@ -265,11 +515,15 @@ class Settings:
             props.update(cmd)
             cmds[i] = copy.copy(props)
 
+        self.sessions = GCSessions()
         self.commands = []
         for cmd in cmds:
             name = cmd.pop('cmd')
             properties: dict = schemas[name]['properties']
-            schemas[name]['required'] = list(properties.keys())
+            schemas[name]['required'] = [k for k, v in properties.items() if 'default' not in v]
+            for key, val in properties.items():
+                if 'default' in val:
+                    cmd.setdefault(key, val['default'])
             jsonschema.validate(cmd, schemas[name], jsonschema.Draft7Validator)
 
             summary = [schemas[name]['description']]
@@ -277,7 +531,7 @@ class Settings:
                 desc = val['description']
                 summary.append(f'    >> {key}: {desc}\n       "{cmd[key]}"')
 
-            self.commands.append(_commandFactory(name, '\n'.join(summary), self.base, cmd))
+            self.commands.append(_commandFactory(name, '\n'.join(summary), self.base, cmd, self.sessions))
 
         logging.info(self.summary())
 
@@ -302,7 +556,8 @@ class Settings:
                         "properties": {
                             "cmd": {
                                 "type": "string",
-                                "enum": ["dcm", "dcm2mha", "upload", "annotate", "mha2nnunet", "inference", "plot"]
+                                "enum": ["dcm", "dcm2mha", "upload", "annotate", "mha2nnunet", "inference", "export",
+                                         "native", "plot"]
                             }
                         }
                     }
@@ -324,6 +579,17 @@ class Settings:
             "description": "picai_prep/dcm2mha mappings",
             "type": "object"
         }
+        deduplicate = {
+            "description": "merge series with identical SOPInstanceUIDs, see dcm_duplicates.json",
+            "type": "boolean",
+            "default": True
+        }
+        archive_format = {
+            "description": "write settings archives as picai_prep json or streamed JSON Lines (jsonl)",
+            "type": "string",
+            "enum": ["json", "jsonl"],
+            "default": "json"
+        }
         gc_slug = {
             "description": "Grand Challenge reader study slug",
             "type": "string"
@@ -348,6 +614,157 @@ class Settings:
             "description": "model trainer name to inference with",
             "type": "string"
         }
+        probabilities = {
+            "description": "store softmax probabilities as none, uint8 or float16",
+            "type": "string",
+            "enum": ["none", "uint8", "float16"],
+            "default": "uint8"
+        }
+        probabilities_crop = {
+            "description": "crop stored probabilities to the foreground bounding box",
+            "type": "boolean",
+            "default": True
+        }
+        cache_dir = {
+            "description": "decompressed volume cache, root is base_dir unless it starts with /, empty to disable",
+            "type": "string",
+            "default": ""
+        }
+        cache_budget = {
+            "description": "maximum size of the volume cache in GB",
+            "type": "number",
+            "minimum": 0,
+            "default": 50
+        }
+        compression_level = {
+            "description": "gzip level of written .nii.gz files, 0 for fast uncompressed scratch output",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 9,
+            "default": 1
+        }
+        patch_store = {
+            "description": "also write a memory-mappable patch store per split to the task's patches directory",
+            "type": "boolean",
+            "default": False
+        }
+        fingerprint = {
+            "description": "fingerprint each converted case (shape, spacing, intensity histograms, voxels per label) "
+                           "and merge them in the task's fingerprint.json",
+            "type": "boolean",
+            "default": True
+        }
+        grid = {
+            "description": "also rasterize the annotations on the nnU-Net target grid of mha2nnunet, to out_dir/grid, "
+                           "which mha2nnunet then uses instead of resampling the annotations",
+            "type": "boolean",
+            "default": False
+        }
+        preview = {
+            "description": "upload uint8 previews downsampled in-plane by this factor in place of the images, "
+                           "0 uploads the images",
+            "type": "integer",
+            "minimum": 0,
+            "default": 0
+        }
+        upload_compression_level = {
+            "description": "zlib level of the compressed copies uploaded of uncompressed images",
+            "type": "integer",
+            "minimum": 0,
+            "maximum": 9,
+            "default": 6
+        }
+        crop_margin = {
+            "description": "crop scans and labels to this margin (mm) around the needle, 0 to disable",
+            "type": "number",
+            "minimum": 0,
+            "default": 0
+        }
+        crop_seed = {
+            "description": "seed of the crop position of cases without needle",
+            "type": "integer",
+            "default": 0
+        }
+        queue_dir = {
+            "description": "shared work queue directory of `fastmri-intervention worker` processes, "
+                           "root is base_dir unless it starts with /, empty to run the stage in this process only",
+            "type": "string",
+            "default": ""
+        }
+        shards = {
+            "description": "number of tasks the stage is split in when queue_dir is set",
+            "type": "integer",
+            "minimum": 1,
+            "default": 8
+        }
+        memory_budget = {
+            "description": "memory in GB that volumes in flight may use, 0 for 80% of the available memory",
+            "type": "number",
+            "minimum": 0,
+            "default": 0
+        }
+        workers = {
+            "description": "threads processing volumes, 0 for the cpu count",
+            "type": "integer",
+            "minimum": 0,
+            "default": 0
+        }
+        cpu_model = {
+            "description": "exported precision directory (see export) to predict with on CPU instead of "
+                           "nnUNet_predict, root is base_dir unless it starts with /, empty to use nnUNet_predict",
+            "type": "string",
+            "default": ""
+        }
+        ensemble_folds = {
+            "description": "folds to ensemble, empty for all",
+            "type": "array",
+            "items": {"type": "integer", "minimum": 0},
+            "default": []
+        }
+        fold_workers = {
+            "description": "processes running the folds of a cpu_model concurrently on each preprocessed case, "
+                           "0 for one per fold, 1 to run them in turn",
+            "type": "integer",
+            "minimum": 0,
+            "default": 0
+        }
+        network = {
+            "description": "nnUNet network configuration of the trained model",
+            "type": "string",
+            "default": "3d_fullres"
+        }
+        folds = {
+            "description": "trained folds to export, empty for all",
+            "type": "array",
+            "items": {"type": "integer", "minimum": 0},
+            "default": []
+        }
+        precisions = {
+            "description": "exports to compare: torch (the trained network on CPU), fp32, fp16 and int8 ONNX",
+            "type": "array",
+            "items": {"type": "string", "enum": ["torch", "fp32", "fp16", "int8"]},
+            "minItems": 1,
+            "default": ["fp32", "fp16", "int8"]
+        }
+        calibration = {
+            "description": "imagesTr cases to calibrate int8 activations with",
+            "type": "integer",
+            "minimum": 1,
+            "default": 16
+        }
+        tip_tolerance = {
+            "description": "mm of median tip error, over that of the baseline export (torch, else the most "
+                           "precise one), to still recommend a faster export that misses no more tips",
+            "type": "number",
+            "minimum": 0,
+            "default": 1
+        }
+        overlays = {
+            "description": "also write a DICOM-SEG-like overlay per prediction: a bit packed frame per label and slice "
+                           "(.seg.npz) with its segments and referenced series (.seg.json)",
+            "type": "boolean",
+            "default": False
+        }
         test_percentage = {
             "description": "mha files to seperate as test set",
             "type": "number",
@@ -364,20 +781,48 @@ class Settings:
             }
 
         schemas['dcm'] = object_schema("generate a json settings file for the dcm2mha converter",
-                                       archive_dir=in_dir, out_dir=out_dir, mappings=mappings)
+                                       archive_dir=in_dir, out_dir=out_dir, mappings=mappings,
+                                       deduplicate=deduplicate, archive_format=archive_format)
         schemas['dcm2mha'] = object_schema("convert dcm2mha",
-                                           archive_dir=in_dir, out_dir=out_dir, json_dir=in_dir)
+                                           archive_dir=in_dir, out_dir=out_dir, json_dir=in_dir,
+                                           queue_dir=queue_dir, shards=shards)
         schemas['upload'] = object_schema("upload MHA to GC",
-                                          gc_slug=gc_slug, gc_api=gc_api)
+                                          mha_dir=in_dir, out_dir=out_dir, gc_slug=gc_slug, gc_api=gc_api,
+                                          preview=preview, compression_level=upload_compression_level,
+                                          workers=workers)
         schemas['annotate'] = object_schema("download from GC, then annotate",
                                             mha_dir=in_dir, out_dir=out_dir,
-                                            gc_slug=gc_slug, gc_api=gc_api)
+                                            gc_slug=gc_slug, gc_api=gc_api,
+                                            cache_dir=cache_dir, cache_budget=cache_budget,
+                                            compression_level=compression_level, grid=grid,
+                                            queue_dir=queue_dir, shards=shards,
+                                            memory_budget=memory_budget, workers=workers)
         schemas['mha2nnunet'] = object_schema("convert mha2nnunet",
                                               mha_dir=in_dir, annotate_dir=in_dir, out_dir=out_dir,
-                                              test_percentage=test_percentage, task_name=task_name, task_id=task_id)
+                                              test_percentage=test_percentage, task_name=task_name, task_id=task_id,
+                                              patch_store=patch_store, fingerprint=fingerprint,
+                                              crop_margin=crop_margin, crop_seed=crop_seed,
+                                              archive_format=archive_format,
+                                              cache_dir=cache_dir, cache_budget=cache_budget,
+                                              queue_dir=queue_dir, shards=shards,
+                                              memory_budget=memory_budget, workers=workers)
         schemas['inference'] = object_schema("inference using trained model",
                                              in_dir=in_dir, model_dir=in_dir, out_dir=out_dir,
-                                             trainer=trainer)
+                                             trainer=trainer, task_name=task_name, task_id=task_id,
+                                             probabilities=probabilities, probabilities_crop=probabilities_crop,
+                                             queue_dir=queue_dir, shards=shards,
+                                             memory_budget=memory_budget, workers=workers, cpu_model=cpu_model,
+                                             folds=ensemble_folds, fold_workers=fold_workers)
+        schemas['export'] = object_schema("export a trained model for CPU inference and compare the exports "
+                                          "on the test split",
+                                          in_dir=in_dir, model_dir=in_dir, out_dir=out_dir,
+                                          trainer=trainer, task_name=task_name, task_id=task_id, network=network,
+                                          folds=folds, precisions=precisions, calibration=calibration,
+                                          tip_tolerance=tip_tolerance, workers=workers)
+        schemas['native'] = object_schema("resample predictions to the geometry of their source scans",
+                                          in_dir=in_dir, mha_dir=in_dir, nnunet_dir=in_dir, out_dir=out_dir,
+                                          overlays=overlays, compression_level=compression_level,
+                                          cache_dir=cache_dir, cache_budget=cache_budget, workers=workers)
         schemas['plot'] = object_schema("plot all inferenced directories")
 
         return base, schemas
\ No newline at end of file
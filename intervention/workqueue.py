@@ -0,0 +1,271 @@
+import functools, importlib, json, logging, os, shutil, socket, threading, time, uuid, zlib
+from pathlib import Path
+from typing import Callable, List, Optional
+
+# seconds a claimed task may go without heartbeat before it is reclaimed
+LEASE = 600
+SHARDS_DIR = 'shards'
+STATES = ['pending', 'claimed', 'done', 'failed']
+
+# stage name: 'module:function' run by workers, called as function(cmd, shard, shards)
+STAGES = {
+    'dcm2mha': 'intervention.dcm2mha:dcm2mha_shard',
+    'annotate': 'intervention.annotate:annotate_shard',
+    'mha2nnunet': 'intervention.mha2nnunet:mha2nnunet_shard',
+    'inference': 'intervention.inference:inference_shard',
+}
+
+
+def shard_of(key: str, shards: int) -> int:
+    """stable shard of a key (e.g. a case name), equal on every node"""
+    return zlib.crc32(key.encode()) % shards
+
+
+def shard_dir(out_dir: Path, shard: int) -> Path:
+    """scratch output directory of a shard"""
+    return Path(out_dir) / SHARDS_DIR / str(shard)
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}.{os.getpid()}'
+
+
+def merge_shards(shard_dirs: List[Path], out_dir: Path):
+    """
+    Move the files of shard output directories into out_dir, then remove the shard directories.
+    Files that exist in more than one shard are replaced, except .log and .txt files, which are appended.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for src_dir in shard_dirs:
+        if not src_dir.exists():
+            continue
+        for dirpath, _, filenames in os.walk(src_dir):
+            for fn in filenames:
+                src = Path(dirpath) / fn
+                dst = out_dir / src.relative_to(src_dir)
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                if dst.exists() and dst.suffix in ('.log', '.txt'):
+                    with open(src) as f, open(dst, 'a') as g:
+                        g.write(f.read())
+                else:
+                    os.replace(src, dst)
+        shutil.rmtree(src_dir)
+
+
+class WorkQueue:
+    def __init__(self, root: Path):
+        """
+        Work queue in a directory on a shared filesystem (e.g. NFS), without a server.
+        A task is a json file that moves between pending/, claimed/, done/ and failed/ by atomic renames, such that
+        only one worker claims it. A worker holds the lease of a claimed task by touching its file, tasks of dead
+        workers are reclaimed when their lease expires, and fail after max_attempts.
+
+        :param root: queue directory, shared by the coordinator and all workers
+        """
+        self.root = Path(root)
+        for state in STATES + ['tmp']:
+            (self.root / state).mkdir(parents=True, exist_ok=True)
+
+    def _path(self, state: str, task_id: str) -> Path:
+        return self.root / state / f'{task_id}.json'
+
+    def _write(self, state: str, entry: dict):
+        tmp = self.root / 'tmp' / f'{entry["id"]}.{uuid.uuid4().hex}.json'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._path(state, entry['id']))
+
+    def _read(self, state: str, task_id: str) -> dict:
+        with open(self._path(state, task_id)) as f:
+            return json.load(f)
+
+    def put(self, task: dict, lease: float = LEASE, max_attempts: int = 3) -> str:
+        """
+        :param task: json serializable task
+        :param lease: seconds without heartbeat after which the task is reclaimed
+        :return: task id, ordered by submission
+        """
+        task_id = f'{time.time_ns():020d}_{uuid.uuid4().hex[:8]}'
+        self._write('pending', {'id': task_id, 'task': task, 'lease': lease, 'attempts': 0,
+                                'max_attempts': max_attempts, 'errors': []})
+        return task_id
+
+    def claim(self) -> Optional[dict]:
+        """claim the oldest pending task, None if there is none"""
+        for path in sorted((self.root / 'pending').glob('*.json')):
+            claimed = self.root / 'claimed' / path.name
+            try:
+                # the lease starts before the rename, such that reclaim never sees a stale claim
+                os.utime(path)
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            with open(claimed) as f:
+                entry = json.load(f)
+            if self._path('done', entry['id']).exists():
+                # completed by a worker whose lease had expired
+                claimed.unlink(missing_ok=True)
+                continue
+            return entry
+        return None
+
+    def heartbeat(self, task_id: str) -> bool:
+        """renew the lease of a claimed task, False if it was reclaimed"""
+        try:
+            os.utime(self._path('claimed', task_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, entry: dict, result: dict = None):
+        self._write('done', dict(entry, result=result))
+        self._path('claimed', entry['id']).unlink(missing_ok=True)
+
+    def release(self, task_id: str, error: str) -> Optional[str]:
+        """
+        Return a claimed task to pending, or to failed after max_attempts
+
+        :return: the new state, None if the task was not claimed (anymore)
+        """
+        own = self.root / 'tmp' / f'{task_id}.{uuid.uuid4().hex}.release'
+        try:
+            os.rename(self._path('claimed', task_id), own)
+        except FileNotFoundError:
+            return None
+        with open(own) as f:
+            entry = json.load(f)
+        entry['attempts'] += 1
+        entry['errors'].append(error)
+        state = 'failed' if entry['attempts'] >= entry['max_attempts'] else 'pending'
+        self._write(state, entry)
+        own.unlink()
+        return state
+
+    def reclaim(self) -> int:
+        """release claimed tasks whose lease expired, e.g. of dead workers; returns the number released"""
+        n = 0
+        for path in (self.root / 'claimed').glob('*.json'):
+            try:
+                mtime = path.stat().st_mtime
+                with open(path) as f:
+                    lease = json.load(f)['lease']
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+            if time.time() - mtime > lease and self.release(path.stem, 'lease expired') is not None:
+                logging.info(f'Reclaimed task {path.stem} from {self.root}')
+                n += 1
+        return n
+
+    def state(self, task_id: str) -> Optional[str]:
+        for state in ['done', 'failed', 'claimed', 'pending']:
+            if self._path(state, task_id).exists():
+                return state
+        return None
+
+    def run(self, entry: dict, func: Callable[[dict], Optional[dict]]) -> bool:
+        """run a claimed task, renewing its lease meanwhile; returns whether it completed"""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(entry['lease'] / 4):
+                if not self.heartbeat(entry['id']):
+                    logging.warning(f'Lost the lease of task {entry["id"]}')
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        try:
+            result = func(entry['task'])
+        except Exception as e:
+            logging.exception(f'Task {entry["id"]} failed')
+            self.release(entry['id'], f'{worker_name()}: {type(e).__name__}({e})')
+            return False
+        finally:
+            stop.set()
+            thread.join()
+        self.complete(entry, result)
+        return True
+
+    def join(self, task_ids: List[str], func: Callable[[dict], Optional[dict]] = None,
+             poll: float = 1) -> List[dict]:
+        """
+        Wait for tasks to complete, reclaiming expired leases meanwhile
+
+        :param func: if set, also claim and run tasks in this process
+        :return: the results of the tasks, in order of task_ids
+        """
+        while True:
+            self.reclaim()
+            states = [self.state(i) for i in task_ids]
+            if 'failed' in states:
+                errors = [e for i, s in zip(task_ids, states) if s == 'failed'
+                          for e in self._read('failed', i)['errors']]
+                raise RuntimeError(f'{states.count("failed")} task(s) failed:\n' + '\n'.join(errors))
+            if all(s == 'done' for s in states):
+                return [self._read('done', i)['result'] for i in task_ids]
+            entry = self.claim() if func else None
+            if entry:
+                self.run(entry, func)
+            else:
+                time.sleep(poll)
+
+    def remove(self, task_ids: List[str]):
+        for task_id in task_ids:
+            for state in STATES:
+                self._path(state, task_id).unlink(missing_ok=True)
+
+
+def task_command(task: dict, secrets: dict = None) -> 'Command':
+    """
+    Rebuild the command of a task
+
+    :param secrets: settings left out of the task, by default read from the environment (see utils.read_secrets)
+    """
+    from intervention.utils import GCSessions, _commandFactory, read_secrets
+
+    settings = {**task['settings'], **(read_secrets() if secrets is None else secrets)}
+    return _commandFactory(task['name'], '', Path(task['base_dir']), settings, GCSessions())
+
+
+def run_task(task: dict, secrets: dict = None) -> Optional[dict]:
+    """run one shard of a stage, rebuilding its command from the task"""
+    cmd = task_command(task, secrets)
+    module, func = STAGES[task['name']].split(':')
+    logging.info(f'{worker_name()} runs {task["name"]} shard {task["shard"] + 1}/{task["shards"]}')
+    return getattr(importlib.import_module(module), func)(cmd, task['shard'], task['shards'])
+
+
+def distribute(cmd: 'Command', poll: float = 1) -> List[dict]:
+    """
+    Split a stage in cmd.shards tasks on cmd.queue_dir and wait for workers (and this process) to run them
+
+    :return: the results of the shards
+    """
+    queue = WorkQueue(cmd.queue_dir)
+    task_ids = [queue.put(cmd.task(shard=i, shards=cmd.shards)) for i in range(cmd.shards)]
+    logging.info(f'Queued {len(task_ids)} {cmd.name} tasks on {cmd.queue_dir}')
+    results = queue.join(task_ids, func=functools.partial(run_task, secrets=cmd.secrets()), poll=poll)
+    queue.remove(task_ids)
+    return results
+
+
+def work(root: Path, func: Callable[[dict], Optional[dict]] = run_task, idle_timeout: float = None,
+         max_tasks: int = None, poll: float = 5) -> int:
+    """
+    Worker loop, claims and runs tasks until idle for idle_timeout seconds or max_tasks are run
+
+    :return: number of completed tasks
+    """
+    queue = WorkQueue(root)
+    completed, tasks, idle = 0, 0, time.monotonic()
+    while max_tasks is None or tasks < max_tasks:
+        queue.reclaim()
+        entry = queue.claim()
+        if entry is None:
+            if idle_timeout is not None and time.monotonic() - idle > idle_timeout:
+                break
+            time.sleep(poll)
+            continue
+        tasks += 1
+        completed += queue.run(entry, func)
+        idle = time.monotonic()
+    return completed
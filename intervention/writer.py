@@ -0,0 +1,127 @@
+import os, struct, threading, zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np, SimpleITK as sitk
+
+BLOCK_SIZE = 1 << 20
+
+
+def _deflate(block: bytes, level: int, last: bool) -> bytes:
+    # raw deflate, byte aligned by a sync flush, such that compressed blocks can be concatenated (as pigz does)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_bytes(data: bytes, level: int = 1, threads: int = None, block_size: int = BLOCK_SIZE) -> bytes:
+    """
+    gzip data by compressing blocks in parallel into a single gzip member, readable by any gzip reader
+
+    :param level: 0 (stored, no compression) to 9
+    :param threads: compression threads, defaults to the cpu count
+    """
+    view = memoryview(data)
+    blocks = [view[i:i + block_size] for i in range(0, len(view), block_size)] or [view]
+    last = [False] * (len(blocks) - 1) + [True]
+
+    # zlib releases the GIL, so threads compress in parallel
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+        deflated = list(pool.map(_deflate, blocks, [level] * len(blocks), last))
+
+    crc = 0
+    for block in blocks:
+        crc = zlib.crc32(block, crc)
+
+    header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    trailer = struct.pack('<II', crc, len(view) & 0xFFFFFFFF)
+    return b''.join([header] + deflated + [trailer])
+
+
+# NIfTI-1 datatype code and bitpix per numpy dtype
+_NIFTI_TYPES = {'uint8': (2, 8), 'int16': (4, 16), 'int32': (8, 32), 'float32': (16, 32), 'float64': (64, 64),
+                'int8': (256, 8), 'uint16': (512, 16), 'uint32': (768, 32), 'int64': (1024, 64), 'uint64': (1280, 64)}
+_NIFTI_HEADER = struct.Struct('<i10s18sihcb8h3f4h8f3fhbb4f2i80s24s2h6f12f16s4s')
+
+
+def _quaternion(rotation: np.ndarray) -> Tuple[np.ndarray, float]:
+    """quatern_b, c, d and qfac of a 3 x 3 orthonormal matrix, as nifti_mat44_to_quatern"""
+    qfac = 1.0
+    if np.linalg.det(rotation) < 0:
+        rotation, qfac = rotation * [1, 1, -1], -1.0
+    (r11, r12, r13), (r21, r22, r23), (r31, r32, r33) = rotation
+    a = r11 + r22 + r33 + 1
+    if a > 0.5:
+        a = 0.5 * np.sqrt(a)
+        b, c, d = 0.25 * (r32 - r23) / a, 0.25 * (r13 - r31) / a, 0.25 * (r21 - r12) / a
+    else:
+        xd, yd, zd = 1 + r11 - (r22 + r33), 1 + r22 - (r11 + r33), 1 + r33 - (r11 + r22)
+        if xd > 1:
+            b = 0.5 * np.sqrt(xd)
+            c, d, a = 0.25 * (r12 + r21) / b, 0.25 * (r13 + r31) / b, 0.25 * (r32 - r23) / b
+        elif yd > 1:
+            c = 0.5 * np.sqrt(yd)
+            b, d, a = 0.25 * (r12 + r21) / c, 0.25 * (r23 + r32) / c, 0.25 * (r13 - r31) / c
+        else:
+            d = 0.5 * np.sqrt(zd)
+            b, c, a = 0.25 * (r13 + r31) / d, 0.25 * (r23 + r32) / d, 0.25 * (r21 - r12) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+    return np.array([b, c, d]), qfac
+
+
+def nifti_bytes(image: sitk.Image) -> bytes:
+    """
+    Uncompressed NIfTI-1 (.nii) file of a 2D or 3D, scalar or vector image, serialized in memory with the geometry
+    SimpleITK writes: qform and sform in RAS, in mm
+    """
+    dimension, components = image.GetDimension(), image.GetNumberOfComponentsPerPixel()
+    if dimension not in (2, 3):
+        raise ValueError(f'cannot write a {dimension}D image as NIfTI in memory')
+    array = sitk.GetArrayViewFromImage(image)
+    if array.dtype.name not in _NIFTI_TYPES:
+        raise ValueError(f'no NIfTI datatype for {array.dtype}')
+    datatype, bitpix = _NIFTI_TYPES[array.dtype.name]
+
+    size = list(image.GetSize()) + [1] * (3 - dimension)
+    spacing = list(image.GetSpacing()) + [1.0] * (3 - dimension)
+    origin = list(image.GetOrigin()) + [0.0] * (3 - dimension)
+    direction = np.eye(3)
+    direction[:dimension, :dimension] = np.array(image.GetDirection()).reshape(dimension, dimension)
+
+    # LPS to RAS
+    lps2ras = np.array([-1.0, -1.0, 1.0])
+    rotation, offset = direction * lps2ras[:, None], np.array(origin) * lps2ras
+    quaternion, qfac = _quaternion(rotation)
+    affine = np.concatenate([rotation * spacing, offset[:, None]], axis=1)
+
+    dim = [dimension] + size + [1] * 4
+    intent = 0
+    if components > 1:
+        # components are the 5th dimension, after a singleton time dimension
+        dim, intent = [5] + size + [1, components, 1, 1], 1007
+        array = np.moveaxis(array, -1, 0)
+    header = _NIFTI_HEADER.pack(
+        348, b'', b'', 0, 0, b'r', 0, *dim[:8], 0, 0, 0, intent, datatype, bitpix, 0,
+        qfac, *spacing, 0, 0, 0, 0, 352, 1, 0, 0, 0, 10, 0, 0, 0, 0, 0, 0, b'', b'',
+        1, 1, *quaternion, *offset, *affine.ravel(), b'', b'n+1\0')
+    return header + b'\0' * 4 + np.ascontiguousarray(array).astype(array.dtype.newbyteorder('<')).tobytes()
+
+
+def write_image(image: sitk.Image, path: Path, level: int = 1, threads: int = None):
+    """
+    Write image, compressing .nii.gz files with block parallel gzip
+
+    :param path: output file, .nii.gz or any format SimpleITK writes
+    :param level: compression level, 0 writes uncompressed (stored) data as fast as possible
+    :param threads: compression threads, defaults to the cpu count
+    """
+    path = Path(path)
+    if not path.name.endswith('.nii.gz'):
+        sitk.WriteImage(image, str(path), useCompression=level > 0, compressionLevel=level)
+        return
+
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(gzip_bytes(nifti_bytes(image), level=level, threads=threads))
+    tmp.replace(path)
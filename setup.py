@@ -20,6 +20,9 @@ setup(
         'picai-prep @ git+https://github.com/DIAGNijmegen/picai_prep@refactor',
         'click'
     ],
+    extras_require={
+        'export': ['onnx', 'onnxruntime'],
+    },
     entry_points={
         'console_scripts': [
             'fastmri-intervention = intervention.__main__:cli',
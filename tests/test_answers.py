@@ -0,0 +1,55 @@
+import asyncio, json
+
+import numpy as np
+
+from intervention.answers import AnswerTable
+from intervention.fakegc import FakeGC
+from intervention.gcclient import AsyncGC
+from intervention.synthetic import generate, SyntheticGC
+
+
+def test_multi_reader_consensus(tmp_path):
+    paths = generate(tmp_path, patients=1, series=3, no_needle=0)
+    with open(paths['answers']) as f:
+        gc = json.load(f)
+
+    # a second and third reader, offset by +1 and -1 mm, and a reader with a missing tip on the last case
+    last = sorted(gc['display_sets'])[-1]
+    for creator, offset in [('second', 1), ('third', -1), ('partial', 0)]:
+        for url, answer in list(gc['answers'].items()):
+            answer = dict(answer, creator=creator)
+            if isinstance(answer['answer'], dict):
+                if creator == 'partial' and answer['display_set'] == last:
+                    continue
+                answer['answer'] = {'point': [p + offset for p in answer['answer']['point']]}
+            gc['answers'][f'{url}{creator}'] = answer
+    with open(paths['answers'], 'w') as f:
+        json.dump(gc, f)
+
+    answers = AnswerTable.from_gc(SyntheticGC(paths['answers']), paths['mha'])
+    assert len(answers) == 3 * 4
+    assert answers.valid().sum() == 3 * 4 - 1
+    assert answers.log() == [f'{answers.names[-1]} (partial): missing point']
+
+    consensus = answers.consensus()
+    assert list(consensus['readers']) == [4, 4, 3]
+    assert np.allclose(consensus['agreement'], np.sqrt(3))
+
+
+def test_consensus_of_fetched_answers(tmp_path):
+    paths = generate(tmp_path, patients=1, series=2, no_needle=0, readers=3)
+    fake = FakeGC.from_answers(paths['answers'])
+
+    async def fetch():
+        async with AsyncGC('0' * 64, 'fake', base_url=fake.base_url, transport=fake.transport()) as gc:
+            return {'questions': await gc.questions(), 'answers': await gc.answers(),
+                    'display_sets': await gc.display_sets(), 'cases': await gc.images()}
+
+    with open(tmp_path / 'fetched.json', 'w') as f:
+        json.dump(asyncio.run(fetch()), f)
+    answers = AnswerTable.from_gc(SyntheticGC(tmp_path / 'fetched.json'), paths['mha'])
+
+    consensus = answers.consensus()
+    assert list(consensus['readers']) == [3, 3]
+    # two readers up to 1 mm off in each axis
+    assert np.all((consensus['agreement'] > 0) & (consensus['agreement'] <= np.sqrt(3)))
@@ -0,0 +1,80 @@
+import os, shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np, SimpleITK as sitk
+
+import intervention.cache as cache
+from intervention.cache import VolumeCache, VOLUME_RAW
+
+
+def _images(tmp_path, n: int, shape=(4, 32, 32)):
+    paths = []
+    for i in range(n):
+        image = sitk.GetImageFromArray(np.full(shape, i, dtype=np.int16) + np.arange(shape[2], dtype=np.int16))
+        image.SetSpacing((0.5, 0.7, 3.0))
+        image.SetOrigin((i, -i, 2.0 * i))
+        image.SetMetaData('0020|000e', f'1.2.{i}')
+        paths.append(tmp_path / f'{i}.mha')
+        sitk.WriteImage(image, str(paths[-1]), useCompression=True)
+    return paths
+
+
+def _entries(volumes: VolumeCache) -> set:
+    return {e.name for e in volumes.root.iterdir() if (e / VOLUME_RAW).exists()}
+
+
+def test_read_and_array(tmp_path):
+    path, = _images(tmp_path, 1)
+    volumes = VolumeCache(tmp_path / 'cache')
+    expected = sitk.ReadImage(str(path))
+
+    array = volumes.array(path)
+    assert isinstance(array, np.memmap) and not array.flags.writeable
+    assert np.array_equal(array, sitk.GetArrayViewFromImage(expected))
+
+    image = volumes.read(path)
+    assert np.array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(expected))
+    assert image.GetPixelID() == expected.GetPixelID() and image.GetOrigin() == expected.GetOrigin()
+    assert image.GetSpacing() == expected.GetSpacing() and image.GetMetaData('0020|000e') == '1.2.0'
+    assert len(_entries(volumes)) == 1
+
+
+def test_lru_eviction(tmp_path):
+    paths = _images(tmp_path, 3)
+    entry_bytes = 4 * 32 * 32 * 2
+    volumes = VolumeCache(tmp_path / 'cache', budget=2 * entry_bytes)
+    keys = [volumes._key(p) for p in paths]
+
+    volumes.array(paths[0])
+    os.utime(volumes.root / keys[0] / VOLUME_RAW, (1, 1))
+    volumes.array(paths[1])
+    os.utime(volumes.root / keys[1] / VOLUME_RAW, (2, 2))
+    # a hit makes the first the most recently used
+    volumes.array(paths[0])
+    volumes.array(paths[2])
+    assert _entries(volumes) == {keys[0], keys[2]}
+
+
+def test_read_during_eviction(tmp_path, monkeypatch):
+    paths = _images(tmp_path, 6)
+    # no entry fits, every miss evicts all entries that are not being opened
+    volumes = VolumeCache(tmp_path / 'cache', budget=0)
+
+    def read(i: int) -> bool:
+        return all(np.array_equal(volumes.array(paths[j % 6])[0, 0], np.arange(32) + j % 6) for j in range(i, i + 6))
+
+    with ThreadPoolExecutor(8) as pool:
+        assert all(pool.map(read, range(24)))
+
+    # another process evicts the entry between its lookup and opening it
+    utime, evicted = os.utime, []
+
+    def evicting_utime(path, *args):
+        if not evicted:
+            evicted.append(path)
+            shutil.rmtree(os.path.dirname(path))
+        return utime(path, *args)
+
+    volumes.array(paths[0])
+    monkeypatch.setattr(cache.os, 'utime', evicting_utime)
+    assert np.array_equal(sitk.GetArrayFromImage(volumes.read(paths[0]))[0, 0], np.arange(32)) and evicted
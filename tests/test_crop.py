@@ -0,0 +1,21 @@
+import numpy as np, SimpleITK as sitk
+
+from intervention.crop import needle_bounds, random_bounds, crop, paste_back
+
+
+def test_crop_paste_back():
+    array = np.zeros((5, 64, 64), dtype=np.uint8)
+    array[2, 20:30, 10:40] = 1
+    label = sitk.GetImageFromArray(array)
+    label.SetSpacing((0.5, 0.5, 3.0))
+    label.SetOrigin((10, -20, 5))
+
+    start, size = needle_bounds(array, label.GetSpacing(), margin=2)
+    assert start == [6, 16, 1] and size == [38, 18, 3]
+
+    cropped = crop(label, start, size)
+    assert np.array_equal(label.TransformIndexToPhysicalPoint(start), cropped.GetOrigin())
+    assert np.array_equal(sitk.GetArrayFromImage(paste_back(cropped, start, size, label)), array)
+
+    assert random_bounds(np.array([19, 9, 9]), label.GetSize(), label.GetSpacing(), 'case') == \
+        random_bounds(np.array([19, 9, 9]), label.GetSize(), label.GetSpacing(), 'case')
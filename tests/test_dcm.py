@@ -0,0 +1,55 @@
+import json, shutil
+
+import intervention.dcm as dcm
+from intervention.synthetic import generate, MAPPINGS
+from intervention.utils import CommandDCM, read_archive, jsonl2json
+
+
+def test_deduplicate(tmp_path):
+    paths = generate(tmp_path, patients=2, series=2)
+    series = sorted(p.parent for p in paths['archive'].rglob('0001.dcm'))
+    # a re-export of the first series in another study folder
+    copy = series[0].parents[1] / '1.2.3.copy' / series[0].name
+    shutil.copytree(series[0], copy)
+
+    cmd = CommandDCM(name='dcm', summary='', base_dir=tmp_path, settings={
+        'archive_dir': paths['archive'].as_posix(), 'out_dir': 'dcm', 'mappings': MAPPINGS})
+    dcm.generate_dcm2mha_json(cmd)
+
+    with open(cmd.out_dir / 'dcm2mha_settings.json') as f:
+        assert len(json.load(f)['archive']) == 4
+    with open(cmd.out_dir / dcm.DUPLICATES_JSON) as f:
+        merged = json.load(f)
+    assert [sorted([k] + v) for k, v in merged.items()] == [sorted([series[0].as_posix(), copy.as_posix()])]
+
+
+def test_jsonl_archive(tmp_path):
+    paths = generate(tmp_path, patients=2, series=2)
+    cmd = CommandDCM(name='dcm', summary='', base_dir=tmp_path, settings={
+        'archive_dir': paths['archive'].as_posix(), 'out_dir': 'dcm', 'mappings': MAPPINGS, 'archive_format': 'jsonl'})
+    dcm.generate_dcm2mha_json(cmd)
+
+    header, archive = read_archive(cmd.out_dir / 'dcm2mha_settings.jsonl')
+    assert header['mappings'] == MAPPINGS
+    items = list(archive)
+    assert len(items) == 4
+
+    jsonl2json(cmd.out_dir / 'dcm2mha_settings.jsonl', cmd.out_dir / 'dcm2mha_settings.json')
+    with open(cmd.out_dir / 'dcm2mha_settings.json') as f:
+        assert json.load(f) == {**header, 'archive': items}
+
+
+def test_deduplicate_lazily(tmp_path):
+    paths = generate(tmp_path, patients=3, series=2)
+    series = sorted(p.parent for p in paths['archive'].rglob('0001.dcm'))
+    taken = []
+
+    def archive():
+        for s in series:
+            taken.append(s)
+            yield {'path': s.as_posix()}
+
+    kept = dcm.deduplicate(archive(), {}, in_flight=2)
+    assert next(kept)['path'] == series[0].as_posix()
+    assert len(taken) == 2
+    assert [item['path'] for item in kept] == [s.as_posix() for s in series[1:]]
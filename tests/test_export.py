@@ -0,0 +1,110 @@
+import json, multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np, pytest, SimpleITK as sitk
+
+import intervention.export as export
+from intervention.tips import NEEDLE, TIP
+
+
+def test_export_network(tmp_path):
+    torch = pytest.importorskip('torch')
+    onnxruntime = pytest.importorskip('onnxruntime')
+
+    torch.manual_seed(0)
+    network = torch.nn.Sequential(torch.nn.Conv3d(1, 4, 3, padding=1), torch.nn.LeakyReLU(),
+                                  torch.nn.Conv3d(4, 3, 1)).eval()
+    export.export_network(network, (1, 4, 16, 16), tmp_path / 'fold_0.onnx')
+
+    # a batch of two, the batch size is dynamic
+    data = np.random.default_rng(0).normal(size=(2, 1, 4, 16, 16)).astype(np.float32)
+    session = onnxruntime.InferenceSession(str(tmp_path / 'fold_0.onnx'), providers=['CPUExecutionProvider'])
+    logits, = session.run(None, {'input': data})
+    with torch.no_grad():
+        expected = network(torch.from_numpy(data)).numpy()
+    assert logits.shape == expected.shape and np.allclose(logits, expected, atol=1e-5)
+
+
+def test_missed_tip(tmp_path):
+    array = np.zeros((5, 20, 40), dtype=np.uint8)
+    array[2, 10, 5:30] = NEEDLE
+    array[2, 10, 30:35] = TIP
+    sitk.WriteImage(sitk.GetImageFromArray(array), str(tmp_path / 'label.nii.gz'))
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros_like(array)), str(tmp_path / 'empty.nii.gz'))
+
+    label, empty = tmp_path / 'label.nii.gz', tmp_path / 'empty.nii.gz'
+    found = export._scores(label, label, 3)
+    assert (found['tip'], found['tip_mm']) == ('found', 0.0)
+    # no tip error without a needle in the label
+    assert [export._scores(p, l, 3)['tip'] for p, l in [(empty, empty), (label, empty)]] == \
+           ['true_negative', 'false_positive']
+    scores = export._scores(empty, label, 3)
+    assert (scores['tip'], scores['tip_mm']) == ('missed', None) and scores['dice'] == {1: 0.0, 2: 0.0}
+    assert json.loads(json.dumps(scores, allow_nan=False))['tip_mm'] is None
+
+
+def test_recommend():
+    def entry(precision: str, seconds: float, median: float, missed: int, false_positive: int = 0) -> dict:
+        return {'precision': precision, 'seconds_per_case': seconds, 'tip_mm_median': median, 'tip_missed': missed,
+                'tip_false_positive': false_positive}
+
+    # the baseline misses a tip, int8 is faster but misses more and fp16 is too inaccurate
+    report = [entry('int8', 1, 1.0, 3), entry('fp16', 2, 4.0, 1), entry('fp32', 3, 1.5, 1), entry('torch', 4, 1.0, 1)]
+    baseline, choice = export.recommend(report, 1)
+    assert baseline['precision'] == 'torch' and choice['precision'] == 'fp32'
+    assert export.recommend(report, 5)[1]['precision'] == 'fp16'
+    assert export.recommend(report[:3], 1)[1]['precision'] == 'fp32'
+    report[0]['tip_missed'] = 0
+    assert export.recommend(report, 1)[1]['precision'] == 'int8'
+    report[0]['tip_false_positive'] = 1
+    assert export.recommend(report, 1)[1]['precision'] == 'fp32'
+
+
+class _Trainer:
+    num_classes = 2
+
+
+def _predict_fold(trainer, fold: int, data: np.ndarray, mirroring: bool) -> np.ndarray:
+    # stub network of a fold, failing on negative data
+    if data.min() < 0:
+        raise ValueError(f'fold {fold} failed')
+    return np.repeat(data * (fold + 1), trainer.num_classes, axis=0)
+
+
+def test_fold_workers(tmp_path, monkeypatch, caplog):
+    with open(tmp_path / export.EXPORT_JSON, 'w') as f:
+        json.dump({'task': 'Task1_x', 'trainer': '', 'network': '3d_fullres', 'folds': [0, 1, 2],
+                   'precision': 'fp32'}, f)
+    monkeypatch.setattr(export, '_trainer', lambda folder, folds, weights=True: (_Trainer(), []))
+    monkeypatch.setattr(export, '_networks', lambda model_dir, meta, results_dir, folds, threads:
+                        (_Trainer(), {fold: fold for fold in folds}))
+    monkeypatch.setattr(export, '_predict_fold', _predict_fold)
+    # fork, such that the fold workers inherit the stubs
+    context = multiprocessing.get_context('fork')
+    monkeypatch.setattr(export.multiprocessing, 'get_context', lambda method: context)
+    created = []
+
+    class Recorded(SharedMemory):
+        def __init__(self, name: str = None, create: bool = False, size: int = 0):
+            super().__init__(name, create, size)
+            if create:
+                created.append(self.name)
+
+    monkeypatch.setattr(export, 'SharedMemory', Recorded)
+
+    data = np.random.default_rng(0).random((1, 4, 8, 8), dtype=np.float32)
+    with export.CpuPredictor(tmp_path, tmp_path, threads=4, fold_workers=1) as predictor:
+        expected = predictor.ensemble(data)
+    with export.CpuPredictor(tmp_path, tmp_path, threads=4, fold_workers=2) as predictor:
+        assert len(predictor._pools) == 2
+        assert np.allclose(predictor.ensemble(data), expected) and np.allclose(expected, 2 * data)
+        with pytest.raises(RuntimeError, match='ValueError'):
+            predictor.ensemble(-data)
+        assert 'Traceback' in caplog.text and 'failed' in caplog.text
+        # the pools still run after a failed case
+        assert np.allclose(predictor.ensemble(data), expected)
+
+    assert len(created) == 6
+    for name in created:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name)
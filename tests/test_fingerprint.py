@@ -0,0 +1,79 @@
+import numpy as np, SimpleITK as sitk
+
+from intervention.fingerprint import case_fingerprint, histogram, histogram_statistics, merge_fingerprints, \
+    merge_histograms, write_case_fingerprints, BINS, PERCENTILES
+
+
+def test_fingerprints(tmp_path):
+    rng = np.random.default_rng(0)
+    images, labels = [], []
+    # cases of two shards, the test case has no label
+    for shard, split, case in [(0, 'Tr', 'a'), (1, 'Tr', 'b'), (1, 'Ts', 'c')]:
+        task = tmp_path / f'shard{shard}' / 'task'
+        (task / f'images{split}').mkdir(parents=True, exist_ok=True)
+        (task / f'labels{split}').mkdir(parents=True, exist_ok=True)
+        image = rng.normal(100 * (shard + 1), 20, size=(3, 16, 20)).astype(np.int16)
+        label = np.zeros(image.shape, dtype=np.uint8)
+        label[1, 4:8, 2:10], label[1, 4:8, 10:12] = 1, 2
+        sitk.WriteImage(sitk.GetImageFromArray(image), str(task / f'images{split}' / f'{case}_0000.nii.gz'))
+        if split == 'Tr':
+            sitk.WriteImage(sitk.GetImageFromArray(label), str(task / f'labels{split}' / f'{case}.nii.gz'))
+            images.append(image)
+            labels.append(label)
+
+    for shard in range(2):
+        assert write_case_fingerprints([tmp_path / f'shard{shard}' / 'task'], tmp_path / f'shard{shard}' / 'fp', 3) \
+               == shard + 1
+    fingerprint = merge_fingerprints([tmp_path / f'shard{shard}' / 'fp' for shard in range(2)], tmp_path / 'fp.json')
+
+    dataset = fingerprint['dataset']
+    assert [c['case'] for c in fingerprint['cases']] == ['a', 'b', 'c'] and dataset['cases'] == 2
+    assert dataset['median_shape'] == [3, 16, 20] and dataset['label_voxels'] == [2 * 920, 2 * 32, 2 * 8]
+    assert dataset['label_cases'] == [2, 2, 2] and fingerprint['cases'][2]['label_voxels'] == [960, 0, 0]
+
+    foreground = np.concatenate([i[l > 0] for i, l in zip(images, labels)])
+    intensities = dataset['intensities'][0]['foreground']
+    assert intensities['voxels'] == foreground.size and np.isclose(intensities['mean'], foreground.mean())
+    assert np.isclose(intensities['sd'], foreground.std())
+    assert intensities['percentiles']['50'] == np.percentile(foreground, 50, method='inverted_cdf')
+    assert intensities['min'] == foreground.min() and intensities['max'] == foreground.max()
+
+
+def test_float_histograms(tmp_path):
+    rng = np.random.default_rng(0)
+    # normalized intensities, which integer bins would collapse to a few values
+    values = [rng.normal(0, 1, size=20000).astype(np.float32), rng.normal(0.5, 2, size=10000).astype(np.float32)]
+    histograms = [histogram(v) for v in values]
+    assert all(len(h['counts']) <= BINS for h in histograms) and histograms[0]['width'] < histograms[1]['width']
+
+    merged = merge_histograms(histograms)
+    statistics = histogram_statistics(merged)
+    everything = np.concatenate(values)
+    assert statistics['voxels'] == everything.size and isinstance(statistics['min'], float)
+    tolerance = merged['width']
+    assert abs(statistics['mean'] - everything.mean()) < tolerance
+    assert abs(statistics['sd'] - everything.std()) < tolerance
+    for p in PERCENTILES:
+        assert abs(statistics['percentiles'][str(p)] - np.percentile(everything, p)) < tolerance
+    assert abs(statistics['min'] - everything.min()) < tolerance
+    assert abs(statistics['max'] - everything.max()) < tolerance
+
+    # integers merged with non-integers on the centres of their bins of 1 are exact
+    mixed = [rng.integers(0, 4000, size=5000) + 0.5, rng.integers(-100, 5000, size=5000).astype(np.int16)]
+    histograms = [histogram(v) for v in mixed]
+    assert histograms[0]['width'] == 1 and histograms[0]['centre'] == 0.5
+    statistics = histogram_statistics(merge_histograms(histograms))
+    everything = np.concatenate(mixed)
+    assert np.isclose(statistics['mean'], everything.mean()) and np.isclose(statistics['sd'], everything.std())
+    for p in PERCENTILES:
+        assert statistics['percentiles'][str(p)] == np.percentile(everything, p, method='inverted_cdf')
+    assert statistics['min'] == everything.min() and statistics['max'] == everything.max()
+
+    # a float32 scan
+    image = values[0].reshape(20, 25, 40)
+    sitk.WriteImage(sitk.GetImageFromArray(image), str(tmp_path / 'a_0000.nii.gz'))
+    fingerprint = case_fingerprint([tmp_path / 'a_0000.nii.gz'], tmp_path / 'a.nii.gz', 3)
+    statistics = histogram_statistics(fingerprint['modalities'][0]['histogram'])
+    width = fingerprint['modalities'][0]['histogram']['width']
+    assert statistics['voxels'] == image.size and abs(statistics['mean'] - image.mean()) < width
+    assert abs(statistics['percentiles']['99.5'] - np.percentile(image, 99.5)) < width
@@ -0,0 +1,112 @@
+import asyncio
+
+import httpx, pytest
+
+from intervention.fakegc import FakeGC
+from intervention.gcclient import AsyncGC, GCRequestError
+from intervention.gcserver import GCServer
+from intervention.synthetic import generate
+
+
+def _client(fake: FakeGC, **kwargs) -> AsyncGC:
+    return AsyncGC('0' * 64, fake.reader_study['slug'], base_url=fake.base_url, transport=fake.transport(),
+                   backoff=0.001, **kwargs)
+
+
+def test_listing(tmp_path):
+    paths = generate(tmp_path, patients=3, series=2)
+    fake = FakeGC.from_answers(paths['answers'], fail_rate=0.5)
+
+    async def run():
+        async with _client(fake, retries=20) as gc:
+            paged = await gc.list('reader-studies/answers/', limit=5)
+            return await gc.questions(), await gc.answers(), await gc.display_sets(), await gc.images(), paged
+
+    questions, answers, display_sets, images, paged = asyncio.run(run())
+    assert [a['api_url'] for a in paged] == list(answers)
+    assert len(display_sets) == len(images) == 6
+    assert len(answers) == len(fake.answers) and len(questions) == len(fake.reader_study['questions'])
+    assert fake.failures > 0
+
+
+def test_upload_and_delete(tmp_path):
+    fake = FakeGC()
+    files = []
+    for i in range(5):
+        files.append(tmp_path / f'{i}.mha')
+        files[-1].write_bytes(bytes([i]) * 1000)
+
+    async def run():
+        async with _client(fake, concurrency=3) as gc:
+            pks = await asyncio.gather(*[gc.create_display_set_from_image(f, order=i) for i, f in enumerate(files)])
+            await gc.update_display_set(pks[0], order=10)
+            with pytest.raises(GCRequestError):
+                await gc.delete_display_set('missing')
+            deleted = await gc.delete_display_sets(pks[1:] + ['missing'])
+            return pks, deleted, gc.errors
+
+    pks, deleted, errors = asyncio.run(run())
+    assert sorted(fake.contents.values()) == sorted(f.read_bytes() for f in files)
+    assert list(fake.display_sets) == [pks[0]] and fake.display_sets[pks[0]]['order'] == 10
+    assert deleted == 4
+    assert [(e.method, e.status, e.attempts) for e in errors] == [('DELETE', 404, 1)]
+
+
+def test_multipart_upload(tmp_path):
+    fake = FakeGC()
+    data = bytes(range(256)) * 40
+    (tmp_path / 'large.mha').write_bytes(data)
+
+    async def run():
+        async with _client(fake) as gc:
+            return await gc.upload_file(tmp_path / 'large.mha', part_size=1000)
+
+    upload = asyncio.run(run())
+    assert len(fake.uploads[upload['pk']]['parts']) == 11
+    assert fake.uploads[upload['pk']]['content'] == data
+
+
+def test_post_not_repeated():
+    fake = FakeGC()
+    outcomes = iter(['lost', 'conflict', 'unavailable', 'refused'])
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        outcome = next(outcomes, None)
+        if outcome in ['unavailable', 'refused']:
+            # not processed, so retried
+            if outcome == 'refused':
+                raise httpx.ConnectError('fake refused', request=request)
+            return httpx.Response(503, text='fake unavailable')
+        response = fake.handle(request)
+        if outcome == 'lost':
+            raise httpx.ReadError('fake lost response', request=request)
+        return httpx.Response(409, text='fake conflict') if outcome == 'conflict' else response
+
+    async def run():
+        async with AsyncGC('0' * 64, fake.reader_study['slug'], base_url=fake.base_url,
+                           transport=httpx.MockTransport(handle), backoff=0.001) as gc:
+            for _ in range(2):
+                with pytest.raises(GCRequestError) as e:
+                    await gc.create_display_set(order=0)
+                assert e.value.error.attempts == 1
+            return await gc.create_display_set(order=1)
+
+    display_set = asyncio.run(run())
+    # the lost and the conflicting POST, each processed once, and the POST retried after 503 and a refused connection
+    assert len(fake.display_sets) == 3 and fake.display_sets[display_set['pk']]['order'] == 1
+
+
+def test_server(tmp_path):
+    fake = FakeGC.synthetic(120, page_size=25, rate_limit=0.3)
+    (tmp_path / 'scan.mha').write_bytes(b'scan' * 1000)
+
+    async def run():
+        async with AsyncGC('0' * 64, 'fake', base_url=fake.base_url, backoff=0.001, retries=20) as gc:
+            display_sets = await gc.display_sets()
+            pk = await gc.create_display_set_from_image(tmp_path / 'scan.mha')
+            return display_sets, pk
+
+    with GCServer(fake, latency=0.001):
+        display_sets, pk = asyncio.run(run())
+    assert len(display_sets) == 120 and fake.rate_limited > 0
+    assert fake.contents[fake.display_sets[pk]['values'][0]['image'].split('/')[-2]] == b'scan' * 1000
@@ -0,0 +1,22 @@
+import subprocess
+
+import pytest
+
+import intervention.inference as inference
+from intervention.inference import case_files
+
+
+def test_case_files(tmp_path):
+    for name in ['b_0000.nii.gz', 'a_0001.nii.gz', 'a_0000.nii.gz', 'dataset.json']:
+        (tmp_path / name).touch()
+    assert {k: [f.name for f in v] for k, v in case_files(tmp_path).items()} == {
+        'a': ['a_0000.nii.gz', 'a_0001.nii.gz'], 'b': ['b_0000.nii.gz']}
+
+
+def test_predict_failure(tmp_path, monkeypatch):
+    def check_call(cmd):
+        raise subprocess.CalledProcessError(1, cmd)
+
+    monkeypatch.setattr(inference.subprocess, 'check_call', check_call)
+    with pytest.raises(subprocess.CalledProcessError):
+        inference.nnUNet_predict(tmp_path, tmp_path, tmp_path, 'Task1_x', 'nnUNetTrainerV2')
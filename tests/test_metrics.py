@@ -0,0 +1,59 @@
+import json, pstats
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import intervention.metrics as metrics
+from intervention.metrics import Tracer, work_item
+
+
+def test_tracer(tmp_path):
+    with work_item('outside') as record:
+        assert record == {}
+
+    path = tmp_path / 'trace.jsonl'
+    with Tracer(path) as tracer:
+        with tracer.stage('annotate'):
+            def item(i: int):
+                with work_item(f'case{i}') as record:
+                    record['voxels'] = i
+
+            with ThreadPoolExecutor(4) as pool:
+                list(pool.map(item, range(8)))
+        with tracer.stage('mha2nnunet'):
+            pass
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    items = [r for r in records if r['type'] == 'item']
+    assert sorted(r['item'] for r in items) == [f'case{i}' for i in range(8)]
+    assert all(set(r) == {'type', 'stage', 'item', 'wall', 'cpu', 'voxels'} for r in items)
+
+    stages = [r for r in records if r['type'] == 'stage']
+    assert [(s['stage'], s['items']) for s in stages] == [('annotate', 8), ('mha2nnunet', 0)]
+    assert stages == tracer.stages and all(s['wall'] >= 0 and s['peak_rss'] > 0 for s in stages)
+    summary = tracer.summary().splitlines()
+    assert len(summary) == 4 and summary[2].split()[0] == 'annotate' and summary[2].split()[-2] == '8'
+
+
+def _busy(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+def test_stage_peak_rss_and_profile(tmp_path):
+    with Tracer(profile_dir=tmp_path / 'profile') as tracer:
+        with tracer.stage('large'):
+            array = np.ones(200_000_000 // 8)
+            del array
+        # work in pool threads, which the profile covers too
+        with tracer.stage('small'):
+            with ThreadPoolExecutor(2) as pool:
+                results = list(pool.map(_busy, [10000] * 4))
+
+    assert results == [_busy(10000)] * 4
+    large, small = tracer.stages
+    metrics._reset_peak_rss()
+    if metrics._peak_rss() < large['peak_rss'] - 100e6:
+        # the peak is reset per stage where the platform allows it
+        assert small['peak_rss'] < large['peak_rss'] - 100e6
+    stats = pstats.Stats(str(tmp_path / 'profile' / '2_small.prof'))
+    assert any(function == '_busy' for _, _, function in stats.stats)
@@ -0,0 +1,43 @@
+import json
+
+import numpy as np, SimpleITK as sitk
+
+from intervention.annotate import Boundary, rasterize
+from intervention.cache import image_header
+from intervention.grid import empty_image, target_grid
+from intervention.native import backproject, read_segmentation
+from intervention.synthetic import synthetic_image
+from intervention.utils import CommandNative
+
+
+def test_backproject(tmp_path):
+    source, (base, needle, tip) = synthetic_image(np.random.default_rng(0))
+    source.SetMetaData('0020|000e', '1.2.3')
+    (tmp_path / 'mha' / '10000').mkdir(parents=True)
+    sitk.WriteImage(source, str(tmp_path / 'mha' / '10000' / 'scan.mha'))
+    (tmp_path / 'nnunet').mkdir()
+    with open(tmp_path / 'nnunet' / 'mha2nnunet_test_settings.json', 'w') as f:
+        json.dump({'archive': [{'patient_id': '10000', 'study_id': '1_0', 'scan_paths': ['10000/scan.mha']}]}, f)
+
+    # a needle predicted on the preprocessing grid
+    prediction = empty_image(target_grid(image_header(tmp_path / 'mha' / '10000' / 'scan.mha')))
+    rasterize(prediction, [Boundary(base, needle, 1, thickness=12), Boundary(needle, tip, 2, thickness=6)])
+    (tmp_path / 'predictions').mkdir()
+    sitk.WriteImage(prediction, str(tmp_path / 'predictions' / '10000_1_0.nii.gz'))
+
+    cmd = CommandNative(name='native', summary='', base_dir=tmp_path, settings={
+        'in_dir': 'predictions', 'mha_dir': 'mha', 'nnunet_dir': 'nnunet', 'out_dir': 'native', 'overlays': True,
+        'workers': 2})
+    assert backproject(cmd) == 1
+
+    native = sitk.ReadImage(str(cmd.out_dir / '10000_1_0.nii.gz'))
+    assert native.GetSize() == source.GetSize() and np.allclose(native.GetDirection(), source.GetDirection())
+    # from the header only, the same as resampling onto the source image itself
+    array = sitk.GetArrayFromImage(native)
+    expected = sitk.Resample(prediction, source, sitk.Transform(), sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+    assert np.array_equal(array, sitk.GetArrayViewFromImage(expected)) and set(np.unique(array)) == {0, 1, 2}
+
+    assert np.array_equal(read_segmentation(cmd.out_dir / '10000_1_0'), array)
+    with open(cmd.out_dir / '10000_1_0.seg.json') as f:
+        overlay = json.load(f)
+    assert overlay['series_instance_uid'] == '1.2.3' and [s['label'] for s in overlay['segments']] == ['needle', 'tip']
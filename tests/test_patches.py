@@ -0,0 +1,38 @@
+import numpy as np, SimpleITK as sitk
+import pytest
+
+from intervention.patches import write_patch_store, PatchStore
+
+
+def test_patch_store(tmp_path):
+    rng = np.random.default_rng(0)
+    (tmp_path / 'imagesTr').mkdir()
+    (tmp_path / 'labelsTr').mkdir()
+    arrays = []
+    for i, shape in enumerate([(5, 32, 32), (5, 24, 40)]):
+        image = rng.normal(size=shape).astype(np.float32)
+        label = np.zeros(shape, dtype=np.uint8)
+        label[2, 10:12, 5:20] = 1
+        label[2, 10:12, 20:22] = 2
+        sitk.WriteImage(sitk.GetImageFromArray(image), str(tmp_path / 'imagesTr' / f'case_{i}_0000.nii.gz'))
+        sitk.WriteImage(sitk.GetImageFromArray(label), str(tmp_path / 'labelsTr' / f'case_{i}.nii.gz'))
+        arrays.append((image, label))
+
+    write_patch_store(tmp_path, tmp_path / 'patches')
+    store = PatchStore(tmp_path / 'patches')
+
+    assert store.cases == ['case_0', 'case_1']
+    assert store.index[1]['label_voxels'] == {'1': 30, '2': 4}
+    for i, (image, label) in enumerate(arrays):
+        assert np.array_equal(store.case(i)[0], image)
+        assert np.array_equal(store.case(i)[1], label)
+
+    image, label = store.sample((3, 16, 16), rng, foreground=1)
+    assert image.shape == label.shape == (3, 16, 16)
+    assert label.any()
+
+    # the store has a single pixel type
+    sitk.WriteImage(sitk.GetImageFromArray(np.zeros((5, 8, 8), dtype=np.int16)),
+                    str(tmp_path / 'imagesTr' / 'case_2_0000.nii.gz'))
+    with pytest.raises(ValueError, match='case_2'):
+        write_patch_store(tmp_path, tmp_path / 'patches')
@@ -0,0 +1,64 @@
+import json
+
+import numpy as np, SimpleITK as sitk
+
+import intervention.annotate as annotate
+from intervention.preview import preview
+from intervention.synthetic import generate, SyntheticGC
+from intervention.utils import CommandAnnotate
+
+
+def test_preview_geometry():
+    array = np.zeros((5, 50, 65), dtype=np.int16)
+    array[2, 20:22, 10:12] = 1000
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.7, 0.8, 3.0))
+    image.SetOrigin((-12.5, 40.0, 7.25))
+    c, s = np.cos(0.3), np.sin(0.3)
+    image.SetDirection((c, -s, 0, s, c, 0, 0, 0, 1))
+
+    p = preview(image, factor=2)
+    assert p.GetPixelID() == sitk.sitkUInt8
+    assert p.GetSize() == (32, 25, 5)
+
+    # each preview voxel centre is the centre of its 2 x 2 bin of the image
+    for index in [(0, 0, 0), (5, 10, 2), (31, 24, 4)]:
+        point = p.TransformIndexToPhysicalPoint(index)
+        expected = (2 * index[0] + 0.5, 2 * index[1] + 0.5, index[2])
+        assert np.allclose(image.TransformPhysicalPointToContinuousIndex(point), expected)
+
+    # the bright block lands on that preview voxel
+    assert np.unravel_index(sitk.GetArrayViewFromImage(p).argmax(), (5, 25, 32)) == (2, 10, 5)
+
+
+def test_preview_answers_roundtrip(tmp_path):
+    """points placed on previews annotate the original images at the same place"""
+    paths = generate(tmp_path, patients=1, series=2, no_needle=0)
+    with open(paths['answers']) as f:
+        gc = json.load(f)
+
+    # an annotator clicks the preview voxels nearest to the true points
+    names = {ds['api_url']: gc['cases'][ds['values'][0]['image']]['name'] for ds in gc['display_sets'].values()}
+    for answer in gc['answers'].values():
+        if isinstance(answer['answer'], dict):
+            mha = next(paths['mha'].rglob(names[answer['display_set']]))
+            p = preview(sitk.ReadImage(str(mha)), factor=2)
+            index = p.TransformPhysicalPointToIndex(answer['answer']['point'])
+            answer['answer']['point'] = list(p.TransformIndexToPhysicalPoint(index))
+    with open(tmp_path / 'preview_answers.json', 'w') as f:
+        json.dump(gc, f)
+
+    labels = {}
+    for name, answers in [('original', paths['answers']), ('preview', tmp_path / 'preview_answers.json')]:
+        cmd = CommandAnnotate(name='annotate', summary='', base_dir=tmp_path, settings={
+            'out_dir': name, 'mha_dir': paths['mha'].as_posix(), 'gc_slug': 'synthetic', 'gc_api': '0' * 64})
+        cmd.gc = SyntheticGC(answers)
+        annotate.write_annotations(cmd)
+        labels[name] = {f.name: sitk.GetArrayFromImage(sitk.ReadImage(str(f))) for f in cmd.out_dir.glob('*.nii.gz')}
+
+    assert labels['original'].keys() == labels['preview'].keys() and len(labels['original']) == 2
+    for key, original in labels['original'].items():
+        moved = labels['preview'][key]
+        dice = 2 * np.sum((original > 0) & (moved > 0)) / (np.sum(original > 0) + np.sum(moved > 0))
+        # points move at most half a preview voxel
+        assert dice > 0.8
@@ -0,0 +1,22 @@
+import numpy as np
+
+from intervention.probability import save_probabilities, ProbabilityMap
+
+
+def test_probability_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    softmax = np.zeros((3, 5, 64, 64), dtype=np.float32)
+    softmax[1:, 1:4, 10:30, 20:40] = rng.random((2, 3, 20, 20)) / 2
+    softmax[0] = 1 - softmax[1:].sum(axis=0)
+
+    npy = save_probabilities(softmax, tmp_path / 'case.npz', dtype='uint8', crop=True)
+    assert npy.stat().st_size * 4 < softmax.nbytes
+
+    pm = ProbabilityMap(npy)
+    assert pm.shape == softmax.shape
+    assert np.allclose(pm.channel(1), softmax[1], atol=1 / 255)
+    assert np.allclose(pm.slice(2, 2), softmax[2, 2], atol=1 / 255)
+
+    thresholds = [0, 0.1, 0.25, 0.4]
+    counts = pm.voxel_counts(1, thresholds)
+    assert counts == [int(pm.threshold(1, t).sum()) for t in thresholds]
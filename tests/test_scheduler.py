@@ -0,0 +1,39 @@
+import threading, time
+
+import numpy as np, SimpleITK as sitk
+
+from intervention.probability import npz_bytes
+from intervention.scheduler import Scheduler, image_bytes
+
+
+def test_scheduler_budget():
+    lock, used, peak, order = threading.Lock(), [0], [0], []
+
+    def func(size: int) -> int:
+        with lock:
+            used[0] += size
+            peak[0] = max(peak[0], used[0])
+            order.append(size)
+        time.sleep(0.01)
+        with lock:
+            used[0] -= size
+        return size
+
+    sizes = [10, 40, 20, 30, 50, 100]
+    scheduler = Scheduler(memory_budget=60, workers=4)
+    results = [future.result() for _, future in scheduler.map(func, sizes, lambda s: s)]
+
+    assert sorted(results) == sorted(sizes)
+    # largest first, the item over budget alone
+    assert order[0] == 100
+    assert peak[0] <= 100 and scheduler.peak <= 100
+    assert max(order[1:3]) == 50
+
+
+def test_estimates(tmp_path):
+    sitk.WriteImage(sitk.Image([16, 8, 4], sitk.sitkInt16), str(tmp_path / 'scan.mha'), True)
+    assert image_bytes(tmp_path / 'scan.mha') == 16 * 8 * 4 * 2
+    assert image_bytes(tmp_path / 'scan.mha', dtype=np.uint8) == 16 * 8 * 4
+
+    np.savez_compressed(tmp_path / 'case.npz', softmax=np.zeros((3, 4, 8, 8), dtype=np.float32))
+    assert npz_bytes(tmp_path / 'case.npz') == 3 * 4 * 8 * 8 * 4
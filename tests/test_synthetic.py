@@ -0,0 +1,109 @@
+import json
+
+import numpy as np, SimpleITK as sitk
+
+from intervention.cache import image_header
+from intervention.grid import copy_grid_labels, empty_image, target_grid, GRID_DIR, MATRIX_SIZE, SPACING
+from intervention.synthetic import generate, SyntheticGC
+import intervention.annotate as annotate
+from intervention.utils import CommandAnnotate
+
+
+def test_synthetic_annotations(tmp_path):
+    paths = generate(tmp_path, patients=2, series=2, no_needle=0)
+    assert len(list(paths['archive'].rglob('*.dcm'))) == 4 * 5
+
+    cmd = CommandAnnotate(name='annotate', summary='', base_dir=tmp_path, settings={
+        'out_dir': 'annotations', 'mha_dir': paths['mha'].as_posix(), 'gc_slug': 'synthetic', 'gc_api': '0' * 64,
+        'cache_dir': 'cache'})
+    cmd.gc = SyntheticGC(paths['answers'])
+    annotate.write_annotations(cmd)
+
+    annotations = list(cmd.out_dir.glob('*.nii.gz'))
+    assert len(annotations) == 4
+    for annotation in annotations:
+        assert sitk.GetArrayViewFromImage(sitk.ReadImage(str(annotation))).max() == 2
+
+
+def test_preflight(tmp_path):
+    paths = generate(tmp_path, patients=1, series=4, no_needle=0)
+    with open(paths['answers']) as f:
+        gc = json.load(f)
+
+    # a tip far outside the first image, casing on the needle point in the second, an unreadable third image
+    points = {}
+    for answer in gc['answers'].values():
+        if isinstance(answer['answer'], dict):
+            points.setdefault(answer['display_set'], []).append(answer['answer'])
+    first, second, third, _ = [points[ds] for ds in sorted(points)]
+    first[2]['point'] = [p + 500 for p in first[2]['point']]
+    second[0]['point'] = list(second[1]['point'])
+    names = {ds['api_url']: gc['cases'][ds['values'][0]['image']]['name'] for ds in gc['display_sets'].values()}
+    next(paths['mha'].rglob(names[sorted(points)[2]])).write_bytes(b'not an image')
+    with open(paths['answers'], 'w') as f:
+        json.dump(gc, f)
+
+    cmd = CommandAnnotate(name='annotate', summary='', base_dir=tmp_path, settings={
+        'out_dir': 'annotations', 'mha_dir': paths['mha'].as_posix(), 'gc_slug': 'synthetic', 'gc_api': '0' * 64})
+    cmd.gc = SyntheticGC(paths['answers'])
+    assert annotate.write_annotations(cmd) == {'successes': 1, 'skips': 3, 'errors': 0}
+
+    log = next(cmd.out_dir.glob('annotation_log_*.log')).read_text()
+    assert 'tip point outside the image' in log and 'coincident casing and needle points' in log
+    assert 'unreadable mha' in log
+
+
+def test_grid_annotations(tmp_path):
+    paths = generate(tmp_path, patients=1, series=2, no_needle=0)
+    cmd = CommandAnnotate(name='annotate', summary='', base_dir=tmp_path, settings={
+        'out_dir': 'annotations', 'mha_dir': paths['mha'].as_posix(), 'gc_slug': 'synthetic', 'gc_api': '0' * 64,
+        'grid': True})
+    cmd.gc = SyntheticGC(paths['answers'])
+    annotate.write_annotations(cmd)
+
+    for path in cmd.out_dir.glob('*.nii.gz'):
+        native, grid = sitk.ReadImage(str(path)), sitk.ReadImage(str(cmd.out_dir / GRID_DIR / path.name))
+        assert grid.GetSize() == MATRIX_SIZE[::-1] and np.allclose(grid.GetSpacing(), SPACING[::-1])
+        # the grid is centred on the image, up to a voxel of either
+        centre = [img.TransformContinuousIndexToPhysicalPoint([(s - 1) / 2 for s in img.GetSize()])
+                  for img in [native, grid]]
+        assert np.linalg.norm(np.subtract(*centre)) < np.linalg.norm(SPACING)
+
+        # rasterized on the grid, the needle matches the resampled native annotation
+        resampled = sitk.GetArrayViewFromImage(sitk.Resample(native, grid, sitk.Transform(), sitk.sitkNearestNeighbor))
+        gridded = sitk.GetArrayViewFromImage(grid)
+        assert gridded.max() == 2
+        dice = 2 * np.sum((resampled > 0) & (gridded > 0)) / (np.sum(resampled > 0) + np.sum(gridded > 0))
+        assert dice > 0.8
+
+
+    # labels the converter wrote are replaced by the gridded annotations, if the scan is on their grid
+    task = tmp_path / 'Task100_test'
+    (task / 'imagesTr').mkdir(parents=True)
+    (task / 'labelsTr').mkdir()
+    archive = []
+    for i, path in enumerate(sorted(cmd.out_dir.glob('*.nii.gz'))):
+        case = f'case_{i}'
+        header = image_header(path)
+        # the second scan is not on the grid
+        scan = empty_image(target_grid(header) if i == 0 else header)
+        sitk.WriteImage(scan, str(task / 'imagesTr' / f'{case}_0000.nii.gz'))
+        sitk.WriteImage(empty_image(target_grid(header)), str(task / 'labelsTr' / f'{case}.nii.gz'))
+        archive.append({'patient_id': 'case', 'study_id': str(i), 'annotation_path': f'{GRID_DIR}/{path.name}'})
+    assert copy_grid_labels(task, 'Tr', archive, cmd.out_dir) == 1
+    labels = [sitk.GetArrayFromImage(sitk.ReadImage(str(task / 'labelsTr' / f'case_{i}.nii.gz'))) for i in range(2)]
+    grid = sitk.GetArrayFromImage(sitk.ReadImage(str(cmd.out_dir / archive[0]['annotation_path'])))
+    assert np.array_equal(labels[0], grid) and labels[1].max() == 0
+
+
+def test_distributed_annotations(tmp_path):
+    paths = generate(tmp_path, patients=2, series=2, no_needle=0)
+    cmd = CommandAnnotate(name='annotate', summary='', base_dir=tmp_path, settings={
+        'out_dir': 'annotations', 'mha_dir': paths['mha'].as_posix(), 'gc_slug': 'synthetic', 'gc_api': '0' * 64,
+        'queue_dir': 'queue', 'shards': 2})
+    # the shards rebuild their command with a real client, they read the answers the coordinator downloaded
+    cmd.gc = SyntheticGC(paths['answers'])
+    assert annotate.write_annotations(cmd) == {'successes': 4, 'skips': 0, 'errors': 0}
+    assert len(list(cmd.out_dir.glob('*.nii.gz'))) == 4
+    assert len(list(cmd.out_dir.glob('annotation_log_*.log'))) == 1
+    assert not (cmd.out_dir / 'shards').exists()
@@ -0,0 +1,35 @@
+import numpy as np, SimpleITK as sitk
+
+from intervention.tips import localize, localize_dir, NEEDLE, TIP
+
+
+def _label(tip_at_end: bool) -> sitk.Image:
+    array = np.zeros((5, 40, 60), dtype=np.uint8)
+    array[2, 20, 5:45] = NEEDLE
+    array[2, 20, 45:50] = TIP if tip_at_end else NEEDLE
+    array[4, 2:4, 2:4] = NEEDLE  # a smaller, spurious component
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.5, 0.5, 3.0))
+    image.SetOrigin((10.0, -5.0, 2.0))
+    return image
+
+
+def test_localize(tmp_path):
+    assert localize(sitk.Image(10, 10, 3, sitk.sitkUInt8)) is None
+
+    needle = localize(_label(True))
+    assert needle.components == 2 and needle.voxels == 45
+    assert np.allclose(needle.tip, (10 + 49 * 0.5, -5 + 20 * 0.5, 2 + 2 * 3.0))
+    assert np.allclose(needle.entry, (10 + 5 * 0.5, 5.0, 8.0))
+    assert np.allclose(needle.direction, (1, 0, 0)) and np.isclose(needle.length, 22)
+    assert np.isclose(needle.azimuth, 0) and np.isclose(needle.elevation, 0)
+
+    # without a TIP label, the end nearest the image centre (x = 29.5) is the tip
+    needle = localize(_label(False))
+    assert np.allclose(needle.tip, (34.5, 5.0, 8.0))
+
+    sitk.WriteImage(_label(True), str(tmp_path / 'a.nii.gz'))
+    sitk.WriteImage(sitk.Image(10, 10, 3, sitk.sitkUInt8), str(tmp_path / 'b.nii.gz'))
+    rows = localize_dir(tmp_path, workers=2)
+    assert [(r['case'], r['found']) for r in rows] == [('a', True), ('b', False)]
+    assert rows[0]['tip_x'] == 34.5 and (tmp_path / 'tips.csv').read_text().startswith('case,found,tip_x')
@@ -0,0 +1,78 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx, numpy as np, SimpleITK as sitk
+
+from intervention.fakegc import FakeGC
+from intervention.gcclient import AsyncGC
+from intervention.upload import upload_copy, upload_data, is_compressed
+from intervention.utils import GCAPI
+
+
+def test_upload_data(tmp_path):
+    rng = np.random.default_rng(0)
+    images = {}
+    for i in range(3):
+        (tmp_path / 'mha' / str(i)).mkdir(parents=True)
+        array = np.zeros((5, 64, 64), dtype=np.int16)
+        array[:, 20:40, 20:40] = rng.integers(0, 100, size=(5, 20, 20))
+        images[f'{i}.mha'] = array
+        # uncompressed and compressed files
+        sitk.WriteImage(sitk.GetImageFromArray(array), str(tmp_path / 'mha' / str(i) / f'{i}.mha'), i == 0)
+    assert [is_compressed(tmp_path / 'mha' / str(i) / f'{i}.mha') for i in range(3)] == [True, False, False]
+
+    fake = FakeGC()
+    gc = GCAPI(fake.reader_study['slug'], '0' * 64)
+    gc.async_client = lambda: AsyncGC('0' * 64, gc.slug, base_url=fake.base_url, transport=fake.transport())
+    errors = upload_data(tmp_path / 'mha', gc, cache_dir=tmp_path / 'cache')
+
+    assert errors == []
+    assert len(list((tmp_path / 'cache').iterdir())) == 2
+    assert sorted(ds['order'] for ds in fake.display_sets.values()) == [1, 2, 3]
+    for pk, content in fake.contents.items():
+        name = fake.images[pk]['name']
+        (tmp_path / name).write_bytes(content)
+        assert is_compressed(tmp_path / name)
+        assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / name))), images[name])
+
+
+def test_concurrent_upload_copies(tmp_path):
+    array = np.arange(5 * 64 * 64, dtype=np.int16).reshape(5, 64, 64)
+    sitk.WriteImage(sitk.GetImageFromArray(array), str(tmp_path / 'image.mha'))
+    (tmp_path / 'cache').mkdir()
+
+    # threads of one process copying the same image write their own temporary files
+    with ThreadPoolExecutor(8) as pool:
+        copies = set(pool.map(lambda _: upload_copy(tmp_path / 'image.mha', tmp_path / 'cache'), range(16)))
+    copy, = copies
+    assert is_compressed(copy) and [p.name for p in (tmp_path / 'cache').iterdir()] == [copy.name]
+    assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(copy))), array)
+
+
+def test_failed_uploads(tmp_path):
+    for i, name in enumerate(['a', 'unreadable', 'refused']):
+        (tmp_path / 'mha' / str(i)).mkdir(parents=True)
+        sitk.WriteImage(sitk.GetImageFromArray(np.full((5, 16, 16), i, dtype=np.int16)),
+                        str(tmp_path / 'mha' / str(i) / f'{name}.mha'), True)
+    # an uncompressed header without its data
+    (tmp_path / 'mha' / '1' / 'unreadable.mha').write_text('ObjectType = Image\nNDims = 3\nDimSize = 16 16 5\n'
+                                                          'ElementType = MET_SHORT\nElementDataFile = LOCAL\n')
+
+    fake = FakeGC()
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        # the storage refuses the parts of one upload
+        pk = request.url.path.split('/')[2] if request.url.path.startswith('/s3/') else None
+        if pk and fake.uploads[pk]['filename'] == 'refused.mha':
+            return httpx.Response(403, text='fake refused part')
+        return fake.handle(request)
+
+    gc = GCAPI(fake.reader_study['slug'], '0' * 64)
+    gc.async_client = lambda: AsyncGC('0' * 64, gc.slug, base_url=fake.base_url, transport=httpx.MockTransport(handle),
+                                      backoff=0.001)
+    errors = upload_data(tmp_path / 'mha', gc, cache_dir=tmp_path / 'cache')
+
+    assert sorted((e.method, e.status) for e in errors) == [('PUT', 403), ('UPLOAD', None)]
+    assert 'unreadable.mha' in next(e for e in errors if e.method == 'UPLOAD').url
+    # no empty display sets are left behind
+    assert len(fake.display_sets) == 1 and all(ds['values'] for ds in fake.display_sets.values())
+    assert [fake.images[pk]['name'] for pk in fake.contents] == ['a.mha']
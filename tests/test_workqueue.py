@@ -0,0 +1,85 @@
+import multiprocessing, os, time
+
+import pytest
+
+from intervention.utils import CommandAnnotate
+from intervention.workqueue import WorkQueue, merge_shards, task_command, work
+
+
+def _record(task: dict) -> dict:
+    time.sleep(0.01)
+    with open(os.path.join(task['out'], f'{task["n"]}.{os.getpid()}'), 'w'):
+        pass
+    return {'square': task['n'] ** 2}
+
+
+def test_workers(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue')
+    out = tmp_path / 'out'
+    out.mkdir()
+    task_ids = [queue.put({'n': n, 'out': str(out)}) for n in range(30)]
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=work, args=(queue.root, _record), kwargs={'idle_timeout': 0.5, 'poll': 0.01})
+               for _ in range(3)]
+    for w in workers:
+        w.start()
+    results = queue.join(task_ids, poll=0.01)
+    for w in workers:
+        w.join()
+
+    # every task ran exactly once
+    assert sorted(int(f.split('.')[0]) for f in os.listdir(out)) == list(range(30))
+    assert results == [{'square': n ** 2} for n in range(30)]
+
+
+def test_reclaim(tmp_path):
+    queue = WorkQueue(tmp_path)
+    task_id = queue.put({'n': 0}, lease=0.1, max_attempts=2)
+
+    # a worker claims the task and dies
+    assert queue.claim()['id'] == task_id
+    assert queue.claim() is None
+    time.sleep(0.2)
+    assert queue.reclaim() == 1
+    assert queue.state(task_id) == 'pending'
+
+    entry = queue.claim()
+    assert entry['attempts'] == 1 and entry['errors'] == ['lease expired']
+    assert queue.run(entry, lambda task: 1 / task['n']) is False
+    assert queue.state(task_id) == 'failed'
+    with pytest.raises(RuntimeError, match='ZeroDivisionError'):
+        queue.join([task_id])
+
+
+def test_merge_shards(tmp_path):
+    for i in range(2):
+        (tmp_path / str(i) / 'case').mkdir(parents=True)
+        (tmp_path / str(i) / 'case' / f'{i}.mha').write_text(str(i))
+        (tmp_path / str(i) / 'convert.log').write_text(f'shard {i}\n')
+
+    merge_shards([tmp_path / '0', tmp_path / '1'], tmp_path / 'out')
+    assert sorted(os.listdir(tmp_path / 'out' / 'case')) == ['0.mha', '1.mha']
+    assert (tmp_path / 'out' / 'convert.log').read_text() == 'shard 0\nshard 1\n'
+    assert not (tmp_path / '0').exists()
+
+
+def test_tasks_without_secrets(tmp_path, monkeypatch):
+    key = 'f' * 64
+    (tmp_path / 'mha').mkdir()
+    cmd = CommandAnnotate(name='annotate', summary='', base_dir=tmp_path, settings={
+        'out_dir': 'annotations', 'mha_dir': 'mha', 'gc_slug': 'synthetic', 'gc_api': key,
+        'queue_dir': 'queue', 'shards': 2})
+    queue = WorkQueue(cmd.queue_dir)
+    task_ids = [queue.put(cmd.task(shard=i, shards=cmd.shards)) for i in range(cmd.shards)]
+
+    files = list(cmd.queue_dir.rglob('*.json'))
+    assert len(files) == len(task_ids)
+    for path in files:
+        assert 'gc_api' not in path.read_text() and key not in path.read_text()
+
+    # workers read the secrets from the environment by default
+    entry = queue.claim()
+    monkeypatch.setenv('GC_API_KEY', 'e' * 64)
+    assert task_command(entry['task']).gc._api == 'e' * 64
+    assert task_command(entry['task'], cmd.secrets()).gc._api == key
@@ -0,0 +1,50 @@
+import gzip
+
+import numpy as np, SimpleITK as sitk
+
+from intervention.writer import gzip_bytes, nifti_bytes, write_image
+
+
+def _oblique(shape=(5, 24, 32), dtype=np.int16, components: int = 1) -> sitk.Image:
+    rng = np.random.default_rng(0)
+    array = rng.integers(-100, 100, size=shape + ((components,) if components > 1 else ())).astype(dtype)
+    image = sitk.GetImageFromArray(array, isVector=components > 1)
+    dimension = image.GetDimension()
+    image.SetSpacing((0.5, 0.7, 3.0)[:dimension])
+    image.SetOrigin((-12.5, 30.0, 7.25)[:dimension])
+    rotation = sitk.VersorTransform((0.3, -0.2, 1.0), 0.4) if dimension == 3 else sitk.Euler2DTransform((0, 0), 0.4)
+    image.SetDirection(rotation.GetMatrix())
+    return image
+
+
+def _assert_equal(image: sitk.Image, expected: sitk.Image):
+    assert image.GetPixelID() == expected.GetPixelID() and image.GetSize() == expected.GetSize()
+    assert np.allclose(image.GetSpacing(), expected.GetSpacing())
+    assert np.allclose(image.GetOrigin(), expected.GetOrigin(), atol=1e-4)
+    assert np.allclose(image.GetDirection(), expected.GetDirection(), atol=1e-5)
+    assert np.array_equal(sitk.GetArrayFromImage(image), sitk.GetArrayFromImage(expected))
+
+
+def test_multi_block_gzip(tmp_path):
+    image = _oblique()
+    data = nifti_bytes(image)
+    compressed = gzip_bytes(data, level=6, threads=4, block_size=500)
+    assert len(data) > 10 * 500
+    assert gzip.decompress(compressed) == data
+
+    path = tmp_path / 'image.nii.gz'
+    path.write_bytes(compressed)
+    _assert_equal(sitk.ReadImage(str(path)), image)
+
+
+def test_write_image(tmp_path):
+    for i, image in enumerate([_oblique(), _oblique(dtype=np.float32), _oblique(dtype=np.uint8, components=3),
+                               _oblique(shape=(24, 32))]):
+        if image.GetDimension() == 3:
+            # an improper rotation, i.e. with a negative qfac
+            image.SetDirection((np.array(image.GetDirection()).reshape(3, 3) * [1, 1, -1]).ravel().tolist())
+        write_image(image, tmp_path / f'{i}.nii.gz', level=0)
+        sitk.WriteImage(image, str(tmp_path / f'{i}.sitk.nii.gz'))
+        _assert_equal(sitk.ReadImage(str(tmp_path / f'{i}.nii.gz')), sitk.ReadImage(str(tmp_path / f'{i}.sitk.nii.gz')))
+        _assert_equal(sitk.ReadImage(str(tmp_path / f'{i}.nii.gz')), image)
+    assert sorted(p.name for p in tmp_path.iterdir() if '.tmp' in p.name) == []